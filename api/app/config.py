@@ -20,6 +20,29 @@ class Settings(BaseSettings):
     # API 配置
     api_port: int = int(os.getenv("API_PORT", "8080"))
     cache_ttl_seconds: int = int(os.getenv("CACHE_TTL_SECONDS", "60"))
+    # 缓存未命中时的计算租约：持有租约的副本计算，其他副本最多等待 cache_lease_wait_ms
+    cache_lease_ms: int = int(os.getenv("CACHE_LEASE_MS", "30000"))
+    cache_lease_wait_ms: int = int(os.getenv("CACHE_LEASE_WAIT_MS", "3000"))
+    # 缓存软过期（cache_ttl_seconds）后仍可返回过期值、同时后台刷新的时间，超过后硬过期
+    cache_stale_ttl_seconds: int = int(os.getenv("CACHE_STALE_TTL_SECONDS", "600"))
+    # 进程内L1缓存（Redis之前）的条目数与占用上限（按缓存的响应体字节数）
+    l1_cache_max_entries: int = int(os.getenv("L1_CACHE_MAX_ENTRIES", "512"))
+    l1_cache_max_mb: int = int(os.getenv("L1_CACHE_MAX_MB", "64"))
+    # 仪表盘默认视图预热（Worker每轮聚合后调用）：预热结果可代替截止时间晚于预热时间不超过该秒数的请求，
+    # 同时作为预热结果的缓存时间；排行预热的条数（逗号分隔，每个条数单独预热一份响应体）
+    cache_warm_max_lag_seconds: int = int(os.getenv("CACHE_WARM_MAX_LAG_SECONDS", "420"))
+    cache_warm_top_limits: str = os.getenv("CACHE_WARM_TOP_LIMITS", "10,50")
+    # 预热接口的共享密钥（与Worker一致），请求头 X-Cache-Warm-Token 不一致时拒绝；为空时不接受预热请求
+    cache_warm_token: str = os.getenv("CACHE_WARM_TOKEN", "")
+    # /stats/series 与 /stats/top 范围已全部聚合（结束时间不晚于聚合水位）时响应的 Cache-Control max-age：
+    # 结果只随聚合修订号变化，可缓存较久；包含logs尾部的响应不带ETag且不缓存
+    http_closed_max_age_seconds: int = int(os.getenv("HTTP_CLOSED_MAX_AGE_SECONDS", "300"))
+    # 聚合水位与修订号（Worker写入Redis）在进程内的缓存时间，Worker推进水位或重算后最多延迟该秒数生效
+    aggregation_state_ttl_seconds: int = int(os.getenv("AGGREGATION_STATE_TTL_SECONDS", "5"))
+    # 时序/TopN封闭分段（聚合水位之前按天切分）的缓存时间，分段内容不再变化，迟到日志重算后由修订号失效
+    segment_cache_ttl_seconds: int = int(os.getenv("SEGMENT_CACHE_TTL_SECONDS", "86400"))
+    # 交叉维度聚合（与Worker的 AGG_CUBES 保持一致），决定哪些过滤组合可由聚合表回答
+    agg_cubes: str = os.getenv("AGG_CUBES", "user:model,channel:model")
     
     # 日志配置
     log_level: str = os.getenv("LOG_LEVEL", "INFO")
@@ -1,17 +1,104 @@
 """依赖注入模块 - 数据库连接池和Redis连接管理"""
 import os
+import asyncio
+import json
+import time
+import uuid
+from collections import OrderedDict
 import aiomysql
 import redis.asyncio as redis
-from typing import Optional
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple
 import structlog
 
 from .config import settings
+from .metrics import CACHE_LOOKUPS, CACHE_COALESCED, CACHE_REFRESHES
+from .responses import encode_body
 
 logger = structlog.get_logger()
 
 # 全局连接池实例
 _mysql_pool: Optional[aiomysql.Pool] = None
 _redis_client: Optional[redis.Redis] = None
+# 不解码响应的Redis客户端，用于读写结果缓存中的响应体字节
+_redis_binary_client: Optional[redis.Redis] = None
+
+
+class L1Cache:
+    """进程内LRU/TTL缓存，保存编码后的响应体，位于Redis之前
+
+    条目数与占用（响应体字节数）均有上限，超出时淘汰最久未使用的条目。
+    条目带软/硬两个过期时间，硬过期时间不晚于对应Redis键的过期时间。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # 缓存键 -> (软过期时间monotonic, 硬过期时间monotonic, 响应体, 字节数)
+        self._entries: "OrderedDict[str, Tuple[float, float, Any, int]]" = OrderedDict()
+
+    def get(self, key: str) -> Tuple[bool, Any, bool]:
+        """返回 (是否命中, 结果, 是否已过软过期时间)，硬过期的条目在读取时删除"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None, False
+        now = time.monotonic()
+        if entry[1] <= now:
+            self._remove(key)
+            return False, None, False
+        self._entries.move_to_end(key)
+        return True, entry[2], entry[0] <= now
+
+    def set(self, key: str, value: Any, size: int, soft_ttl: float, hard_ttl: float):
+        """写入条目，超过单条上限（总上限的1/4）或硬TTL非正时不缓存"""
+        if key in self._entries:
+            self._remove(key)
+        if hard_ttl <= 0 or self.max_entries <= 0 or size > self.max_bytes // 4:
+            return
+        now = time.monotonic()
+        self._entries[key] = (now + soft_ttl, now + hard_ttl, value, size)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        size = self._entries.pop(key)[3]
+        self.total_bytes -= size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_l1_cache = L1Cache(settings.l1_cache_max_entries, settings.l1_cache_max_mb * 1024 * 1024)
+
+# 各缓存层的命中统计（本进程），Prometheus指标之外供 /health/cache 查看
+_cache_stats: Dict[str, Dict[str, int]] = {
+    "l1": {"hit": 0, "miss": 0, "stale": 0},
+    "redis": {"hit": 0, "miss": 0, "stale": 0},
+}
+
+# 正在后台刷新的缓存键 -> 刷新任务（同一键只刷新一次，同时持有任务引用）
+_refreshing: Dict[str, asyncio.Task] = {}
+
+# 进程内正在计算的缓存键 -> 计算结果（单飞）
+_inflight: Dict[str, asyncio.Future] = {}
+
+# 聚合水位与修订号的进程内缓存：(过期时间monotonic, 聚合水位, 修订号)
+_aggregation_state: Optional[Tuple[float, Optional[int], str]] = None
+
+# 结果缓存值的格式版本：2 为编码后的完整响应体（此前为 json.dumps 的查询结果）
+CACHE_FORMAT_VERSION = 2
+
+# 等待其他副本计算时轮询缓存的间隔（秒）
+_LEASE_POLL_INTERVAL = 0.05
+
+# 仅当租约仍属于自己时才释放，避免租约过期后误删其他副本的租约
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 
 async def get_mysql_pool() -> aiomysql.Pool:
@@ -71,9 +158,26 @@ async def get_redis_client() -> redis.Redis:
     return _redis_client
 
 
+async def get_redis_binary_client() -> redis.Redis:
+    """获取不解码响应的Redis客户端（结果缓存以字节保存响应体）"""
+    global _redis_binary_client
+
+    if _redis_binary_client is None:
+        _redis_binary_client = redis.from_url(
+            settings.redis_url,
+            decode_responses=False,
+            socket_connect_timeout=30,
+            socket_timeout=30,
+            retry_on_timeout=True,
+            health_check_interval=30,
+        )
+
+    return _redis_binary_client
+
+
 async def close_connections():
     """关闭所有连接"""
-    global _mysql_pool, _redis_client
+    global _mysql_pool, _redis_client, _redis_binary_client
     
     if _mysql_pool:
         _mysql_pool.close()
@@ -86,6 +190,10 @@ async def close_connections():
         _redis_client = None
         logger.info("Redis连接已关闭")
 
+    if _redis_binary_client:
+        await _redis_binary_client.close()
+        _redis_binary_client = None
+
 
 async def execute_query(sql: str, params: dict = None) -> list:
     """执行SQL查询并返回结果"""
@@ -112,46 +220,362 @@ async def execute_query(sql: str, params: dict = None) -> list:
         raise
 
 
-async def get_cached_result(cache_key: str, query_func, ttl: int = None) -> any:
-    """获取缓存结果，如果不存在则执行查询函数并缓存"""
-    redis_client = await get_redis_client()
-    ttl = ttl or settings.cache_ttl_seconds
+async def stream_query(sql: str, params: dict = None,
+                       batch_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+    """以服务端游标（SSCursor）流式执行单条查询，按批返回结果
+
+    结果不在客户端整体缓冲，内存占用与批大小成正比，适用于导出等大结果集。
+    迭代完成前会占用一个连接。
+    """
+    pool = await get_mysql_pool()
     
     try:
-        # 尝试从缓存获取
-        cached_data = await redis_client.get(cache_key)
-        if cached_data:
-            import json
-            logger.debug("缓存命中", cache_key=cache_key)
-            return json.loads(cached_data)
-        
-        # 缓存未命中，执行查询
-        logger.debug("缓存未命中，执行查询", cache_key=cache_key)
-        result = await query_func()
-        
-        # 存储到缓存
-        import json
-        await redis_client.setex(
-            cache_key, 
-            ttl, 
-            json.dumps(result, ensure_ascii=False, default=str)
-        )
-        
-        return result
-        
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSDictCursor) as cursor:
+                await cursor.execute(sql.strip().rstrip(';'), params or {})
+                while True:
+                    batch = await cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    yield list(batch)
+                
+    except Exception as e:
+        logger.error("流式SQL查询执行失败", sql=sql[:100], error=str(e))
+        raise
+
+
+def _record_lookup(endpoint: str, tier: str, result: str):
+    """记录一次缓存查找结果"""
+    CACHE_LOOKUPS.labels(endpoint, tier, result).inc()
+    _cache_stats[tier][result] += 1
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    """返回本进程各缓存层的查找次数与命中率（过期值计入命中），以及L1缓存的占用"""
+    tiers = {}
+    for tier, counts in _cache_stats.items():
+        total = sum(counts.values())
+        served = counts["hit"] + counts["stale"]
+        tiers[tier] = {**counts, "hit_rate": round(served / total, 4) if total else None}
+    return {
+        "tiers": tiers,
+        "l1": {
+            "entries": len(_l1_cache),
+            "bytes": _l1_cache.total_bytes,
+            "max_entries": _l1_cache.max_entries,
+            "max_bytes": _l1_cache.max_bytes,
+        },
+        "refreshing": len(_refreshing),
+    }
+
+
+def _cache_endpoint(cache_key: str) -> str:
+    """从缓存键（newapi_monitor:{endpoint}:{hash}）中取出接口名，用作指标标签"""
+    parts = cache_key.split(":")
+    return parts[1] if len(parts) > 2 else "unknown"
+
+
+async def get_cached_body(cache_key: str, query_func, ttl: int = None, binary: bool = False) -> bytes:
+    """获取缓存的响应体，如果不存在则执行查询函数，编码后缓存
+
+    query_func 返回完整的响应内容，以 encode_body 编码（orjson，binary 时为MessagePack，较大时gzip压缩）后缓存；
+    命中时直接返回字节，由 body_response 构造响应，不再解码为Python对象。
+
+    缓存条目在 ttl（默认 cache_ttl_seconds）后软过期，再过 cache_stale_ttl_seconds 后硬过期。
+    软过期到硬过期之间直接返回过期值，并在后台刷新（同一键只刷新一次），
+    只有硬过期（或从未缓存）时请求才需要等待查询。
+
+    先查进程内L1缓存，未命中再查Redis。
+    同一进程内相同缓存键的并发请求只执行一次查询，其余请求等待同一结果（单飞）；
+    多个API副本之间以Redis租约选出一个副本执行查询，见 _load_or_compute。
+    """
+    endpoint = _cache_endpoint(cache_key)
+    ttl = ttl or settings.cache_ttl_seconds
+
+    async def encode() -> bytes:
+        return encode_body(await query_func(), binary)
+
+    hit, body, stale = _l1_cache.get(cache_key)
+    if hit:
+        _record_lookup(endpoint, "l1", "stale" if stale else "hit")
+        if stale:
+            _schedule_refresh(cache_key, endpoint, encode, ttl)
+        return body
+    _record_lookup(endpoint, "l1", "miss")
+
+    inflight = _inflight.get(cache_key)
+    if inflight is not None:
+        CACHE_COALESCED.labels(endpoint, "process").inc()
+        try:
+            return await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            # 执行查询的请求被取消（如客户端断开）时由当前请求重新执行，自身被取消则继续抛出
+            if not inflight.cancelled():
+                raise
+
+    future = asyncio.get_running_loop().create_future()
+    # 没有等待者时也标记异常已读取，避免未读取异常的告警
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[cache_key] = future
+    try:
+        body = await _load_or_compute(cache_key, endpoint, encode, ttl)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(body)
+        return body
+    finally:
+        if _inflight.get(cache_key) is future:
+            del _inflight[cache_key]
+
+
+async def _load_or_compute(cache_key: str, endpoint: str, query_func, ttl: int) -> bytes:
+    """读取Redis缓存，未命中时在Redis租约保护下执行查询并写入缓存，query_func 返回编码后的响应体
+
+    Redis中的值已软过期时直接返回并在后台刷新。硬过期后获得租约（SET NX PX）的副本执行查询，
+    其他副本轮询等待其写入结果，超过 cache_lease_wait_ms 后自行查询。
+    Redis读到的值与查询结果都写入L1缓存；Redis不可用时直接执行查询，结果只写入L1缓存。
+    """
+    lease_key = f"{cache_key}:lease"
+    token = uuid.uuid4().hex
+    leased = False
+
+    try:
+        redis_client = await get_redis_binary_client()
+        cached = await _get_with_ttl(redis_client, cache_key)
+        if cached:
+            stale = _cache_to_l1(cache_key, *cached)
+            _record_lookup(endpoint, "redis", "stale" if stale else "hit")
+            if stale:
+                _schedule_refresh(cache_key, endpoint, query_func, ttl)
+            logger.debug("缓存命中", cache_key=cache_key, stale=stale)
+            return cached[0]
+
+        _record_lookup(endpoint, "redis", "miss")
+        leased = bool(await redis_client.set(lease_key, token, nx=True, px=settings.cache_lease_ms))
+        if not leased:
+            CACHE_COALESCED.labels(endpoint, "lease").inc()
+            waited = 0.0
+            while waited < settings.cache_lease_wait_ms / 1000:
+                await asyncio.sleep(_LEASE_POLL_INTERVAL)
+                waited += _LEASE_POLL_INTERVAL
+                cached = await _get_with_ttl(redis_client, cache_key)
+                if cached:
+                    _cache_to_l1(cache_key, *cached)
+                    return cached[0]
+            logger.debug("等待其他副本计算超时，直接执行查询", cache_key=cache_key)
     except Exception as e:
         logger.warning("缓存操作失败，直接执行查询", cache_key=cache_key, error=str(e))
-        # 缓存失败时直接执行查询
-        return await query_func()
+        body = await query_func()
+        _store_l1(cache_key, body, ttl)
+        return body
+
+    # 缓存未命中，执行查询
+    logger.debug("缓存未命中，执行查询", cache_key=cache_key)
+    try:
+        body = await query_func()
+    finally:
+        if leased:
+            await _release_lease(lease_key, token)
+
+    _store_l1(cache_key, body, ttl)
+    await _write_redis(cache_key, body, ttl)
+    return body
+
+
+def _schedule_refresh(cache_key: str, endpoint: str, query_func, ttl: int):
+    """在后台刷新已软过期的缓存条目，同一键已在刷新时不重复创建任务"""
+    if cache_key in _refreshing:
+        return
+    task = asyncio.create_task(_refresh(cache_key, endpoint, query_func, ttl))
+    _refreshing[cache_key] = task
+    task.add_done_callback(lambda _: _refreshing.pop(cache_key, None))
+
+
+async def _refresh(cache_key: str, endpoint: str, query_func, ttl: int):
+    """后台刷新缓存条目
+
+    Redis中已有未软过期的值（其他副本刷新过）时只更新L1缓存；
+    否则获得租约的副本执行查询并写回，未获得租约说明其他副本正在刷新，直接跳过。
+    Redis不可用时执行查询，结果只写入L1缓存。
+    """
+    lease_key = f"{cache_key}:lease"
+    token = uuid.uuid4().hex
+    try:
+        try:
+            redis_client = await get_redis_binary_client()
+            cached = await _get_with_ttl(redis_client, cache_key)
+            if cached and not _cache_to_l1(cache_key, *cached):
+                CACHE_REFRESHES.labels(endpoint, "reloaded").inc()
+                return
+            if not await redis_client.set(lease_key, token, nx=True, px=settings.cache_lease_ms):
+                CACHE_REFRESHES.labels(endpoint, "skipped").inc()
+                return
+        except Exception as e:
+            logger.warning("缓存刷新时Redis不可用，仅刷新进程内缓存", cache_key=cache_key, error=str(e))
+            _store_l1(cache_key, await query_func(), ttl)
+            CACHE_REFRESHES.labels(endpoint, "refreshed").inc()
+            return
+
+        try:
+            body = await query_func()
+        finally:
+            await _release_lease(lease_key, token)
+        _store_l1(cache_key, body, ttl)
+        await _write_redis(cache_key, body, ttl)
+        CACHE_REFRESHES.labels(endpoint, "refreshed").inc()
+        logger.debug("缓存后台刷新完成", cache_key=cache_key)
+    except Exception as e:
+        CACHE_REFRESHES.labels(endpoint, "failed").inc()
+        logger.warning("缓存后台刷新失败", cache_key=cache_key, error=str(e))
+
+
+def _store_l1(cache_key: str, body: bytes, ttl: int):
+    """以刚写入的软/硬过期时间写入L1缓存"""
+    _l1_cache.set(cache_key, body, len(body), ttl, ttl + settings.cache_stale_ttl_seconds)
+
+
+async def _write_redis(cache_key: str, body: bytes, ttl: int):
+    """写入Redis，键的TTL为硬过期时间（软过期时间 + cache_stale_ttl_seconds）"""
+    try:
+        redis_client = await get_redis_binary_client()
+        await redis_client.setex(cache_key, ttl + settings.cache_stale_ttl_seconds, body)
+    except Exception as e:
+        logger.warning("写入缓存失败", cache_key=cache_key, error=str(e))
+
+
+async def _get_with_ttl(redis_client: redis.Redis, cache_key: str) -> Optional[Tuple[bytes, int]]:
+    """读取缓存的响应体及其剩余TTL（毫秒），未命中时返回None"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(cache_key)
+        pipe.pttl(cache_key)
+        body, pttl = await pipe.execute()
+    return (body, pttl) if body else None
+
+
+def _cache_to_l1(cache_key: str, body: bytes, pttl: int) -> bool:
+    """将Redis中的响应体写入L1缓存，返回是否已软过期
+
+    Redis键的TTL为硬过期时间，剩余TTL不超过 cache_stale_ttl_seconds 即已软过期；
+    键没有TTL时按刚写入处理。
+    """
+    stale_window = settings.cache_stale_ttl_seconds
+    hard_ttl = pttl / 1000 if pttl > 0 else settings.cache_ttl_seconds + stale_window
+    _l1_cache.set(cache_key, body, len(body), hard_ttl - stale_window, hard_ttl)
+    return hard_ttl <= stale_window
+
+
+async def _release_lease(lease_key: str, token: str):
+    """释放计算租约"""
+    try:
+        redis_client = await get_redis_client()
+        await redis_client.eval(_RELEASE_LEASE_SCRIPT, 1, lease_key, token)
+    except Exception as e:
+        logger.warning("释放缓存租约失败", lease_key=lease_key, error=str(e))
 
 
 def generate_cache_key(endpoint: str, params: dict) -> str:
     """生成缓存键"""
     import hashlib
-    import json
     
-    # 对参数进行排序以确保一致性
-    sorted_params = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    # 对参数进行排序以确保一致性，缓存值格式版本参与哈希，格式变化后旧缓存不再命中
+    sorted_params = json.dumps({**params, "_v": CACHE_FORMAT_VERSION}, sort_keys=True, ensure_ascii=False)
     param_hash = hashlib.md5(sorted_params.encode()).hexdigest()[:8]
     
     return f"newapi_monitor:{endpoint}:{param_hash}"
+
+
+async def get_cached_segments(keys: List[str]) -> List[Optional[Any]]:
+    """批量读取分段缓存，未命中或读取失败的位置为None"""
+    if not keys:
+        return []
+
+    try:
+        redis_client = await get_redis_client()
+        values = await redis_client.mget(keys)
+        return [json.loads(value) if value else None for value in values]
+    except Exception as e:
+        logger.warning("读取分段缓存失败", error=str(e))
+        return [None] * len(keys)
+
+
+async def set_cached_segments(segments: Dict[str, Any], ttl: int = None):
+    """批量写入分段缓存（值需可JSON序列化）"""
+    if not segments:
+        return
+
+    try:
+        redis_client = await get_redis_client()
+        ttl = ttl or settings.segment_cache_ttl_seconds
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, value in segments.items():
+                pipe.setex(key, ttl, json.dumps(value, ensure_ascii=False))
+            await pipe.execute()
+    except Exception as e:
+        logger.warning("写入分段缓存失败", error=str(e))
+
+
+async def get_warm_view(key: str) -> Optional[Tuple[int, bytes]]:
+    """读取预热视图，返回 (预热截止时间毫秒, 响应体)，未预热或读取失败时返回None
+
+    先查L1缓存，未命中再从Redis读取并写入L1缓存（cache_ttl_seconds），
+    其他副本预热的新视图最多延迟该时间后被本进程读到。
+    """
+    hit, view, _ = _l1_cache.get(key)
+    if hit:
+        return view
+
+    try:
+        redis_client = await get_redis_binary_client()
+        end_ms, body = await redis_client.mget([f"{key}:end_ms", key])
+    except Exception as e:
+        logger.warning("读取预热视图失败", key=key, error=str(e))
+        return None
+
+    if not (end_ms and body):
+        return None
+    view = (int(end_ms), body)
+    _l1_cache.set(key, view, len(body), settings.cache_ttl_seconds, settings.cache_ttl_seconds)
+    return view
+
+
+async def set_warm_views(views: Dict[str, bytes], end_ms: int, ttl: int):
+    """批量写入预热视图的响应体及其截止时间，同时替换本进程L1缓存中的旧视图"""
+    redis_client = await get_redis_binary_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, body in views.items():
+            pipe.setex(key, ttl, body)
+            pipe.setex(f"{key}:end_ms", ttl, end_ms)
+        await pipe.execute()
+    for key, body in views.items():
+        _l1_cache.set(key, (end_ms, body), len(body), settings.cache_ttl_seconds, settings.cache_ttl_seconds)
+
+
+async def get_aggregation_state() -> Tuple[Optional[int], Optional[str]]:
+    """获取 (Worker聚合已定稿的小时边界Unix秒, 聚合修订号)
+
+    两者一次Redis往返读取，并在进程内缓存 aggregation_state_ttl_seconds 秒，
+    同一请求的HTTP缓存判断与时序/TopN查询、以及同一进程的并发请求都复用同一份值。
+    尚未聚合时水位为None，修订号默认为"0"；读取失败时返回 (None, None) 且不缓存。
+    """
+    global _aggregation_state
+    now = time.monotonic()
+    if _aggregation_state is not None and _aggregation_state[0] > now:
+        return _aggregation_state[1], _aggregation_state[2]
+
+    try:
+        redis_client = await get_redis_client()
+        last_time, revision = await redis_client.mget(["last_aggregation_time", "aggregation_revision"])
+    except Exception as e:
+        logger.warning("获取聚合水位与修订号失败，全部读取logs且不使用分段缓存", error=str(e))
+        return None, None
+
+    from datetime import datetime
+    aggregated_until = int(datetime.fromisoformat(last_time).timestamp()) if last_time else None
+    revision = revision or "0"
+    _aggregation_state = (now + settings.aggregation_state_ttl_seconds, aggregated_until, revision)
+    return aggregated_until, revision
@@ -1,12 +1,15 @@
 """FastAPI主应用模块"""
 import os
+import hmac
 import json
+import time
+import asyncio
 import structlog
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, Query, Depends
+from fastapi import FastAPI, HTTPException, Query, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from prometheus_fastapi_instrumentator import Instrumentator
@@ -14,14 +17,28 @@ from prometheus_fastapi_instrumentator import Instrumentator
 from .config import settings
 from .deps import (
     get_mysql_pool, get_redis_client, close_connections,
-    execute_query, get_cached_result, generate_cache_key
+    execute_query, stream_query, get_cached_body, generate_cache_key, get_aggregation_state,
+    get_cache_stats, get_warm_view, set_warm_views
 )
 from .queries import (
-    SERIES_QUERY, get_top_query, get_anomaly_query
+    SERIES_SLOT_SECONDS, UNIQUES_QUERY, QUANTILE_SLOT_SECONDS, TOP_DIMENSIONS,
+    get_series_query, get_top_query, get_anomaly_query, get_quantile_query,
+    split_series_range, split_top_range
 )
+from .planner import query_series, query_top, stream_series, format_series_rows, format_series_columns
 from .schemas import (
-    HealthResponse, ErrorResponse, SeriesResponse, TopResponse, 
-    AnomalyResponse, StatsQueryParams, TopQueryParams, AnomalyQueryParams
+    HealthResponse, ErrorResponse, SeriesResponse, TopResponse, UniquesResponse,
+    QuantilesResponse, AnomalyResponse, StatsQueryParams, TopQueryParams, AnomalyQueryParams
+)
+from .sketches import union_cardinality, merge_quantile_sketches_by, DDSketch
+from .responses import (
+    encode_body, body_response, conditional_response, make_etag, etag_matches, not_modified_response,
+    JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE
+)
+from .warming import (
+    DEFAULT_VIEW_RANGE_MS, DEFAULT_SERIES_SLOT_SEC, DEFAULT_SERIES_FILL, DEFAULT_TOP_DIMENSIONS,
+    DEFAULT_TOP_METRIC, series_view_key, top_view_key, parse_warm_top_limits, is_default_range,
+    match_warm_view
 )
 
 # 配置结构化日志
@@ -129,48 +146,217 @@ async def health_check():
         raise HTTPException(status_code=503, detail="服务不可用")
 
 
+@app.post("/cache/warm")
+async def warm_default_views(x_cache_warm_token: Optional[str] = Header(default=None)):
+    """预热仪表盘默认视图（由Worker在每轮聚合完成后调用）
+
+    以当前时间为截止计算最近24小时的默认时序与各维度排行，编码为响应体写入固定的缓存键。
+    请求头 X-Cache-Warm-Token 须与 CACHE_WARM_TOKEN 一致，未配置密钥时拒绝所有预热请求。
+    """
+    if not settings.cache_warm_token or not hmac.compare_digest(
+            (x_cache_warm_token or "").encode(), settings.cache_warm_token.encode()):
+        raise HTTPException(status_code=403, detail="无权调用预热接口")
+
+    started = time.perf_counter()
+    end_ms = int(time.time() * 1000)
+    start_ms = end_ms - DEFAULT_VIEW_RANGE_MS
+    limits = parse_warm_top_limits(settings.cache_warm_top_limits)
+
+    try:
+        jobs = {
+            "series": compute_series(get_series_query(DEFAULT_SERIES_SLOT_SEC, {}), start_ms, end_ms,
+                                     DEFAULT_SERIES_SLOT_SEC, {}, DEFAULT_SERIES_FILL)
+        }
+        # 各条数的排行都由最大条数的结果截取
+        if limits:
+            for by in DEFAULT_TOP_DIMENSIONS:
+                jobs[by] = compute_top(get_top_query(by, DEFAULT_TOP_METRIC, {}), start_ms, end_ms,
+                                       by, DEFAULT_TOP_METRIC, limits[-1], {})
+        results = dict(zip(jobs, await asyncio.gather(*jobs.values())))
+
+        series = results.pop("series")
+        views = {series_view_key(): encode_body({"data": format_series_rows(series), "total_points": len(series)})}
+        for by, data in results.items():
+            for limit in limits:
+                views[top_view_key(by, limit)] = encode_body({
+                    "data": data[:limit],
+                    "by": by,
+                    "metric": DEFAULT_TOP_METRIC,
+                    "limit": limit,
+                    "filters": {}
+                })
+        await set_warm_views(views, end_ms, settings.cache_warm_max_lag_seconds)
+    except Exception as e:
+        logger.error("默认视图预热失败", error=str(e))
+        raise HTTPException(status_code=500, detail="预热失败")
+
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    logger.info("默认视图预热完成", views=len(views), end_ms=end_ms, elapsed_ms=elapsed_ms)
+    return {"views": list(views), "end_ms": end_ms, "elapsed_ms": elapsed_ms}
+
+
+@app.get("/health/cache")
+async def cache_stats():
+    """本进程各缓存层（L1 / Redis）的命中统计与L1缓存占用"""
+    return get_cache_stats()
+
+
+# CSV导出每批写出的行数
+EXPORT_BATCH_SIZE = 1000
+
+# 返回的分位数：字段名 -> 分位
+TOKEN_QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+def summarize_quantiles(sketch: DDSketch) -> Dict[str, Any]:
+    """由分位数草图计算请求数与 p50/p95/p99（Token数，保留1位小数）"""
+    summary = {"count": sketch.count}
+    for field, q in TOKEN_QUANTILES.items():
+        value = sketch.quantile(q)
+        summary[field] = round(value, 1) if value is not None else None
+    return summary
+
+
+def get_segment_prefix(endpoint: str, aggregated_until: Optional[int], revision: Optional[str],
+                       params: Dict[str, Any]) -> Optional[str]:
+    """生成封闭分段的缓存键前缀（含聚合修订号），没有聚合水位或Redis不可用时返回None（不使用分段缓存）"""
+    if aggregated_until is None or revision is None:
+        return None
+    return f"{generate_cache_key(f'{endpoint}_segment', params)}:r{revision}"
+
+
+async def compute_series(queries: Dict[str, str], start_ms: int, end_ms: int, slot_sec: int,
+                         filters: Dict[str, Any], fill: str) -> List[Dict[str, Any]]:
+    """查询时序数据：聚合水位之前读聚合表（封闭分段走分段缓存），之后的尾部读logs"""
+    aggregated_until, revision = await get_aggregation_state()
+    params = {
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+        "slot_sec": slot_sec,
+        **filters,
+        # 聚合水位之前读聚合表，之后的尾部读logs，两部分并发查询
+        **split_series_range(start_ms, end_ms, aggregated_until)
+    }
+    segment_prefix = get_segment_prefix("series", aggregated_until, revision,
+                                        {"slot_sec": slot_sec, **filters})
+    return await query_series(queries, params, fill, segment_prefix)
+
+
+async def compute_top(queries: Dict[str, str], start_ms: int, end_ms: int, by: str, metric: str,
+                      limit: int, filters: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """查询TopN排行：已定稿的整小时读聚合表（封闭分段走分段缓存），其余部分读logs"""
+    aggregated_until, revision = await get_aggregation_state()
+    params = {
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+        "limit": limit,
+        **filters,
+        # 已定稿的整小时读聚合表，其余部分读logs，两部分并发查询
+        **split_top_range(start_ms, end_ms, aggregated_until)
+    }
+    segment_prefix = get_segment_prefix("top", aggregated_until, revision, {"by": by, **filters})
+    return await query_top(queries, params, TOP_DIMENSIONS[by]["field"], metric, limit, segment_prefix)
+
+
+async def get_http_cache_state(end_ms: int) -> Tuple[Optional[str], str]:
+    """返回 (聚合修订号, Cache-Control)
+
+    请求范围已全部聚合（结束时间不晚于聚合水位）时返回当前聚合修订号：结果只随修订号变化，
+    修订号参与缓存键，ETag由缓存键计算，无需读取响应体即可回答条件请求。
+    范围包含logs尾部（或读取失败）时修订号为None，响应不带ETag且不缓存：仪表盘每次轮询的结束时间
+    都不同，URL随之变化，条件请求几乎不会命中。
+    """
+    aggregated_until, revision = await get_aggregation_state()
+    if aggregated_until is not None and end_ms <= aggregated_until * 1000:
+        return revision, f"public, max-age={settings.http_closed_max_age_seconds}"
+    return None, "no-store"
+
+
+def collect_dimension_filters(**filters) -> Dict[str, Any]:
+    """收集非空的维度过滤参数（user_id / model_name / channel_id / token_id）"""
+    return {field: value for field, value in filters.items() if value is not None}
+
+
 @app.get("/stats/series")
 async def get_series_data(
+    request: Request,
     start_ms: int = Query(description="开始时间戳(毫秒)"),
     end_ms: int = Query(description="结束时间戳(毫秒)"),
-    slot_sec: int = Query(default=60, description="时间粒度(秒)")
+    slot_sec: int = Query(default=60, description="时间粒度(秒)"),
+    user_id: Optional[int] = Query(default=None, description="按用户过滤"),
+    model_name: Optional[str] = Query(default=None, description="按模型过滤"),
+    channel_id: Optional[int] = Query(default=None, description="按通道过滤"),
+    token_id: Optional[int] = Query(default=None, description="按Token过滤"),
+    fill: str = Query(default="zero", description="空时间桶补齐方式", regex="^(zero|null|none)$"),
+    format: str = Query(default="rows", description="响应格式", regex="^(rows|columnar|msgpack)$")
 ):
-    """获取时序统计数据"""
+    """获取时序统计数据
+
+    带维度过滤时读取小时级/天级聚合表中的对应维度（多个过滤条件需配置对应的交叉维度），
+    时间粒度至少为1小时。
+
+    format 为 rows 时每个时间桶一个对象；columnar 时 data 为每个字段一个数组（bucket 为Unix秒），
+    msgpack 为列格式的MessagePack编码，不再为每个点重复字段名。
+    """
     try:
         # 参数验证
         if start_ms >= end_ms:
             raise HTTPException(status_code=400, detail="开始时间必须小于结束时间")
         
-        if slot_sec not in [60, 300, 900, 1800, 3600]:  # 1分钟到1小时
+        if slot_sec not in SERIES_SLOT_SECONDS:  # 1分钟到1天
             raise HTTPException(status_code=400, detail="不支持的时间粒度")
+
+        filters = collect_dimension_filters(user_id=user_id, model_name=model_name,
+                                            channel_id=channel_id, token_id=token_id)
+        try:
+            queries = get_series_query(slot_sec, filters)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        # 生成缓存键
+        # 生成缓存键（范围已全部聚合时包含聚合修订号）
+        revision, cache_control = await get_http_cache_state(end_ms)
         cache_key = generate_cache_key("series", {
             "start_ms": start_ms,
             "end_ms": end_ms,
-            "slot_sec": slot_sec
+            "slot_sec": slot_sec,
+            "fill": fill,
+            "format": format,
+            **filters,
+            **({"revision": revision} if revision is not None else {})
         })
+        media_type = MSGPACK_MEDIA_TYPE if format == "msgpack" else JSON_MEDIA_TYPE
+
+        # 已聚合范围的条件请求在读取缓存之前回答
+        etag = make_etag(cache_key) if revision is not None else None
+        if etag and etag_matches(request, etag):
+            return not_modified_response(etag, cache_control)
         
         # 查询函数
         async def query_func():
-            params = {
-                "start_ms": start_ms,
-                "end_ms": end_ms,
-                "slot_sec": slot_sec
-            }
-            result = await execute_query(SERIES_QUERY, params)
-            return [dict(row) for row in result]
+            data = await compute_series(queries, start_ms, end_ms, slot_sec, filters, fill)
+            if format == "rows":
+                return {"data": format_series_rows(data), "total_points": len(data)}
+            return {"data": format_series_columns(data), "total_points": len(data), "slot_sec": slot_sec}
         
-        # 获取缓存结果
-        data = await get_cached_result(cache_key, query_func)
+        # 默认视图优先使用Worker预热的响应体，否则获取缓存的响应体
+        body = None
+        if (not filters and slot_sec == DEFAULT_SERIES_SLOT_SEC and fill == DEFAULT_SERIES_FILL
+                and format == "rows" and is_default_range(start_ms, end_ms)):
+            view = await get_warm_view(series_view_key())
+            if match_warm_view(view, end_ms, settings.cache_warm_max_lag_seconds * 1000):
+                body = view[1]
+        if body is None:
+            body = await get_cached_body(cache_key, query_func, binary=format == "msgpack")
         
         logger.info("时序数据查询成功", 
                    start_ms=start_ms, 
                    end_ms=end_ms, 
                    slot_sec=slot_sec,
-                   data_points=len(data))
+                   filters=filters,
+                   format=format,
+                   body_bytes=len(body))
         
-        return {"data": data, "total_points": len(data)}
+        return conditional_response(request, body, cache_control, etag, media_type)
 
     except HTTPException:
         raise
@@ -179,42 +365,185 @@ async def get_series_data(
         raise HTTPException(status_code=500, detail="查询失败")
 
 
+@app.get("/stats/uniques", response_model=UniquesResponse)
+async def get_uniques_data(
+    request: Request,
+    start_ms: int = Query(description="开始时间戳(毫秒)"),
+    end_ms: int = Query(description="结束时间戳(毫秒)")
+):
+    """获取任意时间范围内的独立用户数与独立Token数
+
+    由天级与小时级聚合表的HLL草图取并集估算，标准误差约0.8%（精度14），不扫描logs表。
+    """
+    try:
+        if start_ms >= end_ms:
+            raise HTTPException(status_code=400, detail="开始时间必须小于结束时间")
+
+        cache_key = generate_cache_key("uniques", {
+            "start_ms": start_ms,
+            "end_ms": end_ms
+        })
+
+        async def query_func():
+            rows = await execute_query(UNIQUES_QUERY, {"start_ms": start_ms, "end_ms": end_ms})
+            users = union_cardinality(row["users_sketch"] for row in rows)
+            tokens_cnt = union_cardinality(row["tokens_sketch"] for row in rows)
+
+            # 迁移前的聚合行没有草图，退回为单个时间桶去重数的最大值（下界）
+            if users is None:
+                users = max((int(row["unique_users"]) for row in rows), default=0)
+            if tokens_cnt is None:
+                tokens_cnt = max((int(row["unique_tokens"]) for row in rows), default=0)
+
+            return {"users": users, "tokens_cnt": tokens_cnt, "start_ms": start_ms, "end_ms": end_ms}
+
+        body = await get_cached_body(cache_key, query_func)
+
+        logger.info("去重计数查询成功",
+                   start_ms=start_ms,
+                   end_ms=end_ms,
+                   body_bytes=len(body))
+
+        return body_response(request, body)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("去重计数查询失败", error=str(e))
+        raise HTTPException(status_code=500, detail="查询失败")
+
+
+@app.get("/stats/quantiles", response_model=QuantilesResponse)
+async def get_quantiles_data(
+    request: Request,
+    start_ms: int = Query(description="开始时间戳(毫秒)"),
+    end_ms: int = Query(description="结束时间戳(毫秒)"),
+    slot_sec: int = Query(default=3600, description="时间粒度(秒)，3600或86400"),
+    model_name: Optional[str] = Query(default=None, description="按模型过滤")
+):
+    """获取单请求Token数（prompt + completion）的 p50/p95/p99 时序与整个范围的汇总
+
+    由小时级/天级聚合表中的DDSketch草图合并得到，相对误差约1%，不扫描logs表。
+    """
+    try:
+        if start_ms >= end_ms:
+            raise HTTPException(status_code=400, detail="开始时间必须小于结束时间")
+
+        if slot_sec not in QUANTILE_SLOT_SECONDS:
+            raise HTTPException(status_code=400, detail="不支持的时间粒度")
+
+        sql = get_quantile_query(slot_sec, model_name)
+
+        cache_key = generate_cache_key("quantiles", {
+            "start_ms": start_ms,
+            "end_ms": end_ms,
+            "slot_sec": slot_sec,
+            "model_name": model_name
+        })
+
+        async def query_func():
+            params = {"start_ms": start_ms, "end_ms": end_ms, "model_name": model_name}
+            buckets: Dict[Any, DDSketch] = {}
+            async for batch in stream_query(sql, params):
+                merge_quantile_sketches_by(batch, "bucket", "tokens_qsketch", buckets)
+
+            total = None
+            data = []
+            for bucket in sorted(buckets):
+                sketch = buckets[bucket]
+                data.append({"bucket": str(bucket), **summarize_quantiles(sketch)})
+                if total is None:
+                    total = DDSketch(gamma=sketch.gamma)
+                total.merge(sketch)
+
+            summary = summarize_quantiles(total) if total is not None else None
+            return {"data": data, "summary": summary, "slot_sec": slot_sec, "model_name": model_name}
+
+        body = await get_cached_body(cache_key, query_func)
+
+        logger.info("分位数查询成功",
+                   start_ms=start_ms,
+                   end_ms=end_ms,
+                   slot_sec=slot_sec,
+                   model_name=model_name,
+                   body_bytes=len(body))
+
+        return body_response(request, body)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("分位数查询失败", error=str(e))
+        raise HTTPException(status_code=500, detail="查询失败")
+
+
 @app.get("/stats/top")
 async def get_top_data(
+    request: Request,
     start_ms: int = Query(description="开始时间戳(毫秒)"),
     end_ms: int = Query(description="结束时间戳(毫秒)"),
     by: str = Query(description="排序维度", regex="^(user|token|model|channel)$"),
     metric: str = Query(description="排序指标", regex="^(tokens|reqs|quota_sum)$"),
-    limit: int = Query(default=50, ge=1, le=1000, description="限制数量")
+    limit: int = Query(default=50, ge=1, le=1000, description="限制数量"),
+    user_id: Optional[int] = Query(default=None, description="按用户过滤"),
+    model_name: Optional[str] = Query(default=None, description="按模型过滤"),
+    channel_id: Optional[int] = Query(default=None, description="按通道过滤"),
+    token_id: Optional[int] = Query(default=None, description="按Token过滤")
 ):
-    """获取TopN排行数据"""
+    """获取TopN排行数据
+
+    带维度过滤时（如 by=model 且按 user_id 过滤）读取排行维度与过滤维度组成的交叉维度，
+    需在 AGG_CUBES 中配置。
+    """
     try:
         # 参数验证
         if start_ms >= end_ms:
             raise HTTPException(status_code=400, detail="开始时间必须小于结束时间")
 
-        # 生成缓存键
+        filters = collect_dimension_filters(user_id=user_id, model_name=model_name,
+                                            channel_id=channel_id, token_id=token_id)
+        try:
+            queries = get_top_query(by, metric, filters)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # 生成缓存键（范围已全部聚合时包含聚合修订号）
+        revision, cache_control = await get_http_cache_state(end_ms)
         cache_key = generate_cache_key("top", {
             "start_ms": start_ms,
             "end_ms": end_ms,
             "by": by,
             "metric": metric,
-            "limit": limit
+            "limit": limit,
+            **filters,
+            **({"revision": revision} if revision is not None else {})
         })
 
+        # 已聚合范围的条件请求在读取缓存之前回答
+        etag = make_etag(cache_key) if revision is not None else None
+        if etag and etag_matches(request, etag):
+            return not_modified_response(etag, cache_control)
+
         # 查询函数
         async def query_func():
-            sql = get_top_query(by, metric)
-            params = {
-                "start_ms": start_ms,
-                "end_ms": end_ms,
-                "limit": limit
+            return {
+                "data": await compute_top(queries, start_ms, end_ms, by, metric, limit, filters),
+                "by": by,
+                "metric": metric,
+                "limit": limit,
+                "filters": filters
             }
-            result = await execute_query(sql, params)
-            return [dict(row) for row in result]
 
-        # 获取缓存结果
-        data = await get_cached_result(cache_key, query_func)
+        # 默认视图优先使用Worker预热的响应体，否则获取缓存的响应体
+        body = None
+        if (not filters and by in DEFAULT_TOP_DIMENSIONS and metric == DEFAULT_TOP_METRIC
+                and limit in parse_warm_top_limits(settings.cache_warm_top_limits)
+                and is_default_range(start_ms, end_ms)):
+            view = await get_warm_view(top_view_key(by, limit))
+            if match_warm_view(view, end_ms, settings.cache_warm_max_lag_seconds * 1000):
+                body = view[1]
+        if body is None:
+            body = await get_cached_body(cache_key, query_func)
 
         logger.info("TopN数据查询成功",
                    start_ms=start_ms,
@@ -222,14 +551,10 @@ async def get_top_data(
                    by=by,
                    metric=metric,
                    limit=limit,
-                   result_count=len(data))
+                   filters=filters,
+                   body_bytes=len(body))
 
-        return {
-            "data": data,
-            "by": by,
-            "metric": metric,
-            "limit": limit
-        }
+        return conditional_response(request, body, cache_control, etag)
 
     except HTTPException:
         raise
@@ -240,6 +565,7 @@ async def get_top_data(
 
 @app.get("/stats/anomalies")
 async def get_anomalies_data(
+    request: Request,
     start_ms: int = Query(description="开始时间戳(毫秒)"),
     end_ms: int = Query(description="结束时间戳(毫秒)"),
     rule: str = Query(description="规则名称", regex="^(burst|multi_user_token|ip_many_users|big_request)$"),
@@ -276,23 +602,23 @@ async def get_anomalies_data(
                 "sigma": sigma,
                 "limit_per_token": limit_per_token
             }
-            result = await execute_query(sql, params)
-            return [dict(row) for row in result]
+            data = list(await execute_query(sql, params))
+            return {
+                "data": data,
+                "rule": rule,
+                "total_count": len(data)
+            }
 
-        # 获取缓存结果
-        data = await get_cached_result(cache_key, query_func)
+        # 获取缓存的响应体
+        body = await get_cached_body(cache_key, query_func)
 
         logger.info("异常检测数据查询成功",
                    start_ms=start_ms,
                    end_ms=end_ms,
                    rule=rule,
-                   anomaly_count=len(data))
+                   body_bytes=len(body))
 
-        return {
-            "data": data,
-            "rule": rule,
-            "total_count": len(data)
-        }
+        return body_response(request, body)
 
     except HTTPException:
         raise
@@ -308,17 +634,31 @@ async def export_csv(
     end_ms: int = Query(description="结束时间戳(毫秒)"),
     # 其他参数根据query_type动态处理
 ):
-    """导出CSV数据"""
+    """导出CSV数据
+
+    时序与TopN与接口相同，在聚合水位处切分后并发查询聚合表与logs尾部。
+    时序按 EXPORT_BATCH_SIZE 个时间桶的窗口逐批查询并写出，内存占用与导出范围无关；
+    TopN的结果行数不超过limit，一次写出。
+    """
     try:
         from fastapi.responses import StreamingResponse
         import csv
         import io
 
-        # 根据查询类型获取数据
+        if start_ms >= end_ms:
+            raise HTTPException(status_code=400, detail="开始时间必须小于结束时间")
+
+        # 根据查询类型确定查询语句
         if query_type == "series":
             slot_sec = 300  # 默认5分钟粒度
-            data_response = await get_series_data(start_ms, end_ms, slot_sec)
-            data = data_response["data"]
+            queries = get_series_query(slot_sec)
+            aggregated_until, _ = await get_aggregation_state()
+
+            async def fetch():
+                async for data in stream_series(queries, start_ms, end_ms, slot_sec,
+                                                aggregated_until, EXPORT_BATCH_SIZE):
+                    yield format_series_rows(data)
+
             filename = f"series_data_{start_ms}_{end_ms}.csv"
 
         elif query_type == "top":
@@ -326,30 +666,53 @@ async def export_csv(
             by = "user"
             metric = "tokens"
             limit = 100
-            data_response = await get_top_data(start_ms, end_ms, by, metric, limit)
-            data = data_response["data"]
+            queries = get_top_query(by, metric)
+            params = {
+                "start_ms": start_ms,
+                "end_ms": end_ms,
+                "limit": limit,
+                **split_top_range(start_ms, end_ms, (await get_aggregation_state())[0])
+            }
+
+            async def fetch():
+                yield await query_top(queries, params, TOP_DIMENSIONS[by]["field"], metric, limit)
+
             filename = f"top_{by}_{metric}_{start_ms}_{end_ms}.csv"
 
         else:
             raise HTTPException(status_code=400, detail="暂不支持该查询类型的导出")
 
-        # 生成CSV
-        output = io.StringIO()
-        if data:
-            writer = csv.DictWriter(output, fieldnames=data[0].keys())
-            writer.writeheader()
-            writer.writerows(data)
+        async def generate_csv():
+            fieldnames = None
+            rows = 0
+            try:
+                async for data in fetch():
+                    for offset in range(0, len(data), EXPORT_BATCH_SIZE):
+                        batch = data[offset:offset + EXPORT_BATCH_SIZE]
+                        output = io.StringIO()
+                        if fieldnames is None:
+                            fieldnames = list(batch[0].keys())
+                            writer = csv.DictWriter(output, fieldnames=fieldnames)
+                            writer.writeheader()
+                        else:
+                            writer = csv.DictWriter(output, fieldnames=fieldnames)
+                        writer.writerows(batch)
+                        rows += len(batch)
+                        yield output.getvalue().encode('utf-8')
+
+                logger.info("CSV导出成功", query_type=query_type, rows=rows)
+            except Exception as e:
+                # 响应头已发送，只能记录错误并中止输出
+                logger.error("CSV导出中断", query_type=query_type, rows=rows, error=str(e))
+                raise
 
         # 返回流式响应
-        response = StreamingResponse(
-            io.BytesIO(output.getvalue().encode('utf-8')),
+        return StreamingResponse(
+            generate_csv(),
             media_type="text/csv",
             headers={"Content-Disposition": f"attachment; filename={filename}"}
         )
 
-        logger.info("CSV导出成功", query_type=query_type, rows=len(data))
-        return response
-
     except HTTPException:
         raise
     except Exception as e:
@@ -0,0 +1,28 @@
+"""Prometheus指标定义
+
+指标注册在默认registry中，启用 ENABLE_METRICS 后与请求指标一起由 /metrics 暴露。
+"""
+from prometheus_client import Counter
+
+# 结果缓存查找：tier 为 l1（进程内）/ redis；result 为 hit（命中）/ miss（未命中）/
+# stale（已软过期，返回过期值并在后台刷新）
+CACHE_LOOKUPS = Counter(
+    "newapi_monitor_cache_lookups_total",
+    "结果缓存查找次数",
+    ["endpoint", "tier", "result"],
+)
+
+# 合并到其他请求计算结果的次数：scope 为 process（同进程单飞）/ lease（等待持有Redis租约的副本）
+CACHE_COALESCED = Counter(
+    "newapi_monitor_cache_coalesced_total",
+    "合并到其他请求计算结果的请求数",
+    ["endpoint", "scope"],
+)
+
+# 软过期条目的后台刷新：result 为 refreshed（已重新查询）/ reloaded（其他副本已刷新，只更新进程内缓存）/
+# skipped（其他副本正在刷新）/ failed（查询失败，继续返回过期值）
+CACHE_REFRESHES = Counter(
+    "newapi_monitor_cache_refreshes_total",
+    "缓存后台刷新次数",
+    ["endpoint", "result"],
+)
@@ -0,0 +1,423 @@
+"""混合查询规划模块
+
+请求范围在聚合水位（Worker已定稿的小时边界）处切分：水位之前的封闭部分读聚合表，
+水位之后的开放尾部（TopN还包括首尾不足一小时的部分）读logs。两部分查询并发执行，
+在Python中合并，logs扫描范围只取决于聚合延迟（正常不超过一小时），与请求范围的长度无关。
+时序查询只返回有数据的时间桶，合并后在API中补齐空桶，不在MySQL中递归生成时间序列。
+
+封闭部分的数据不再变化，按UTC自然日切分为分段长期缓存（键中包含Worker的聚合修订号，
+迟到日志重算后整体失效）；含聚合水位的末段以水位为键，水位前进后自然换键。
+滑动时间窗口的每次刷新只需查询logs尾部，其余分段均由缓存拼接。
+"""
+import asyncio
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import structlog
+
+from .deps import execute_query, stream_query, get_cached_segments, set_cached_segments
+from .queries import SERIES_SKETCH_QUERY, get_series_tier, split_series_range
+from .sketches import HyperLogLog, merge_sketches_by
+
+logger = structlog.get_logger()
+
+# 时序数据中由草图修正的去重字段 -> 草图列
+SERIES_UNIQUE_FIELDS = {"users": "users_sketch", "tokens_cnt": "tokens_sketch"}
+
+# 时序数据的指标字段
+SERIES_METRIC_FIELDS = ("reqs", "tokens", "users", "tokens_cnt")
+
+# 分段长度（秒）：分钟级与小时级的时间粒度都能整除一天，时间桶不会跨越分段
+SEGMENT_SECONDS = 86400
+
+# 分段缓存未命中时并发查询的分段数
+SEGMENT_FETCH_CONCURRENCY = 4
+
+# 不使用分段缓存时，TopN封闭部分只取前 limit + TOP_AGG_LIMIT_MARGIN 项，
+# 用户/Token等高基数维度的长时间范围不必把全部分组读回Python
+TOP_AGG_LIMIT_MARGIN = 100
+
+
+async def _empty() -> list:
+    """无需查询的部分"""
+    return []
+
+
+async def _single_part(query: Awaitable[list]) -> List[list]:
+    """单个查询的结果作为一个部分"""
+    return [list(await query)]
+
+
+async def get_series_unique_overrides(params: dict) -> Optional[Dict[str, Dict[Any, int]]]:
+    """多个分钟桶合并为一个时间桶时，由分钟草图取并集得到各时间桶的去重数
+
+    流式读取草图并逐批合并，内存中只保留每个时间桶合并后的草图。
+    时间粒度直接对应聚合层级时返回None，此时SQL结果中的去重数即为准确值。
+    """
+    slot_sec = params["slot_sec"]
+    if get_series_tier(slot_sec) != "minute" or slot_sec <= 60:
+        return None
+
+    users, tokens_cnt = {}, {}
+    async for batch in stream_query(SERIES_SKETCH_QUERY, params):
+        merge_sketches_by(batch, "bucket", "users_sketch", users)
+        merge_sketches_by(batch, "bucket", "tokens_sketch", tokens_cnt)
+
+    return {
+        "users": {bucket: sketch.cardinality() for bucket, sketch in users.items()},
+        "tokens_cnt": {bucket: sketch.cardinality() for bucket, sketch in tokens_cnt.items()},
+    }
+
+
+def apply_series_unique_overrides(rows: List[Dict[str, Any]], overrides: Dict[str, Dict[Any, int]]):
+    """用草图并集结果替换时序数据中按分钟累加的去重数"""
+    for row in rows:
+        for field, values in overrides.items():
+            row[field] = values.get(row["bucket"], row[field])
+
+
+async def get_series_boundary_sketches(sql: Optional[str], params: dict) -> Dict[str, Dict[Any, HyperLogLog]]:
+    """读取聚合水位所在时间桶的草图，返回 {去重字段: {时间桶: 草图}}"""
+    if sql is None:
+        return {}
+
+    rows = await execute_query(sql, params)
+    return {
+        field: merge_sketches_by(rows, "bucket", sketch_field)
+        for field, sketch_field in SERIES_UNIQUE_FIELDS.items()
+    }
+
+
+def merge_series_tail(rows: List[Dict[str, Any]], tail_rows: List[Dict[str, Any]],
+                      boundary: Dict[str, Dict[Any, HyperLogLog]]):
+    """将logs尾部并入时序数据（就地修改 rows）
+
+    请求数与Token数直接相加；尾部的去重数由用户/Token ID集合计算，
+    水位所在的时间桶与封闭部分的草图取并集，缺少草图时退回为两部分相加（上界）。
+    """
+    tail: Dict[Any, Dict[str, Any]] = {}
+    for row in tail_rows:
+        part = tail.get(row["bucket"])
+        if part is None:
+            part = tail[row["bucket"]] = {"reqs": 0, "tokens": 0, "users": set(), "tokens_cnt": set()}
+        part["reqs"] += row["reqs"]
+        part["tokens"] += row["tokens"]
+        part["users"].add(row["user_id"])
+        part["tokens_cnt"].add(row["token_id"])
+
+    by_bucket = {row["bucket"]: row for row in rows}
+    buckets = set(tail)
+    for sketches in boundary.values():
+        buckets.update(bucket for bucket in sketches if bucket in by_bucket)
+
+    for bucket in buckets:
+        row = by_bucket.get(bucket)
+        if row is None:
+            row = by_bucket[bucket] = {"bucket": bucket, "reqs": 0, "tokens": 0, "users": 0, "tokens_cnt": 0}
+            rows.append(row)
+
+        part = tail.get(bucket)
+        if part is not None:
+            row["reqs"] += part["reqs"]
+            row["tokens"] += part["tokens"]
+
+        for field in SERIES_UNIQUE_FIELDS:
+            # 与聚合的COUNT(DISTINCT)语义保持一致，不计NULL
+            ids = part[field] - {None} if part is not None else set()
+            sketch = boundary.get(field, {}).get(bucket)
+            if sketch is not None:
+                for value in ids:
+                    sketch.add(value)
+                row[field] = sketch.cardinality()
+            else:
+                row[field] += len(ids)
+
+    rows.sort(key=lambda row: row["bucket"])
+
+
+def densify_series(rows: List[Dict[str, Any]], first_bucket, range_end, slot_sec: int,
+                   fill: str = "zero") -> List[Dict[str, Any]]:
+    """按时间粒度补齐 [first_bucket, range_end) 内的空时间桶
+
+    rows 为按时间桶排序的稀疏数据，first_bucket / range_end 为数据库时区下的时间（与时间桶一致），
+    按固定步长生成时间桶后一次字典查找对齐，耗时与时间桶数成线性关系。
+    fill 为 zero 时空桶补0，null 时补None（图表中显示为断点），none 时不补齐。
+    """
+    if fill == "none" or first_bucket is None:
+        return rows
+
+    by_bucket = {row["bucket"]: row for row in rows}
+    empty_value = 0 if fill == "zero" else None
+    step = timedelta(seconds=slot_sec)
+
+    dense = []
+    bucket = first_bucket
+    while bucket < range_end:
+        row = by_bucket.pop(bucket, None)
+        if row is None:
+            row = {"bucket": bucket}
+            row.update(dict.fromkeys(SERIES_METRIC_FIELDS, empty_value))
+        dense.append(row)
+        bucket += step
+
+    # 理论上不会出现范围外的时间桶，保留以免丢数据
+    if by_bucket:
+        dense.extend(by_bucket.values())
+        dense.sort(key=lambda row: row["bucket"])
+    return dense
+
+
+def _series_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """去掉边界列与没有数据的边界行，保留时间桶、Unix秒与指标"""
+    return [
+        {"bucket": row["bucket"], "ts": row["ts"], **{field: row[field] for field in SERIES_METRIC_FIELDS}}
+        for row in rows if row["bucket"] is not None
+    ]
+
+
+def _finish_series(data: List[Dict[str, Any]], bounds: List[Dict[str, Any]], slot_sec: int,
+                   fill: str) -> List[Dict[str, Any]]:
+    """补齐空时间桶并为每个时间桶补全 ts（Unix秒），bounds 为任一附带范围边界的查询结果
+
+    补齐的空桶与只出现在logs尾部的时间桶没有 ts，由首个时间桶的Unix秒 first_ts 按偏移推算。
+    """
+    first_bucket = bounds[0]["first_bucket"] if bounds else None
+    range_end = bounds[0]["range_end"] if bounds else None
+    dense = densify_series(data, first_bucket, range_end, slot_sec, fill)
+    if first_bucket is not None:
+        first_ts = int(bounds[0]["first_ts"])
+        for row in dense:
+            if row.get("ts") is None:
+                row["ts"] = first_ts + int((row["bucket"] - first_bucket).total_seconds())
+    return dense
+
+
+def format_series_rows(data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """行格式：每个时间桶一个对象，去掉内部使用的 ts 字段（就地修改）"""
+    for row in data:
+        row.pop("ts", None)
+    return data
+
+
+def format_series_columns(data: List[Dict[str, Any]]) -> Dict[str, list]:
+    """列格式：每个字段一个数组，bucket 为时间桶的Unix秒"""
+    columns = {"bucket": [int(row["ts"]) for row in data]}
+    for field in SERIES_METRIC_FIELDS:
+        columns[field] = [row[field] for row in data]
+    return columns
+
+
+async def query_series(queries: Dict[str, Optional[str]], params: Dict[str, Any],
+                       fill: str = "zero", segment_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+    """并发执行时序查询的封闭部分、logs尾部与去重草图查询，合并后按 fill 补齐空时间桶
+
+    返回的行带有 ts（时间桶的Unix秒），由 format_series_rows / format_series_columns 转为响应格式。
+
+    params 需包含 split_series_range 计算的 agg_end。指定 segment_prefix 时封闭部分按分段缓存
+    （天级粒度的时间桶按数据库时区的自然日对齐，与UTC分段不对齐，不使用分段缓存）。
+    """
+    if segment_prefix is not None and get_series_tier(params["slot_sec"]) != "daily":
+        return await query_series_segmented(queries, params, segment_prefix, fill)
+
+    has_tail = params["agg_end"] * 1000 < params["end_ms"]
+    rows, tail_rows, overrides, boundary = await asyncio.gather(
+        execute_query(queries["agg"], params),
+        execute_query(queries["tail"], params) if has_tail else _empty(),
+        get_series_unique_overrides(params),
+        get_series_boundary_sketches(queries["boundary"], params),
+    )
+
+    # 每行都带有范围边界，没有数据时只有一行 bucket 为NULL的边界行
+    data = _series_rows(rows)
+    if overrides:
+        apply_series_unique_overrides(data, overrides)
+    merge_series_tail(data, [row for row in tail_rows if row["bucket"] is not None], boundary)
+
+    logger.debug("时序混合查询完成", agg_end=params["agg_end"], agg_rows=len(data), tail_rows=len(tail_rows))
+    return _finish_series(data, rows, params["slot_sec"], fill)
+
+
+async def stream_series(queries: Dict[str, Optional[str]], start_ms: int, end_ms: int, slot_sec: int,
+                        aggregated_until: Optional[int], window_buckets: int,
+                        fill: str = "zero") -> AsyncIterator[List[Dict[str, Any]]]:
+    """按时间窗口分批查询时序数据，每批最多 window_buckets 个时间桶（用于导出）
+
+    窗口边界按时间粒度对齐，时间桶不会跨越窗口；每个窗口各自在聚合水位处切分并合并logs尾部，
+    内存占用只取决于窗口大小，与导出的时间范围无关。
+    """
+    window_ms = window_buckets * slot_sec * 1000
+    window_start = start_ms
+    while window_start < end_ms:
+        window_end = min(window_start // (slot_sec * 1000) * slot_sec * 1000 + window_ms, end_ms)
+        params = {
+            "start_ms": window_start,
+            "end_ms": window_end,
+            "slot_sec": slot_sec,
+            **split_series_range(window_start, window_end, aggregated_until)
+        }
+        yield await query_series(queries, params, fill)
+        window_start = window_end
+
+
+def _jsonable(row: Dict[str, Any]) -> Dict[str, Any]:
+    """将查询结果行转换为可JSON序列化的形式（Decimal转数值，时间转ISO字符串）"""
+    result = {}
+    for key, value in row.items():
+        if isinstance(value, Decimal):
+            value = int(value) if value == value.to_integral_value() else float(value)
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        result[key] = value
+    return result
+
+
+def split_segments(start: int, end: int) -> List[Tuple[int, int]]:
+    """将 [start, end)（Unix秒）按 SEGMENT_SECONDS 对齐切分为分段，首尾分段可能不完整"""
+    segments = []
+    seg_start = start
+    while seg_start < end:
+        seg_end = min((seg_start // SEGMENT_SECONDS + 1) * SEGMENT_SECONDS, end)
+        segments.append((seg_start, seg_end))
+        seg_start = seg_end
+    return segments
+
+
+def segment_key(prefix: str, seg_start: int, seg_end: int) -> str:
+    """分段缓存键：完整分段由起点确定，不完整分段（含聚合水位或请求起点）带上终点"""
+    if seg_start % SEGMENT_SECONDS == 0 and seg_end - seg_start == SEGMENT_SECONDS:
+        return f"{prefix}:{seg_start}"
+    return f"{prefix}:{seg_start}:{seg_end}"
+
+
+async def load_segments(prefix: str, segments: List[Tuple[int, int]],
+                        fetch: Callable[[int, int], Awaitable[List[Dict[str, Any]]]]) -> List[List[Dict[str, Any]]]:
+    """读取各分段的结果行，未命中的分段以有限并发调用 fetch(seg_start, seg_end) 查询并写回缓存"""
+    keys = [segment_key(prefix, seg_start, seg_end) for seg_start, seg_end in segments]
+    cached = await get_cached_segments(keys)
+    missing = [i for i, value in enumerate(cached) if value is None]
+
+    if missing:
+        semaphore = asyncio.Semaphore(SEGMENT_FETCH_CONCURRENCY)
+
+        async def fetch_segment(i: int) -> List[Dict[str, Any]]:
+            async with semaphore:
+                return [_jsonable(row) for row in await fetch(*segments[i])]
+
+        results = await asyncio.gather(*(fetch_segment(i) for i in missing))
+        for i, rows in zip(missing, results):
+            cached[i] = rows
+        await set_cached_segments({keys[i]: cached[i] for i in missing})
+
+    logger.debug("分段缓存读取完成", prefix=prefix, segments=len(segments), missing=len(missing))
+    return cached
+
+
+async def query_series_segmented(queries: Dict[str, Optional[str]], params: Dict[str, Any],
+                                 prefix: str, fill: str = "zero") -> List[Dict[str, Any]]:
+    """由缓存分段拼接时序数据的封闭部分，并发查询logs尾部
+
+    分段按整天读取，首个分段按请求的首个时间桶截取，整段可在滑动窗口的多次刷新间复用。
+    """
+    slot_sec = params["slot_sec"]
+    first_ts = params["start_ms"] // 1000 // slot_sec * slot_sec
+    segments = split_segments(first_ts // SEGMENT_SECONDS * SEGMENT_SECONDS, params["agg_end"])
+
+    async def fetch(seg_start: int, seg_end: int) -> List[Dict[str, Any]]:
+        seg_params = {**params, "start_ms": seg_start * 1000, "end_ms": seg_end * 1000, "agg_end": seg_end}
+        rows, overrides = await asyncio.gather(
+            execute_query(queries["agg"], seg_params),
+            get_series_unique_overrides(seg_params),
+        )
+        data = _series_rows(rows)
+        if overrides:
+            apply_series_unique_overrides(data, overrides)
+        return data
+
+    # 尾部查询总会执行，其结果附带补齐空桶所需的范围边界
+    cached, tail_rows = await asyncio.gather(
+        load_segments(prefix, segments, fetch),
+        execute_query(queries["tail"], params),
+    )
+
+    data = [
+        {**row, "bucket": datetime.fromisoformat(row["bucket"])}
+        for rows in cached for row in rows if row["ts"] >= first_ts
+    ]
+    merge_series_tail(data, [row for row in tail_rows if row["bucket"] is not None], {})
+    return _finish_series(data, tail_rows, slot_sec, fill)
+
+
+def merge_top_rows(parts: List[List[Dict[str, Any]]], field: str, metric: str, limit: int) -> List[Dict[str, Any]]:
+    """按维度字段合并各部分的TopN分组结果，按指标降序截取前 limit 项
+
+    缓存分段中的SUM结果已由Decimal转为整数或浮点数，其余部分同样转换后再相加（Decimal与float不能直接相加）。
+    """
+    merged: Dict[Any, Dict[str, Any]] = {}
+    for rows in parts:
+        for row in rows:
+            row = _jsonable(row)
+            item = merged.get(row[field])
+            if item is None:
+                merged[row[field]] = row
+                continue
+            for column in ("reqs", "tokens", "quota_sum"):
+                item[column] += row[column]
+
+    return sorted(merged.values(), key=lambda item: item[metric], reverse=True)[:limit]
+
+
+def is_top_agg_sufficient(agg_rows: List[Dict[str, Any]], tail_rows: List[Dict[str, Any]],
+                          field: str, metric: str, limit: int, agg_limit: int) -> bool:
+    """截取的封闭部分（按指标降序的前 agg_limit 项）与logs部分合并后，前 limit 项是否准确
+
+    未截取到的分组在封闭部分的指标不超过截取的最后一项，加上其在logs部分的指标仍不超过
+    截取到的分组中第 limit 大的合计时，前 limit 项只会来自截取到的分组。
+    """
+    if len(agg_rows) < agg_limit:
+        return True
+
+    listed = {row[field] for row in agg_rows}
+    merged = merge_top_rows([agg_rows, tail_rows], field, metric, len(agg_rows) + len(tail_rows))
+    totals = [item[metric] for item in merged if item[field] in listed]
+    cutoff = _jsonable(agg_rows[-1])[metric]
+    tail_max = max((_jsonable(row)[metric] for row in tail_rows if row[field] not in listed), default=0)
+    return cutoff + tail_max <= totals[limit - 1]
+
+
+async def query_top(queries: Dict[str, str], params: Dict[str, Any],
+                    field: str, metric: str, limit: int,
+                    segment_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+    """并发执行TopN查询的聚合表部分与logs部分，合并后排序截取
+
+    params 需包含 split_top_range 计算的 agg_start / agg_end。指定 segment_prefix 时
+    聚合表部分按分段缓存，每个分段保存该段内全部分组的合计（不能按前N项截取）；
+    否则只取前 limit + TOP_AGG_LIMIT_MARGIN 项，不足以确定结果时再读取全部分组。
+    """
+    has_agg = params["agg_end"] > params["agg_start"]
+    has_tail = (params["start_ms"] < params["agg_start"] * 1000
+                or params["agg_end"] * 1000 < params["end_ms"])
+    agg_limit = limit + TOP_AGG_LIMIT_MARGIN
+
+    if segment_prefix is not None:
+        async def fetch(seg_start: int, seg_end: int) -> List[Dict[str, Any]]:
+            return list(await execute_query(queries["agg"], {**params, "agg_start": seg_start, "agg_end": seg_end}))
+
+        agg_parts = load_segments(segment_prefix, split_segments(params["agg_start"], params["agg_end"]), fetch)
+    elif has_agg:
+        agg_parts = _single_part(execute_query(queries["agg_top"], {**params, "agg_limit": agg_limit}))
+    else:
+        agg_parts = _empty()
+
+    agg_rows, tail_rows = await asyncio.gather(
+        agg_parts,
+        execute_query(queries["tail"], params) if has_tail else _empty(),
+    )
+
+    if (segment_prefix is None and has_agg
+            and not is_top_agg_sufficient(agg_rows[0], tail_rows, field, metric, limit, agg_limit)):
+        # logs部分的分组可能超过截取的下限，退回为读取全部分组
+        logger.info("TopN封闭部分截取不足，读取全部分组", field=field, metric=metric, limit=limit)
+        agg_rows = await _single_part(execute_query(queries["agg"], params))
+
+    logger.debug("TopN混合查询完成", agg_parts=len(agg_rows), tail_rows=len(tail_rows))
+    return merge_top_rows(agg_rows + [list(tail_rows)], field, metric, limit)
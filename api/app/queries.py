@@ -1,158 +1,455 @@
 """SQL查询模板模块"""
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
-# 时序数据查询 - 优先使用聚合表，支持不同时间粒度
-SERIES_QUERY = """
-WITH RECURSIVE time_series AS (
-    -- 生成时间序列
+from .config import settings
+
+# 时序数据查询（封闭部分） - 按时间粒度选择能满足要求的最粗聚合层级，只读取聚合水位 agg_end 之前的数据，
+# 水位之后的开放尾部由 SERIES_TAIL_QUERY 读logs。
+# 只返回有数据的时间桶，空桶由API补齐（planner.densify_series）；每行附带数据库时区下的
+# 首个时间桶 first_bucket（first_ts 为其Unix秒）与范围结束时间 range_end，没有数据时返回一行 bucket 为NULL的边界行；
+# ts 为时间桶的Unix秒，用于分段缓存按UTC自然日切分与列格式响应
+SERIES_QUERIES = {
+    # 分钟级聚合表：支持1分钟到30分钟粒度
+    'minute': """
+WITH bounds AS (
+    SELECT
+        FROM_UNIXTIME(FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s) AS first_bucket,
+        FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s AS first_ts,
+        FROM_UNIXTIME(%(end_ms)s / 1000) AS range_end
+),
+tier_data AS (
     SELECT
-        FROM_UNIXTIME(FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s) AS bucket
-    UNION ALL
+        FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(minute_bucket) / %(slot_sec)s) * %(slot_sec)s) AS bucket,
+        FLOOR(UNIX_TIMESTAMP(minute_bucket) / %(slot_sec)s) * %(slot_sec)s AS ts,
+        SUM(request_count) AS reqs,
+        SUM(total_tokens) AS tokens,
+        SUM(unique_users) AS users,
+        SUM(unique_tokens) AS tokens_cnt
+    FROM agg_usage_minute
+    WHERE minute_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
+      AND minute_bucket < FROM_UNIXTIME(%(agg_end)s)
+    GROUP BY bucket, ts
+)
+SELECT
+    b.first_bucket,
+    b.first_ts,
+    b.range_end,
+    td.bucket,
+    td.ts,
+    td.reqs,
+    td.tokens,
+    td.users,
+    td.tokens_cnt
+FROM bounds b
+LEFT JOIN tier_data td ON TRUE
+ORDER BY td.bucket;
+""",
+
+    # 小时级聚合表：1小时粒度
+    'hourly': """
+WITH bounds AS (
     SELECT
-        DATE_ADD(bucket, INTERVAL %(slot_sec)s SECOND)
-    FROM time_series
-    WHERE bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
+        FROM_UNIXTIME(FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s) AS first_bucket,
+        FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s AS first_ts,
+        FROM_UNIXTIME(%(end_ms)s / 1000) AS range_end
 ),
--- 优先从聚合表获取小时级数据
-hourly_agg_data AS (
+tier_data AS (
     SELECT
         hour_bucket AS bucket,
+        UNIX_TIMESTAMP(hour_bucket) AS ts,
         SUM(request_count) AS reqs,
         SUM(total_tokens) AS tokens,
         SUM(unique_users) AS users,
         SUM(unique_tokens) AS tokens_cnt
     FROM agg_usage_hourly
-    WHERE hour_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
-      AND hour_bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
+    WHERE {dim_filter}
+      AND hour_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
+      AND hour_bucket < FROM_UNIXTIME(%(agg_end)s)
     GROUP BY hour_bucket
+)
+SELECT
+    b.first_bucket,
+    b.first_ts,
+    b.range_end,
+    td.bucket,
+    td.ts,
+    td.reqs,
+    td.tokens,
+    td.users,
+    td.tokens_cnt
+FROM bounds b
+LEFT JOIN tier_data td ON TRUE
+ORDER BY td.bucket;
+""",
+
+    # 天级聚合表：1天粒度，按数据库时区的自然日对齐
+    'daily': """
+WITH bounds AS (
+    SELECT
+        TIMESTAMP(DATE(FROM_UNIXTIME(%(start_ms)s / 1000))) AS first_bucket,
+        UNIX_TIMESTAMP(TIMESTAMP(DATE(FROM_UNIXTIME(%(start_ms)s / 1000)))) AS first_ts,
+        FROM_UNIXTIME(%(end_ms)s / 1000) AS range_end
 ),
--- 如果需要更细粒度或聚合表没有数据，从logs表实时聚合
-realtime_agg_data AS (
+tier_data AS (
     SELECT
-        FROM_UNIXTIME(FLOOR(created_at / %(slot_sec)s) * %(slot_sec)s) AS bucket,
-        COUNT(*) AS reqs,
-        COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS tokens,
-        COUNT(DISTINCT user_id) AS users,
-        COUNT(DISTINCT token_id) AS tokens_cnt
-    FROM logs
-    WHERE created_at >= %(start_ms)s / 1000
-      AND created_at < %(end_ms)s / 1000
-      AND (%(slot_sec)s < 3600 OR NOT EXISTS (SELECT 1 FROM agg_usage_hourly LIMIT 1))
+        bucket,
+        SUM(reqs) AS reqs,
+        SUM(tokens) AS tokens,
+        SUM(users) AS users,
+        SUM(tokens_cnt) AS tokens_cnt
+    FROM (
+        SELECT
+            day_bucket AS bucket,
+            request_count AS reqs,
+            total_tokens AS tokens,
+            unique_users AS users,
+            unique_tokens AS tokens_cnt
+        FROM agg_usage_daily
+        WHERE {dim_filter}
+          AND day_bucket >= TIMESTAMP(DATE(FROM_UNIXTIME(%(start_ms)s / 1000)))
+          AND day_bucket < TIMESTAMP(DATE(FROM_UNIXTIME(%(agg_end)s)))
+        UNION ALL
+        -- 聚合水位所在的自然日：天级行含未定稿小时的增量数据，改读水位之前的小时级行
+        SELECT
+            TIMESTAMP(DATE(hour_bucket)) AS bucket,
+            request_count AS reqs,
+            total_tokens AS tokens,
+            unique_users AS users,
+            unique_tokens AS tokens_cnt
+        FROM agg_usage_hourly
+        WHERE {dim_filter}
+          AND hour_bucket >= TIMESTAMP(DATE(FROM_UNIXTIME(%(agg_end)s)))
+          AND hour_bucket < FROM_UNIXTIME(%(agg_end)s)
+    ) AS parts
     GROUP BY bucket
+)
+SELECT
+    b.first_bucket,
+    b.first_ts,
+    b.range_end,
+    td.bucket,
+    UNIX_TIMESTAMP(td.bucket) AS ts,
+    td.reqs,
+    td.tokens,
+    td.users,
+    td.tokens_cnt
+FROM bounds b
+LEFT JOIN tier_data td ON TRUE
+ORDER BY td.bucket;
+""",
+}
+
+# 基础维度对应的聚合表字段，过滤参数名即字段名
+DIMENSION_FIELDS = {
+    'user': 'user_id',
+    'model': 'model_name',
+    'channel': 'channel_id',
+    'token': 'token_id',
+}
+
+
+def parse_cubes(spec: str) -> Dict[str, Tuple[str, ...]]:
+    """解析交叉维度配置，与Worker的 AGG_CUBES 格式一致（如 "user:model,channel:model"）"""
+    cubes = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        dims = [dim.strip() for dim in item.split(":")]
+        if any(dim not in DIMENSION_FIELDS for dim in dims):
+            raise ValueError(f"未知的交叉维度配置: {item}")
+        cubes["_".join(dims)] = tuple(DIMENSION_FIELDS[dim] for dim in dims)
+    return cubes
+
+
+# 聚合表中已物化的交叉维度：维度名 -> 字段
+AGG_CUBES = parse_cubes(settings.agg_cubes)
+
+
+def resolve_dimension(fields) -> str:
+    """按查询涉及的维度字段选择聚合表中的 dim
+
+    没有字段时为全局维度，单个字段为对应的基础维度，多个字段需要字段集合完全一致的交叉维度。
+    """
+    fields = frozenset(fields)
+    if not fields:
+        return 'global'
+    if len(fields) == 1:
+        field = next(iter(fields))
+        for dim, dim_field in DIMENSION_FIELDS.items():
+            if dim_field == field:
+                return dim
+    for dim, cube_fields in AGG_CUBES.items():
+        if frozenset(cube_fields) == fields:
+            return dim
+    raise ValueError(f"未配置 {'+'.join(sorted(fields))} 的交叉维度聚合（AGG_CUBES）")
+
+
+def build_dim_filter(dim: str, filters: Tuple[str, ...] = (), alias: str = '') -> str:
+    """生成聚合表的维度条件，过滤值以同名参数传入"""
+    prefix = f"{alias}." if alias else ''
+    conditions = [f"{prefix}dim = '{dim}'"]
+    conditions.extend(f"{prefix}{field} = %({field})s" for field in filters)
+    return "\n      AND ".join(conditions)
+
+
+# 支持的时间粒度（秒）
+SERIES_SLOT_SECONDS = [60, 300, 900, 1800, 3600, 86400]
+
+# 分钟级去重草图 - 时间粒度粗于1分钟时，同一时间桶内的分钟去重数不可相加，
+# 由各分钟的HLL草图取并集修正 users / tokens_cnt
+SERIES_SKETCH_QUERY = """
+SELECT
+    FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(minute_bucket) / %(slot_sec)s) * %(slot_sec)s) AS bucket,
+    users_sketch,
+    tokens_sketch
+FROM agg_usage_minute
+WHERE minute_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
+  AND minute_bucket < FROM_UNIXTIME(%(agg_end)s)
+"""
+
+# 时序数据开放尾部 - 聚合水位之后的logs按时间桶、用户、Token分组，
+# 用户与Token去重数在Python中由ID集合（或与水位所在时间桶的草图取并集）计算。
+# 与封闭部分一样附带范围边界，分段缓存命中时由尾部查询提供补齐空桶所需的边界
+SERIES_TAIL_QUERY = """
+WITH bounds AS (
+    SELECT
+        {first_bucket} AS first_bucket,
+        UNIX_TIMESTAMP({first_bucket}) AS first_ts,
+        FROM_UNIXTIME(%(end_ms)s / 1000) AS range_end
 ),
--- 合并聚合表和实时数据
-combined_data AS (
-    SELECT bucket, reqs, tokens, users, tokens_cnt FROM hourly_agg_data
-    WHERE %(slot_sec)s >= 3600
-    UNION ALL
-    SELECT bucket, reqs, tokens, users, tokens_cnt FROM realtime_agg_data
+tail_data AS (
+    SELECT
+        {bucket_expr} AS bucket,
+        l.user_id,
+        l.token_id,
+        COUNT(*) AS reqs,
+        COALESCE(SUM(l.prompt_tokens + l.completion_tokens), 0) AS tokens
+    FROM logs l
+    WHERE l.created_at >= %(agg_end)s
+      AND l.created_at < %(end_ms)s / 1000{tail_filter}
+    GROUP BY bucket, l.user_id, l.token_id
 )
 SELECT
-    ts.bucket,
-    COALESCE(cd.reqs, 0) AS reqs,
-    COALESCE(cd.tokens, 0) AS tokens,
-    COALESCE(cd.users, 0) AS users,
-    COALESCE(cd.tokens_cnt, 0) AS tokens_cnt
-FROM time_series ts
-LEFT JOIN combined_data cd ON ts.bucket = cd.bucket
-ORDER BY ts.bucket;
+    b.first_bucket,
+    b.first_ts,
+    b.range_end,
+    td.bucket,
+    td.user_id,
+    td.token_id,
+    td.reqs,
+    td.tokens
+FROM bounds b
+LEFT JOIN tail_data td ON TRUE
 """
 
-# TopN查询模板 - 优先使用聚合表，支持按不同维度和指标排序
-TOP_QUERY_TEMPLATES = {
-    'user': """
-        WITH agg_data AS (
+# 各聚合层级的首个时间桶（数据库时区）
+SERIES_FIRST_BUCKETS = {
+    'minute': 'FROM_UNIXTIME(FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s)',
+    'hourly': 'FROM_UNIXTIME(FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s)',
+    'daily': 'TIMESTAMP(DATE(FROM_UNIXTIME(%(start_ms)s / 1000)))',
+}
+
+# 各聚合层级的时间桶在logs上的等价表达式
+SERIES_TAIL_BUCKETS = {
+    'minute': 'FROM_UNIXTIME(FLOOR(l.created_at / %(slot_sec)s) * %(slot_sec)s)',
+    'hourly': 'FROM_UNIXTIME(FLOOR(l.created_at / %(slot_sec)s) * %(slot_sec)s)',
+    'daily': 'TIMESTAMP(DATE(FROM_UNIXTIME(l.created_at)))',
+}
+
+# 天级时序中聚合水位所在自然日的小时草图 - 该日的封闭部分由小时级行累加，
+# 去重数需由小时草图与尾部ID取并集修正（分钟级与小时级时间桶按小时对齐，不跨越水位）
+SERIES_BOUNDARY_SKETCH_QUERY = """
+SELECT
+    TIMESTAMP(DATE(FROM_UNIXTIME(%(agg_end)s))) AS bucket,
+    users_sketch,
+    tokens_sketch
+FROM agg_usage_hourly
+WHERE {dim_filter}
+  AND hour_bucket >= TIMESTAMP(DATE(FROM_UNIXTIME(%(agg_end)s)))
+  AND hour_bucket < FROM_UNIXTIME(%(agg_end)s)
+"""
+
+# 任意时间范围的全局去重草图 - 整天部分取天级草图，首尾不足一天的部分取小时级草图
+UNIQUES_QUERY = """
+WITH bounds AS (
+    SELECT
+        FROM_UNIXTIME(%(start_ms)s / 1000) AS range_start,
+        FROM_UNIXTIME(%(end_ms)s / 1000) AS range_end,
+        TIMESTAMP(DATE(FROM_UNIXTIME(%(start_ms)s / 1000) - INTERVAL 1 SECOND)) + INTERVAL 1 DAY AS full_start,
+        TIMESTAMP(DATE(FROM_UNIXTIME(%(end_ms)s / 1000))) AS full_end
+)
+SELECT
+    d.unique_users,
+    d.unique_tokens,
+    d.users_sketch,
+    d.tokens_sketch
+FROM agg_usage_daily d, bounds b
+WHERE d.dim = 'global'
+  AND d.day_bucket >= b.full_start
+  AND d.day_bucket < b.full_end
+UNION ALL
+SELECT
+    h.unique_users,
+    h.unique_tokens,
+    h.users_sketch,
+    h.tokens_sketch
+FROM agg_usage_hourly h, bounds b
+WHERE h.dim = 'global'
+  AND h.hour_bucket >= b.range_start
+  AND h.hour_bucket < b.range_end
+  AND (h.hour_bucket < b.full_start OR h.hour_bucket >= b.full_end)
+"""
+
+# 单请求Token数分位数草图 - 只有全局与模型维度写入草图，按时间桶流式读取后合并
+QUANTILE_QUERIES = {
+    'hourly': """
+SELECT
+    hour_bucket AS bucket,
+    tokens_qsketch
+FROM agg_usage_hourly
+WHERE {dim_filter}
+  AND hour_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
+  AND hour_bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
+  AND tokens_qsketch IS NOT NULL
+ORDER BY hour_bucket
+""",
+
+    'daily': """
+SELECT
+    day_bucket AS bucket,
+    tokens_qsketch
+FROM agg_usage_daily
+WHERE {dim_filter}
+  AND day_bucket >= TIMESTAMP(DATE(FROM_UNIXTIME(%(start_ms)s / 1000)))
+  AND day_bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
+  AND tokens_qsketch IS NOT NULL
+ORDER BY day_bucket
+""",
+}
+
+# 分位数支持的时间粒度（秒），对应小时级与天级聚合表
+QUANTILE_SLOT_SECONDS = [3600, 86400]
+
+# TopN维度定义：聚合表维度字段、logs中对应的表达式（NULL按聚合表哨兵值归并）、名称关联
+TOP_DIMENSIONS = {
+    'user': {
+        'field': 'user_id',
+        'log_expr': 'COALESCE(l.user_id, 0)',
+        'name_select': 'u.username',
+        'name_join': 'LEFT JOIN users u ON cd.user_id = u.id',
+    },
+    'token': {
+        'field': 'token_id',
+        'log_expr': 'COALESCE(l.token_id, 0)',
+        'name_select': 't.name AS token_name',
+        'name_join': 'LEFT JOIN tokens t ON cd.token_id = t.id',
+    },
+    'model': {
+        'field': 'model_name',
+        'log_expr': "COALESCE(l.model_name, '')",
+        'name_select': None,
+        'name_join': '',
+    },
+    'channel': {
+        'field': 'channel_id',
+        'log_expr': 'COALESCE(l.channel_id, 0)',
+        'name_select': 'c.name AS channel_name',
+        'name_join': 'LEFT JOIN channels c ON cd.channel_id = c.id',
+    },
+}
+
+
+def _build_top_templates(dim: str, field: str, log_expr: str, name_select, name_join: str,
+                         filters: Tuple[str, ...] = ()) -> Dict[str, str]:
+    """生成TopN查询模板，返回 {"agg": 封闭部分, "tail": logs部分}
+
+    [agg_start, agg_end) 为已定稿的整小时范围（由 split_top_range 计算）：
+    其中的整天读天级聚合表，其余小时读小时级聚合表；
+    首尾不足一小时的部分与尚未定稿的尾部读logs。两部分各自按维度分组，
+    由调用方并发执行后合并、排序并截取前N项（封闭部分不能单独截取）。
+    filters 为过滤字段（如按 user_id 过滤的模型排行读 user_model 交叉维度）。
+    """
+    select_name = f"{name_select},\n            " if name_select else ""
+    agg_filter = "".join(f"\n                  AND {{alias}}.{f} = %({f})s" for f in filters)
+    tail_filter = "".join(f"\n              AND l.{f} = %({f})s" for f in filters)
+    agg = f"""
+        WITH bounds AS (
+            SELECT
+                FROM_UNIXTIME(%(agg_start)s) AS agg_start,
+                FROM_UNIXTIME(%(agg_end)s) AS agg_end,
+                TIMESTAMP(DATE(FROM_UNIXTIME(%(agg_start)s) - INTERVAL 1 SECOND)) + INTERVAL 1 DAY AS full_start,
+                TIMESTAMP(DATE(FROM_UNIXTIME(%(agg_end)s))) AS full_end
+        )
+        SELECT
+            cd.{field},
+            {select_name}cd.reqs,
+            cd.tokens,
+            cd.quota_sum
+        FROM (
             SELECT
-                user_id,
-                {metric_expr_agg} AS {metric},
-                SUM(request_count) AS reqs,
-                SUM(total_tokens) AS tokens,
+                {field},
+                SUM(reqs) AS reqs,
+                SUM(tokens) AS tokens,
                 SUM(quota_sum) AS quota_sum
-            FROM agg_usage_hourly
-            WHERE hour_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
-              AND hour_bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
-            GROUP BY user_id
-        ),
-        realtime_data AS (
+            FROM (
+                SELECT
+                    d.{field},
+                    d.request_count AS reqs,
+                    d.total_tokens AS tokens,
+                    d.quota_sum
+                FROM agg_usage_daily d, bounds b
+                WHERE d.dim = '{dim}'
+                  AND d.day_bucket >= b.full_start
+                  AND d.day_bucket < b.full_end{agg_filter.format(alias='d')}
+                UNION ALL
+                SELECT
+                    h.{field},
+                    h.request_count AS reqs,
+                    h.total_tokens AS tokens,
+                    h.quota_sum
+                FROM agg_usage_hourly h, bounds b
+                WHERE h.dim = '{dim}'
+                  AND h.hour_bucket >= b.agg_start
+                  AND h.hour_bucket < b.agg_end
+                  AND (h.hour_bucket < b.full_start OR h.hour_bucket >= b.full_end){agg_filter.format(alias='h')}
+            ) AS parts
+            GROUP BY {field}
+        ) AS cd
+        {name_join}
+    """
+    tail = f"""
+        SELECT
+            cd.{field},
+            {select_name}cd.reqs,
+            cd.tokens,
+            cd.quota_sum
+        FROM (
             SELECT
-                l.user_id,
-                {metric_expr} AS {metric},
+                {log_expr} AS {field},
                 COUNT(*) AS reqs,
                 COALESCE(SUM(l.prompt_tokens + l.completion_tokens), 0) AS tokens,
                 COALESCE(SUM(l.quota), 0) AS quota_sum
             FROM logs l
-            WHERE l.created_at >= %(start_ms)s / 1000
-              AND l.created_at < %(end_ms)s / 1000
-              AND NOT EXISTS (SELECT 1 FROM agg_usage_hourly LIMIT 1)
-            GROUP BY l.user_id
-        ),
-        combined_data AS (
-            SELECT user_id, {metric}, reqs, tokens, quota_sum FROM agg_data
-            UNION ALL
-            SELECT user_id, {metric}, reqs, tokens, quota_sum FROM realtime_data
-        )
-        SELECT
-            cd.user_id,
-            u.username,
-            cd.{metric},
-            cd.reqs,
-            cd.tokens,
-            cd.quota_sum
-        FROM combined_data cd
-        LEFT JOIN users u ON cd.user_id = u.id
-        ORDER BY cd.{metric} DESC
-        LIMIT %(limit)s
-    """,
-    
-    'token': """
-        SELECT 
-            l.token_id,
-            t.name AS token_name,
-            {metric_expr} AS {metric},
-            COUNT(*) AS reqs,
-            COALESCE(SUM(l.prompt_tokens + l.completion_tokens), 0) AS tokens,
-            COALESCE(SUM(l.quota), 0) AS quota_sum
-        FROM logs l
-        LEFT JOIN tokens t ON l.token_id = t.id
-        WHERE l.created_at >= %(start_ms)s / 1000
-          AND l.created_at < %(end_ms)s / 1000
-        GROUP BY l.token_id, t.name
-        ORDER BY {metric} DESC
-        LIMIT %(limit)s
-    """,
-    
-    'model': """
-        SELECT 
-            l.model_name,
-            {metric_expr} AS {metric},
-            COUNT(*) AS reqs,
-            COALESCE(SUM(l.prompt_tokens + l.completion_tokens), 0) AS tokens,
-            COALESCE(SUM(l.quota), 0) AS quota_sum
-        FROM logs l
-        WHERE l.created_at >= %(start_ms)s / 1000
-          AND l.created_at < %(end_ms)s / 1000
-        GROUP BY l.model_name
-        ORDER BY {metric} DESC
-        LIMIT %(limit)s
-    """,
-    
-    'channel': """
-        SELECT 
-            l.channel_id,
-            c.name AS channel_name,
-            {metric_expr} AS {metric},
-            COUNT(*) AS reqs,
-            COALESCE(SUM(l.prompt_tokens + l.completion_tokens), 0) AS tokens,
-            COALESCE(SUM(l.quota), 0) AS quota_sum
-        FROM logs l
-        LEFT JOIN channels c ON l.channel_id = c.id
-        WHERE l.created_at >= %(start_ms)s / 1000
-          AND l.created_at < %(end_ms)s / 1000
-        GROUP BY l.channel_id, c.name
-        ORDER BY {metric} DESC
-        LIMIT %(limit)s
+            WHERE ((l.created_at >= %(start_ms)s / 1000 AND l.created_at < %(agg_start)s)
+               OR (l.created_at >= %(agg_end)s AND l.created_at < %(end_ms)s / 1000)){tail_filter}
+            GROUP BY {log_expr}
+        ) AS cd
+        {name_join}
     """
+    return {"agg": agg, "tail": tail}
+
+
+# TopN查询模板 - 已定稿的小时读聚合表，仅未定稿的尾部读logs
+TOP_QUERY_TEMPLATES = {
+    by: _build_top_templates(by, **dimension) for by, dimension in TOP_DIMENSIONS.items()
 }
 
+
+@lru_cache(maxsize=64)
+def _filtered_top_template(by: str, filters: Tuple[str, ...]) -> Dict[str, str]:
+    """带过滤条件的TopN查询模板，读取排行维度与过滤维度组成的交叉维度"""
+    dim = resolve_dimension((TOP_DIMENSIONS[by]['field'],) + filters)
+    return _build_top_templates(dim, **TOP_DIMENSIONS[by], filters=filters)
+
 # 指标表达式映射
 METRIC_EXPRESSIONS = {
     'tokens': 'COALESCE(SUM(l.prompt_tokens + l.completion_tokens), 0)',
@@ -160,13 +457,6 @@ METRIC_EXPRESSIONS = {
     'quota_sum': 'COALESCE(SUM(l.quota), 0)'
 }
 
-# 聚合表指标表达式映射
-METRIC_EXPRESSIONS_AGG = {
-    'tokens': 'SUM(total_tokens)',
-    'reqs': 'SUM(request_count)',
-    'quota_sum': 'SUM(quota_sum)'
-}
-
 # 异常检测查询模板
 ANOMALY_QUERIES = {
     # 突发频率检测
@@ -273,19 +563,112 @@ ANOMALY_QUERIES = {
     """
 }
 
-def get_top_query(by: str, metric: str) -> str:
-    """获取TopN查询SQL"""
+def get_series_tier(slot_sec: int) -> str:
+    """选择能满足时间粒度的最粗聚合层级"""
+    if slot_sec % 86400 == 0:
+        return 'daily'
+    if slot_sec % 3600 == 0:
+        return 'hourly'
+    return 'minute'
+
+
+def _validate_filters(filters: Optional[Dict[str, object]]) -> Tuple[str, ...]:
+    """校验过滤参数，返回排序后的过滤字段"""
+    fields = tuple(sorted(filters or {}))
+    unknown = [field for field in fields if field not in DIMENSION_FIELDS.values()]
+    if unknown:
+        raise ValueError(f"不支持的过滤字段: {', '.join(unknown)}")
+    return fields
+
+
+def get_series_query(slot_sec: int, filters: Optional[Dict[str, object]] = None) -> Dict[str, Optional[str]]:
+    """获取时序查询SQL，返回 {"agg": 封闭部分, "tail": logs尾部, "boundary": 水位所在天的小时草图或None}
+
+    filters 为维度过滤条件（字段 -> 值），按过滤字段选择小时级/天级聚合表中的对应维度；
+    分钟级聚合表只有全局维度，带过滤条件时时间粒度至少为1小时。
+    """
+    if slot_sec not in SERIES_SLOT_SECONDS:
+        raise ValueError(f"不支持的时间粒度: {slot_sec}")
+
+    fields = _validate_filters(filters)
+    tier = get_series_tier(slot_sec)
+    if tier == 'minute' and fields:
+        raise ValueError("按维度过滤的时序查询仅支持1小时及以上的时间粒度")
+
+    tail_filter = "".join(f"\n      AND l.{field} = %({field})s" for field in fields)
+    tail = SERIES_TAIL_QUERY.format(first_bucket=SERIES_FIRST_BUCKETS[tier],
+                                    bucket_expr=SERIES_TAIL_BUCKETS[tier], tail_filter=tail_filter)
+    if tier == 'minute':
+        return {"agg": SERIES_QUERIES[tier], "tail": tail, "boundary": None}
+
+    dim_filter = build_dim_filter(resolve_dimension(fields), fields)
+    boundary = SERIES_BOUNDARY_SKETCH_QUERY.format(dim_filter=dim_filter) if tier == 'daily' else None
+    return {"agg": SERIES_QUERIES[tier].format(dim_filter=dim_filter), "tail": tail, "boundary": boundary}
+
+
+def get_top_query(by: str, metric: str, filters: Optional[Dict[str, object]] = None) -> Dict[str, str]:
+    """获取TopN查询SQL，filters 为维度过滤条件（字段 -> 值）
+
+    返回 {"agg": 封闭部分（全部分组，用于分段缓存）, "agg_top": 封闭部分按指标截取前 %(agg_limit)s 项,
+    "tail": logs部分}。
+    """
     if by not in TOP_QUERY_TEMPLATES:
         raise ValueError(f"不支持的维度: {by}")
 
     if metric not in METRIC_EXPRESSIONS:
         raise ValueError(f"不支持的指标: {metric}")
 
-    template = TOP_QUERY_TEMPLATES[by]
-    metric_expr = METRIC_EXPRESSIONS[metric]
-    metric_expr_agg = METRIC_EXPRESSIONS_AGG[metric]
+    fields = _validate_filters(filters)
+    templates = _filtered_top_template(by, fields) if fields else TOP_QUERY_TEMPLATES[by]
+    return {**templates, "agg_top": f"{templates['agg']}ORDER BY cd.{metric} DESC\n        LIMIT %(agg_limit)s\n"}
+
+
+def get_quantile_query(slot_sec: int, model_name: Optional[str] = None) -> str:
+    """获取分位数草图查询SQL，指定 model_name 时读取模型维度，否则读取全局维度"""
+    if slot_sec not in QUANTILE_SLOT_SECONDS:
+        raise ValueError(f"分位数不支持的时间粒度: {slot_sec}")
+
+    if model_name is None:
+        dim_filter = build_dim_filter('global')
+    else:
+        dim_filter = build_dim_filter('model', ('model_name',))
+    return QUANTILE_QUERIES[get_series_tier(slot_sec)].format(dim_filter=dim_filter)
+
+
+# 聚合水位未知（尚未聚合或读取失败）时按水位位于结束时间一小时之前的整点处理：
+# 之前读聚合表，尾部读logs，logs的读取量与请求范围无关
+UNKNOWN_WATERMARK_TAIL_SECONDS = 3600
+
+
+def effective_watermark(end_ms: int, aggregated_until: Optional[int]) -> int:
+    """返回用于切分的聚合水位（Unix秒），水位未知时取结束时间前 UNKNOWN_WATERMARK_TAIL_SECONDS 秒所在的整点"""
+    if aggregated_until is not None:
+        return aggregated_until
+    return (-(-end_ms // 1000) - UNKNOWN_WATERMARK_TAIL_SECONDS) // 3600 * 3600
+
+
+def split_series_range(start_ms: int, end_ms: int, aggregated_until: Optional[int]) -> Dict[str, int]:
+    """计算时序查询的聚合水位 agg_end（Unix秒）：之前读聚合表，[agg_end, end_ms) 读logs
+
+    aggregated_until 为None时按 effective_watermark 的规则切分，与TopN一致。
+    """
+    end_sec = -(-end_ms // 1000)
+    return {"agg_end": max(min(effective_watermark(end_ms, aggregated_until), end_sec), start_ms // 1000)}
+
+
+def split_top_range(start_ms: int, end_ms: int, aggregated_until: Optional[int]) -> Dict[str, int]:
+    """计算TopN查询中读聚合表的整小时范围 [agg_start, agg_end)（Unix秒）
+
+    aggregated_until 为聚合已定稿的小时边界，之后的数据只能读logs；为None时按 effective_watermark
+    的规则切分，与时序一致。范围内没有完整小时时，agg_start == agg_end，全部读logs。
+    """
+    agg_start = -(-start_ms // 3600000) * 3600
+    agg_end = min((end_ms // 3600000) * 3600, effective_watermark(end_ms, aggregated_until))
+
+    if agg_end <= agg_start:
+        agg_start = agg_end = -(-start_ms // 1000)
 
-    return template.format(metric=metric, metric_expr=metric_expr, metric_expr_agg=metric_expr_agg)
+    return {"agg_start": agg_start, "agg_end": agg_end}
 
 
 def get_anomaly_query(rule: str) -> str:
@@ -0,0 +1,119 @@
+"""响应体编码模块
+
+结果缓存保存最终的响应体：orjson编码（二进制格式为MessagePack），超过 GZIP_MIN_BYTES 时gzip压缩。
+缓存命中时直接返回这些字节——客户端接受gzip时原样返回并带 Content-Encoding，
+否则只需解压，不再经过 json.loads 与 jsonable_encoder。
+
+已全部聚合的范围响应带弱ETag与 Cache-Control，请求的 If-None-Match 与ETag一致时返回304，不发送响应体。
+"""
+import gzip
+import hashlib
+from decimal import Decimal
+from typing import Any, Optional
+
+import msgpack
+import orjson
+from fastapi import Request
+from fastapi.responses import Response
+
+# 小于该字节数的响应体不压缩（压缩收益不足以抵消gzip头与CPU开销）
+GZIP_MIN_BYTES = 1024
+# gzip压缩级别：缓存的响应体只在计算时压缩一次，取较高的压缩比
+GZIP_LEVEL = 6
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _json_default(obj: Any) -> Any:
+    """orjson不支持的类型：Decimal（SUM结果）转为整数或浮点数，与FastAPI的编码一致"""
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode("utf-8", errors="replace")
+    return str(obj)
+
+
+def encode_body(content: Any, binary: bool = False) -> bytes:
+    """编码响应体，binary 为True时编码为MessagePack；超过 GZIP_MIN_BYTES 时gzip压缩
+
+    压缩后以gzip魔数开头，JSON与顶层为map的MessagePack都不会以该字节开头，由此区分是否压缩。
+    """
+    if binary:
+        body = msgpack.packb(content, default=_json_default, use_bin_type=True)
+    else:
+        body = orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    if len(body) >= GZIP_MIN_BYTES:
+        # mtime固定为0，相同内容的压缩结果相同
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+def is_compressed(body: bytes) -> bool:
+    """响应体是否为gzip压缩"""
+    return body[:2] == _GZIP_MAGIC
+
+
+def decode_body(body: bytes, binary: bool = False) -> Any:
+    """解码响应体（需要Python对象时使用，如基准测试）"""
+    if is_compressed(body):
+        body = gzip.decompress(body)
+    return msgpack.unpackb(body, raw=False) if binary else orjson.loads(body)
+
+
+def accepts_gzip(request: Request) -> bool:
+    """客户端是否接受gzip编码"""
+    return "gzip" in request.headers.get("accept-encoding", "").lower()
+
+
+def make_etag(*parts: Any) -> str:
+    """由若干部分生成弱ETag（gzip与未压缩的响应内容相同、字节不同，只能是弱ETag）"""
+    digest = hashlib.md5(":".join(str(part) for part in parts).encode()).hexdigest()[:16]
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """请求的 If-None-Match 是否包含该ETag（按弱比较，忽略 W/ 前缀）"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    target = etag[2:] if etag.startswith("W/") else etag
+    return any(
+        (tag[2:] if tag.startswith("W/") else tag) == target
+        for tag in (item.strip() for item in header.split(","))
+    )
+
+
+def not_modified_response(etag: str, cache_control: str) -> Response:
+    """304 Not Modified 响应"""
+    return Response(status_code=304, headers={
+        "ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"
+    })
+
+
+def body_response(request: Request, body: bytes, media_type: str = JSON_MEDIA_TYPE,
+                  etag: Optional[str] = None, cache_control: Optional[str] = None) -> Response:
+    """以缓存的响应体构造响应，客户端不接受gzip时解压后返回"""
+    headers = {"Vary": "Accept-Encoding"}
+    if etag:
+        headers["ETag"] = etag
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if is_compressed(body):
+        if accepts_gzip(request):
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body = gzip.decompress(body)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def conditional_response(request: Request, body: bytes, cache_control: str, etag: Optional[str] = None,
+                         media_type: str = JSON_MEDIA_TYPE) -> Response:
+    """带 Cache-Control 的响应，指定 etag 时附带ETag，与 If-None-Match 一致时返回304"""
+    if etag and etag_matches(request, etag):
+        return not_modified_response(etag, cache_control)
+    return body_response(request, body, media_type, etag, cache_control)
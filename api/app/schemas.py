@@ -21,10 +21,10 @@ class ErrorResponse(BaseModel):
 class SeriesDataPoint(BaseModel):
     """时序数据点"""
     bucket: str = Field(description="时间桶")
-    reqs: int = Field(description="请求数")
-    tokens: int = Field(description="Token数")
-    users: int = Field(description="用户数")
-    tokens_cnt: int = Field(description="Token种类数")
+    reqs: Optional[int] = Field(description="请求数，fill=null 时空桶为null")
+    tokens: Optional[int] = Field(description="Token数")
+    users: Optional[int] = Field(description="用户数")
+    tokens_cnt: Optional[int] = Field(description="Token种类数")
 
 
 class SeriesResponse(BaseModel):
@@ -33,6 +33,31 @@ class SeriesResponse(BaseModel):
     total_points: int = Field(description="数据点总数")
 
 
+class UniquesResponse(BaseModel):
+    """时间范围去重计数响应"""
+    users: int = Field(description="独立用户数（HLL估算）")
+    tokens_cnt: int = Field(description="独立Token数（HLL估算）")
+    start_ms: int = Field(description="开始时间戳(毫秒)")
+    end_ms: int = Field(description="结束时间戳(毫秒)")
+
+
+class QuantilePoint(BaseModel):
+    """单请求Token数分位数"""
+    bucket: Optional[str] = Field(default=None, description="时间桶（汇总项无此字段）")
+    count: int = Field(description="请求数")
+    p50: Optional[float] = Field(description="Token数中位数")
+    p95: Optional[float] = Field(description="Token数95分位")
+    p99: Optional[float] = Field(description="Token数99分位")
+
+
+class QuantilesResponse(BaseModel):
+    """单请求Token数分位数响应"""
+    data: List[QuantilePoint]
+    summary: Optional[QuantilePoint] = Field(default=None, description="整个时间范围的分位数")
+    slot_sec: int = Field(description="时间粒度(秒)")
+    model_name: Optional[str] = Field(default=None, description="模型过滤条件")
+
+
 class TopUserItem(BaseModel):
     """Top用户项"""
     user_id: int
@@ -0,0 +1,54 @@
+"""仪表盘默认视图预热模块
+
+仪表盘首页与Top页默认展示最近24小时的时序（15分钟粒度）与用户/模型/通道Token排行。
+这些请求的 start_ms/end_ms 取自浏览器当前时间，每次都不相同，按参数生成的缓存键几乎不会命中，
+首个请求总要查询MySQL。Worker每轮聚合完成后调用 POST /cache/warm，API以当前时间为截止计算这些
+默认视图的响应体，写入固定的缓存键；时间范围与默认视图一致、截止时间与预热时间相差不超过
+cache_warm_max_lag_seconds 的请求直接返回预热的响应体。
+排行按 cache_warm_top_limits 中的每个条数分别预热，limit 不在其中的请求按参数查询。
+"""
+from typing import List, Optional, Tuple
+
+# 预热视图的缓存键前缀，与结果缓存（newapi_monitor:{endpoint}:{hash}）同一命名空间
+WARM_KEY_PREFIX = "newapi_monitor:warm"
+
+# 默认视图：最近24小时，时序15分钟粒度（与前端按时间范围选择的粒度一致），空时间桶补零
+DEFAULT_VIEW_RANGE_MS = 24 * 3600 * 1000
+DEFAULT_SERIES_SLOT_SEC = 900
+DEFAULT_SERIES_FILL = "zero"
+# 默认排行：按Token数排行的用户/模型/通道
+DEFAULT_TOP_DIMENSIONS = ("user", "model", "channel")
+DEFAULT_TOP_METRIC = "tokens"
+
+# 请求时间范围与默认视图的允许偏差（前端分别取开始与截止时间，两者可能相差几毫秒）
+RANGE_TOLERANCE_MS = 1000
+
+
+def series_view_key() -> str:
+    """默认时序视图的缓存键"""
+    return f"{WARM_KEY_PREFIX}:series:{DEFAULT_SERIES_SLOT_SEC}"
+
+
+def top_view_key(by: str, limit: int) -> str:
+    """默认排行视图的缓存键"""
+    return f"{WARM_KEY_PREFIX}:top:{by}:{DEFAULT_TOP_METRIC}:{limit}"
+
+
+def parse_warm_top_limits(value: str) -> List[int]:
+    """解析预热的排行条数（逗号分隔，如 "10,50"）"""
+    return sorted({int(item) for item in value.split(",") if item.strip()})
+
+
+def is_default_range(start_ms: int, end_ms: int) -> bool:
+    """请求的时间范围是否为默认视图的范围（最近24小时）"""
+    return abs(end_ms - start_ms - DEFAULT_VIEW_RANGE_MS) <= RANGE_TOLERANCE_MS
+
+
+def match_warm_view(view: Optional[Tuple[int, bytes]], end_ms: int, max_lag_ms: int) -> bool:
+    """预热结果（(预热截止时间, 响应体)）能否代替请求的结果
+
+    请求截止时间不早于预热截止时间（容许一个偏差，兼容时钟差），且晚于预热截止时间不超过 max_lag_ms。
+    """
+    if not view:
+        return False
+    return view[0] - RANGE_TOLERANCE_MS <= end_ms <= view[0] + max_lag_ms
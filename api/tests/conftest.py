@@ -0,0 +1,8 @@
+"""API单元测试：不连接MySQL与Redis，只测试查询规划、合并与响应编码等纯函数
+
+运行: cd api && python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
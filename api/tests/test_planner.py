@@ -0,0 +1,135 @@
+"""查询规划：时序尾部合并、空桶补齐与TopN合并"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from app.planner import (
+    densify_series, merge_series_tail, merge_top_rows, is_top_agg_sufficient, split_segments, SEGMENT_SECONDS
+)
+from app.sketches import HyperLogLog
+
+BASE = datetime(2024, 8, 11, 0, 0)
+SLOT = timedelta(minutes=5)
+
+
+def series_row(i, reqs=1, tokens=10, users=1, tokens_cnt=1):
+    return {"bucket": BASE + SLOT * i, "ts": 1723334400 + 300 * i,
+            "reqs": reqs, "tokens": tokens, "users": users, "tokens_cnt": tokens_cnt}
+
+
+def tail_row(i, user_id, token_id, reqs=1, tokens=5):
+    return {"bucket": BASE + SLOT * i, "reqs": reqs, "tokens": tokens, "user_id": user_id, "token_id": token_id}
+
+
+class TestMergeSeriesTail:
+    def test_adds_tail_to_existing_bucket_and_appends_new_buckets(self):
+        rows = [series_row(0, reqs=3, tokens=30, users=2, tokens_cnt=2)]
+        tail = [tail_row(0, 7, 70), tail_row(0, 8, 80), tail_row(1, 7, 70, reqs=2, tokens=9)]
+
+        merge_series_tail(rows, tail, {})
+
+        assert [row["bucket"] for row in rows] == [BASE, BASE + SLOT]
+        assert rows[0]["reqs"] == 5 and rows[0]["tokens"] == 40
+        # 没有草图时去重数退回为两部分相加（上界）
+        assert rows[0]["users"] == 4 and rows[0]["tokens_cnt"] == 4
+        assert rows[1] == {"bucket": BASE + SLOT, "reqs": 2, "tokens": 9, "users": 1, "tokens_cnt": 1}
+
+    def test_boundary_sketch_deduplicates_users_across_parts(self):
+        rows = [series_row(0, users=2, tokens_cnt=1)]
+        boundary = {
+            "users": {BASE: HyperLogLog.from_values([1, 2])},
+            "tokens_cnt": {BASE: HyperLogLog.from_values([10])},
+        }
+        # 用户1已计入封闭部分，只有用户3是新增的
+        tail = [tail_row(0, 1, 10), tail_row(0, 3, 10)]
+
+        merge_series_tail(rows, tail, boundary)
+
+        assert rows[0]["users"] == 3
+        assert rows[0]["tokens_cnt"] == 1
+
+    def test_null_ids_are_not_counted(self):
+        rows = []
+        merge_series_tail(rows, [tail_row(0, None, None)], {})
+        assert rows[0]["reqs"] == 1
+        assert rows[0]["users"] == 0 and rows[0]["tokens_cnt"] == 0
+
+
+class TestDensifySeries:
+    def test_zero_fill(self):
+        rows = [series_row(1)]
+        dense = densify_series(rows, BASE, BASE + SLOT * 3, 300, "zero")
+
+        assert [row["bucket"] for row in dense] == [BASE, BASE + SLOT, BASE + SLOT * 2]
+        assert dense[0]["reqs"] == 0 and dense[2]["users"] == 0
+        assert dense[1] is rows[0]
+
+    def test_null_fill(self):
+        dense = densify_series([], BASE, BASE + SLOT * 2, 300, "null")
+        assert [row["tokens"] for row in dense] == [None, None]
+
+    def test_none_fill_and_empty_range_return_rows_unchanged(self):
+        rows = [series_row(1)]
+        assert densify_series(rows, BASE, BASE + SLOT * 3, 300, "none") is rows
+        assert densify_series(rows, None, None, 300, "zero") is rows
+
+    def test_keeps_buckets_outside_range(self):
+        dense = densify_series([series_row(5)], BASE, BASE + SLOT * 2, 300, "zero")
+        assert [row["bucket"] for row in dense] == [BASE, BASE + SLOT, BASE + SLOT * 5]
+
+
+class TestMergeTopRows:
+    def test_sums_parts_and_sorts_by_metric(self):
+        agg = [{"user_id": 1, "reqs": 10, "tokens": 100, "quota_sum": 1},
+               {"user_id": 2, "reqs": 5, "tokens": 90, "quota_sum": 1}]
+        tail = [{"user_id": 2, "reqs": 1, "tokens": 20, "quota_sum": 1},
+                {"user_id": 3, "reqs": 1, "tokens": 5, "quota_sum": 1}]
+
+        result = merge_top_rows([agg, tail], "user_id", "tokens", 2)
+
+        assert [(row["user_id"], row["tokens"], row["reqs"]) for row in result] == [(2, 110, 6), (1, 100, 10)]
+
+    def test_mixes_cached_floats_with_tail_decimals(self):
+        # 缓存分段中的SUM结果为float，logs部分为Decimal
+        cached = [{"user_id": 1, "reqs": 1, "tokens": 10, "quota_sum": 2.25}]
+        tail = [{"user_id": 1, "reqs": 2, "tokens": Decimal("5"), "quota_sum": Decimal("0.5")}]
+
+        result = merge_top_rows([cached, tail], "user_id", "quota_sum", 10)
+
+        assert result == [{"user_id": 1, "reqs": 3, "tokens": 15, "quota_sum": 2.75}]
+
+    def test_does_not_modify_input_rows(self):
+        agg = [{"user_id": 1, "reqs": 1, "tokens": 1, "quota_sum": 1}]
+        merge_top_rows([agg, [dict(agg[0])]], "user_id", "tokens", 1)
+        assert agg[0]["tokens"] == 1
+
+
+class TestTopAggSufficient:
+    @staticmethod
+    def agg_rows(count):
+        return [{"user_id": i, "reqs": 1, "tokens": Decimal(100 - i), "quota_sum": 0} for i in range(count)]
+
+    def test_untruncated_result_is_exact(self):
+        assert is_top_agg_sufficient(self.agg_rows(3), [], "user_id", "tokens", 2, 5)
+
+    def test_small_tail_cannot_change_top(self):
+        tail = [{"user_id": 99, "reqs": 1, "tokens": Decimal(2), "quota_sum": 0}]
+        assert is_top_agg_sufficient(self.agg_rows(5), tail, "user_id", "tokens", 2, 5)
+
+    def test_large_tail_for_unlisted_group_requires_full_read(self):
+        tail = [{"user_id": 99, "reqs": 1, "tokens": Decimal(50), "quota_sum": 0}]
+        assert not is_top_agg_sufficient(self.agg_rows(5), tail, "user_id", "tokens", 2, 5)
+
+    def test_tail_of_listed_group_is_merged_exactly(self):
+        tail = [{"user_id": 4, "reqs": 1, "tokens": Decimal(50), "quota_sum": 0}]
+        assert is_top_agg_sufficient(self.agg_rows(5), tail, "user_id", "tokens", 2, 5)
+
+
+def test_split_segments_aligns_to_days():
+    start = 3 * SEGMENT_SECONDS + 3600
+    end = 5 * SEGMENT_SECONDS + 7200
+    assert split_segments(start, end) == [
+        (start, 4 * SEGMENT_SECONDS),
+        (4 * SEGMENT_SECONDS, 5 * SEGMENT_SECONDS),
+        (5 * SEGMENT_SECONDS, end),
+    ]
+    assert split_segments(end, end) == []
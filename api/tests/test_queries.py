@@ -0,0 +1,44 @@
+"""查询范围在聚合水位处的切分"""
+from app.queries import split_series_range, split_top_range, get_top_query
+
+HOUR_MS = 3600 * 1000
+
+
+class TestSplitSeriesRange:
+    def test_without_watermark_reads_last_hour_from_logs(self):
+        assert split_series_range(0, 10 * HOUR_MS + 1, None) == {"agg_end": 9 * 3600}
+        assert split_series_range(0, 10 * HOUR_MS, None) == {"agg_end": 9 * 3600}
+
+    def test_watermark_inside_range(self):
+        assert split_series_range(0, 10 * HOUR_MS, 5 * 3600) == {"agg_end": 5 * 3600}
+
+    def test_watermark_after_range_is_clamped_to_end(self):
+        assert split_series_range(0, 2 * HOUR_MS, 5 * 3600) == {"agg_end": 2 * 3600}
+
+    def test_watermark_before_range_reads_only_logs(self):
+        assert split_series_range(6 * HOUR_MS, 8 * HOUR_MS, 5 * 3600) == {"agg_end": 6 * 3600}
+
+
+class TestSplitTopRange:
+    def test_full_hours_up_to_watermark(self):
+        params = split_top_range(HOUR_MS + 1, 10 * HOUR_MS + 5, 6 * 3600)
+        assert params == {"agg_start": 2 * 3600, "agg_end": 6 * 3600}
+
+    def test_range_ends_before_watermark(self):
+        params = split_top_range(0, 3 * HOUR_MS + 5, 6 * 3600)
+        assert params == {"agg_start": 0, "agg_end": 3 * 3600}
+
+    def test_no_full_hour_reads_only_logs(self):
+        params = split_top_range(HOUR_MS + 1, 2 * HOUR_MS - 1, 6 * 3600)
+        assert params["agg_start"] == params["agg_end"]
+
+    def test_without_watermark_matches_series_split(self):
+        params = split_top_range(0, 10 * HOUR_MS + 1, None)
+        assert params == {"agg_start": 0, "agg_end": 9 * 3600}
+        assert params["agg_end"] == split_series_range(0, 10 * HOUR_MS + 1, None)["agg_end"]
+
+
+def test_top_query_limits_uncached_aggregate_part():
+    queries = get_top_query("user", "quota_sum")
+    assert "LIMIT" not in queries["agg"]
+    assert queries["agg_top"].rstrip().endswith("ORDER BY cd.quota_sum DESC\n        LIMIT %(agg_limit)s")
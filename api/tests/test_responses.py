@@ -0,0 +1,94 @@
+"""响应体编码与HTTP条件请求"""
+import gzip
+from decimal import Decimal
+
+from fastapi import Request
+
+from app.responses import (
+    encode_body, decode_body, is_compressed, body_response, make_etag, etag_matches,
+    conditional_response, GZIP_MIN_BYTES
+)
+
+CACHE_CONTROL = "public, max-age=300"
+
+
+def make_request(**headers) -> Request:
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw})
+
+
+class TestEncodeBody:
+    def test_small_body_is_not_compressed(self):
+        body = encode_body({"data": [1, 2], "total": Decimal("2.5")})
+        assert not is_compressed(body)
+        assert decode_body(body) == {"data": [1, 2], "total": 2.5}
+
+    def test_large_body_is_compressed(self):
+        content = {"data": list(range(GZIP_MIN_BYTES))}
+        body = encode_body(content)
+        assert is_compressed(body)
+        assert decode_body(body) == content
+        # 相同内容的压缩结果相同
+        assert encode_body(content) == body
+
+    def test_msgpack_round_trip(self):
+        content = {"data": {"bucket": [1, 2], "reqs": [3, Decimal(4)]}}
+        assert decode_body(encode_body(content, binary=True), binary=True) == {
+            "data": {"bucket": [1, 2], "reqs": [3, 4]}
+        }
+
+
+def test_gzip_body_depends_on_accept_encoding():
+    body = encode_body({"data": list(range(GZIP_MIN_BYTES))})
+
+    compressed = body_response(make_request(accept_encoding="gzip, br"), body)
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.body == body
+
+    plain = body_response(make_request(), body)
+    assert "content-encoding" not in plain.headers
+    assert plain.body == gzip.decompress(body)
+
+
+class TestEtagMatches:
+    def test_missing_header(self):
+        assert not etag_matches(make_request(), make_etag("key"))
+
+    def test_weak_comparison_and_lists(self):
+        etag = make_etag("key", 3)
+        strong = etag[2:]
+        assert etag_matches(make_request(if_none_match=etag), etag)
+        assert etag_matches(make_request(if_none_match=strong), etag)
+        assert etag_matches(make_request(if_none_match=f'W/"other", {etag}'), etag)
+        assert not etag_matches(make_request(if_none_match='W/"other"'), etag)
+
+    def test_wildcard(self):
+        assert etag_matches(make_request(if_none_match="*"), make_etag("key"))
+
+    def test_etag_depends_on_parts(self):
+        assert make_etag("key", 1) != make_etag("key", 2)
+
+
+class TestConditionalResponse:
+    def test_returns_body_with_etag(self):
+        body = encode_body({"data": []})
+        etag = make_etag("closed", "r7")
+        response = conditional_response(make_request(), body, CACHE_CONTROL, etag)
+        assert response.status_code == 200
+        assert response.headers["etag"] == etag
+        assert response.headers["cache-control"] == CACHE_CONTROL
+        assert response.body == body
+
+    def test_not_modified_when_etag_matches(self):
+        etag = make_etag("closed", "r7")
+        response = conditional_response(make_request(if_none_match=etag), b"{}", CACHE_CONTROL, etag)
+        assert response.status_code == 304
+        assert response.body == b""
+        assert response.headers["etag"] == etag
+
+    def test_open_range_has_no_etag(self):
+        # 包含logs尾部的响应不带ETag，If-None-Match 不会得到304
+        response = conditional_response(make_request(if_none_match="*"), b"{}", "no-store")
+        assert response.status_code == 200
+        assert "etag" not in response.headers
+        assert response.headers["cache-control"] == "no-store"
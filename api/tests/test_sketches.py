@@ -0,0 +1,69 @@
+"""草图的合并与序列化"""
+import pytest
+
+from app.sketches import HyperLogLog, DDSketch, MAX_PRECISION, union_cardinality, merge_sketches_by
+
+# 序列化格式需与 worker/app/sketches.py 一致，两边的测试使用相同的字节
+HLL_BYTES = bytes.fromhex("010a01010301024403")
+DDSKETCH_BYTES = bytes.fromhex(
+    "013ff052bf5a814afd0000000000000001000000510000000000000001000000e70000000000000001"
+)
+
+
+def test_serialized_format_matches_worker():
+    assert HyperLogLog.from_values([1, "a"], precision=10).to_bytes() == HLL_BYTES
+    assert DDSketch.from_values([0, 5, 100]).to_bytes() == DDSKETCH_BYTES
+
+
+class TestHyperLogLog:
+    def test_sparse_round_trip(self):
+        sketch = HyperLogLog.from_values([1, 2, 3, None])
+        restored = HyperLogLog.from_bytes(sketch.to_bytes())
+        assert restored.cardinality() == sketch.cardinality() == 3
+
+    def test_dense_round_trip(self):
+        sketch = HyperLogLog.from_values(range(50000), precision=12)
+        restored = HyperLogLog.from_bytes(sketch.to_bytes())
+        assert restored.cardinality() == sketch.cardinality()
+        assert abs(restored.cardinality() - 50000) / 50000 < 0.05
+
+    def test_merge_is_union(self):
+        left = HyperLogLog.from_values(range(0, 3000))
+        right = HyperLogLog.from_values(range(2000, 5000))
+        merged = HyperLogLog.from_bytes(left.to_bytes()).merge(HyperLogLog.from_bytes(right.to_bytes()))
+        assert abs(merged.cardinality() - 5000) / 5000 < 0.03
+        assert union_cardinality([left.to_bytes(), None, right.to_bytes()]) == merged.cardinality()
+
+    def test_max_precision_fits_blob_column(self):
+        sketch = HyperLogLog.from_values(range(100000), precision=MAX_PRECISION)
+        assert len(sketch.to_bytes()) <= 65535
+
+    def test_rejects_unsupported_precision(self):
+        with pytest.raises(ValueError):
+            HyperLogLog(MAX_PRECISION + 1)
+
+    def test_merge_sketches_by_groups_rows(self):
+        rows = [
+            {"bucket": "a", "users_sketch": HyperLogLog.from_values([1, 2]).to_bytes()},
+            {"bucket": "a", "users_sketch": HyperLogLog.from_values([2, 3]).to_bytes()},
+            {"bucket": "b", "users_sketch": None},
+        ]
+        merged = merge_sketches_by(rows, "bucket", "users_sketch")
+        assert set(merged) == {"a"}
+        assert merged["a"].cardinality() == 3
+
+
+class TestDDSketch:
+    def test_round_trip_and_merge(self):
+        left = DDSketch.from_values(range(1, 1001))
+        right = DDSketch.from_values(range(1001, 2001))
+        merged = DDSketch.from_bytes(left.to_bytes()).merge(DDSketch.from_bytes(right.to_bytes()))
+
+        assert merged.count == 2000
+        assert merged.quantile(0.5) == pytest.approx(1000, rel=0.02)
+        assert merged.quantile(0.99) == pytest.approx(1980, rel=0.02)
+
+    def test_zero_values(self):
+        sketch = DDSketch.from_bytes(DDSketch.from_values([0, 0, 10]).to_bytes())
+        assert sketch.count == 3
+        assert sketch.quantile(0.5) == 0
@@ -19,6 +19,7 @@ echo "-----------------------------------"
 $MYSQL_CMD -e "
 SELECT 
     hour_bucket,
+    dim,
     user_id,
     model_name,
     channel_id,
@@ -41,7 +42,8 @@ SELECT
     COUNT(DISTINCT hour_bucket) as unique_hours,
     SUM(request_count) as total_requests,
     SUM(total_tokens) as total_tokens
-FROM agg_usage_hourly;
+FROM agg_usage_hourly
+WHERE dim = 'global';
 "
 
 echo ""
@@ -65,11 +65,11 @@ echo "测试插入一条聚合数据："
 
 $MYSQL_CMD -e "
 INSERT INTO agg_usage_hourly (
-    hour_bucket, user_id, model_name, channel_id,
+    hour_bucket, dim, user_id, model_name, channel_id,
     request_count, total_tokens, prompt_tokens, completion_tokens,
     quota_sum, unique_users, unique_tokens
 ) VALUES (
-    '2025-08-12 13:00:00', NULL, NULL, NULL,
+    '2025-08-12 13:00:00', 'global', 0, '', 0,
     1, 100, 50, 50, 0.01, 1, 1
 ) ON DUPLICATE KEY UPDATE
     request_count = VALUES(request_count),
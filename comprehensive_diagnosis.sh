@@ -62,6 +62,7 @@ echo "聚合表最新数据："
 $MYSQL_CMD -e "
 SELECT 
     hour_bucket,
+    dim,
     user_id,
     model_name,
     channel_id,
@@ -21,9 +21,11 @@ GRANT SELECT ON `new-api`.models TO 'newapi_agg'@'%';
 CREATE TABLE IF NOT EXISTS `new-api`.agg_usage_hourly (
     id BIGINT AUTO_INCREMENT PRIMARY KEY,
     hour_bucket DATETIME NOT NULL COMMENT '小时时间桶',
-    user_id INT DEFAULT NULL COMMENT '用户ID，NULL表示全局聚合',
-    model_name VARCHAR(255) DEFAULT NULL COMMENT '模型名称，NULL表示全局聚合',
-    channel_id INT DEFAULT NULL COMMENT '通道ID，NULL表示全局聚合',
+    dim VARCHAR(32) NOT NULL DEFAULT 'global' COMMENT '聚合维度：global/user/model/channel/token',
+    user_id INT NOT NULL DEFAULT 0 COMMENT '用户ID，非用户维度为0',
+    model_name VARCHAR(255) NOT NULL DEFAULT '' COMMENT '模型名称，非模型维度为空串',
+    channel_id INT NOT NULL DEFAULT 0 COMMENT '通道ID，非通道维度为0',
+    token_id INT NOT NULL DEFAULT 0 COMMENT 'Token ID，非Token维度为0',
     
     -- 聚合指标
     request_count BIGINT NOT NULL DEFAULT 0 COMMENT '请求数',
@@ -33,24 +35,108 @@ CREATE TABLE IF NOT EXISTS `new-api`.agg_usage_hourly (
     quota_sum DECIMAL(20,2) NOT NULL DEFAULT 0.00 COMMENT '配额消耗总和',
     unique_users INT NOT NULL DEFAULT 0 COMMENT '独立用户数',
     unique_tokens INT NOT NULL DEFAULT 0 COMMENT '独立Token数',
+    users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图',
+    tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图',
+    tokens_qsketch BLOB DEFAULT NULL COMMENT '单请求Token数分位数草图（DDSketch），仅全局与模型维度',
     
     -- 时间戳
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     
-    -- 唯一约束，支持幂等更新
-    UNIQUE KEY uk_agg_hourly (hour_bucket, user_id, model_name, channel_id),
+    -- 唯一约束，支持幂等更新（维度字段均为非NULL哨兵值，保证键总能匹配）
+    UNIQUE KEY uk_agg_hourly (hour_bucket, dim, user_id, model_name, channel_id, token_id),
     
     -- 查询索引
-    KEY idx_agg_hour_bucket (hour_bucket),
+    KEY idx_agg_dim_hour (dim, hour_bucket),
     KEY idx_agg_user_hour (user_id, hour_bucket),
     KEY idx_agg_model_hour (model_name, hour_bucket),
-    KEY idx_agg_channel_hour (channel_id, hour_bucket)
+    KEY idx_agg_channel_hour (channel_id, hour_bucket),
+    KEY idx_agg_token_hour (token_id, hour_bucket)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
 COMMENT='小时级使用量聚合表';
 
+-- 创建分钟级全局聚合表（由Worker增量写入，供细粒度时序查询）
+CREATE TABLE IF NOT EXISTS `new-api`.agg_usage_minute (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    minute_bucket DATETIME NOT NULL COMMENT '分钟时间桶',
+    
+    -- 聚合指标
+    request_count BIGINT NOT NULL DEFAULT 0 COMMENT '请求数',
+    total_tokens BIGINT NOT NULL DEFAULT 0 COMMENT '总Token数',
+    prompt_tokens BIGINT NOT NULL DEFAULT 0 COMMENT '输入Token数',
+    completion_tokens BIGINT NOT NULL DEFAULT 0 COMMENT '输出Token数',
+    quota_sum DECIMAL(20,2) NOT NULL DEFAULT 0.00 COMMENT '配额消耗总和',
+    unique_users INT NOT NULL DEFAULT 0 COMMENT '独立用户数',
+    unique_tokens INT NOT NULL DEFAULT 0 COMMENT '独立Token数',
+    users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图',
+    tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图',
+    
+    -- 时间戳
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    
+    -- 唯一约束，支持幂等更新
+    UNIQUE KEY uk_agg_minute (minute_bucket)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='分钟级全局使用量聚合表';
+
+-- 创建天级聚合表（由小时级聚合表汇总）
+CREATE TABLE IF NOT EXISTS `new-api`.agg_usage_daily (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    day_bucket DATETIME NOT NULL COMMENT '天时间桶',
+    dim VARCHAR(32) NOT NULL DEFAULT 'global' COMMENT '聚合维度：global/user/model/channel/token',
+    user_id INT NOT NULL DEFAULT 0 COMMENT '用户ID，非用户维度为0',
+    model_name VARCHAR(255) NOT NULL DEFAULT '' COMMENT '模型名称，非模型维度为空串',
+    channel_id INT NOT NULL DEFAULT 0 COMMENT '通道ID，非通道维度为0',
+    token_id INT NOT NULL DEFAULT 0 COMMENT 'Token ID，非Token维度为0',
+    
+    -- 聚合指标
+    request_count BIGINT NOT NULL DEFAULT 0 COMMENT '请求数',
+    total_tokens BIGINT NOT NULL DEFAULT 0 COMMENT '总Token数',
+    prompt_tokens BIGINT NOT NULL DEFAULT 0 COMMENT '输入Token数',
+    completion_tokens BIGINT NOT NULL DEFAULT 0 COMMENT '输出Token数',
+    quota_sum DECIMAL(20,2) NOT NULL DEFAULT 0.00 COMMENT '配额消耗总和',
+    unique_users INT NOT NULL DEFAULT 0 COMMENT '独立用户数',
+    unique_tokens INT NOT NULL DEFAULT 0 COMMENT '独立Token数',
+    users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图',
+    tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图',
+    tokens_qsketch BLOB DEFAULT NULL COMMENT '单请求Token数分位数草图（DDSketch），仅全局与模型维度',
+    
+    -- 时间戳
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    
+    -- 唯一约束，支持幂等更新
+    UNIQUE KEY uk_agg_daily (day_bucket, dim, user_id, model_name, channel_id, token_id),
+    
+    -- 查询索引
+    KEY idx_agg_daily_dim_day (dim, day_bucket)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='天级使用量聚合表';
+
+-- 创建聚合检查点表（各层级/维度的聚合水位，与聚合数据在同一事务中更新）
+CREATE TABLE IF NOT EXISTS `new-api`.agg_checkpoints (
+    name VARCHAR(64) NOT NULL PRIMARY KEY COMMENT '检查点名称：hourly:<维度>、minute、daily 或 incremental:log_id',
+    watermark_time DATETIME DEFAULT NULL COMMENT '已完成的时间边界（不含）',
+    watermark_id BIGINT DEFAULT NULL COMMENT '已聚合的logs.id高水位',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='聚合检查点表';
+
+-- 创建待重算小时表（收到迟到日志的已定稿小时，由迟到日志重算任务消费）
+CREATE TABLE IF NOT EXISTS `new-api`.agg_dirty_hours (
+    hour_bucket DATETIME NOT NULL PRIMARY KEY COMMENT '收到迟到日志的小时',
+    max_log_id BIGINT NOT NULL COMMENT '该小时迟到日志的最大logs.id',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='待重算小时表';
+
 -- 授权聚合用户对聚合表的权限
-GRANT SELECT, INSERT, UPDATE ON `new-api`.agg_usage_hourly TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_usage_hourly TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_usage_minute TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_usage_daily TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_checkpoints TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_dirty_hours TO 'newapi_agg'@'%';
 
 -- 刷新权限
 FLUSH PRIVILEGES;
@@ -73,9 +73,11 @@ USE \`$DB_NAME\`;
 CREATE TABLE agg_usage_hourly (
     id BIGINT AUTO_INCREMENT PRIMARY KEY,
     hour_bucket DATETIME NOT NULL COMMENT '小时时间桶',
-    user_id INT DEFAULT NULL COMMENT '用户ID，NULL表示全局聚合',
-    model_name VARCHAR(255) DEFAULT NULL COMMENT '模型名称，NULL表示全局聚合',
-    channel_id INT DEFAULT NULL COMMENT '通道ID，NULL表示全局聚合',
+    dim VARCHAR(32) NOT NULL DEFAULT 'global' COMMENT '聚合维度：global/user/model/channel/token',
+    user_id INT NOT NULL DEFAULT 0 COMMENT '用户ID，非用户维度为0',
+    model_name VARCHAR(255) NOT NULL DEFAULT '' COMMENT '模型名称，非模型维度为空串',
+    channel_id INT NOT NULL DEFAULT 0 COMMENT '通道ID，非通道维度为0',
+    token_id INT NOT NULL DEFAULT 0 COMMENT 'Token ID，非Token维度为0',
     
     -- 聚合指标
     request_count BIGINT NOT NULL DEFAULT 0 COMMENT '请求数',
@@ -85,21 +87,34 @@ CREATE TABLE agg_usage_hourly (
     quota_sum DECIMAL(20,2) NOT NULL DEFAULT 0.00 COMMENT '配额消耗总和',
     unique_users INT NOT NULL DEFAULT 0 COMMENT '独立用户数',
     unique_tokens INT NOT NULL DEFAULT 0 COMMENT '独立Token数',
+    users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图',
+    tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图',
+    tokens_qsketch BLOB DEFAULT NULL COMMENT '单请求Token数分位数草图（DDSketch），仅全局与模型维度',
     
     -- 时间戳
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     
-    -- 唯一约束，支持幂等更新
-    UNIQUE KEY uk_agg_hourly (hour_bucket, user_id, model_name, channel_id),
+    -- 唯一约束，支持幂等更新（维度字段均为非NULL哨兵值，保证键总能匹配）
+    UNIQUE KEY uk_agg_hourly (hour_bucket, dim, user_id, model_name, channel_id, token_id),
     
     -- 查询索引
-    KEY idx_agg_hour_bucket (hour_bucket),
+    KEY idx_agg_dim_hour (dim, hour_bucket),
     KEY idx_agg_user_hour (user_id, hour_bucket),
     KEY idx_agg_model_hour (model_name, hour_bucket),
-    KEY idx_agg_channel_hour (channel_id, hour_bucket)
+    KEY idx_agg_channel_hour (channel_id, hour_bucket),
+    KEY idx_agg_token_hour (token_id, hour_bucket)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
 COMMENT='小时级使用量聚合表';
+
+-- 创建聚合检查点表（各层级/维度的聚合水位，与聚合数据在同一事务中更新）
+CREATE TABLE IF NOT EXISTS agg_checkpoints (
+    name VARCHAR(64) NOT NULL PRIMARY KEY COMMENT '检查点名称：hourly:<维度> 或 incremental:log_id',
+    watermark_time DATETIME DEFAULT NULL COMMENT '已完成的时间边界（不含）',
+    watermark_id BIGINT DEFAULT NULL COMMENT '已聚合的logs.id高水位',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='聚合检查点表';
 EOF
 
 if [ $? -eq 0 ]; then
@@ -18,6 +18,21 @@ export interface SeriesResponse {
   total_points: number;
 }
 
+// 列格式时序（format=columnar）：每个字段一个数组，bucket 为Unix秒
+export interface SeriesColumns {
+  bucket: number[];
+  reqs: number[];
+  tokens: number[];
+  users: number[];
+  tokens_cnt: number[];
+}
+
+export interface SeriesColumnsResponse {
+  data: SeriesColumns;
+  total_points: number;
+  slot_sec: number;
+}
+
 export interface TopUserItem {
   user_id: number;
   username?: string;
@@ -133,6 +148,17 @@ export const getSeries = (params: {
   return api.get<SeriesResponse>('/stats/series', params);
 };
 
+/**
+ * 获取列格式的时序统计数据（字段名不随数据点重复，适合数据点多的图表）
+ */
+export const getSeriesColumns = (params: {
+  start_ms: number;
+  end_ms: number;
+  slot_sec?: number;
+}): Promise<SeriesColumnsResponse> => {
+  return api.get<SeriesColumnsResponse>('/stats/series', { ...params, format: 'columnar' });
+};
+
 /**
  * 获取TopN排行数据
  */
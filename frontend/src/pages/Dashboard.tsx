@@ -27,7 +27,7 @@ const Dashboard: React.FC = () => {
     if (hours <= 6) return 300; // 5分钟
     if (hours <= 24) return 900; // 15分钟
     if (hours <= 168) return 3600; // 1小时
-    return 14400; // 4小时
+    return 86400; // 1天
   }, [timeRange]);
 
   // 获取时序数据
@@ -9,7 +9,7 @@ import * as echarts from 'echarts';
 
 import Chart from '@/components/Chart';
 import RangeFilter, { TimeRange } from '@/components/RangeFilter';
-import { getSeries, Metric } from '@/api/stats';
+import { getSeriesColumns, Metric, SeriesColumns } from '@/api/stats';
 
 const Heatmap: React.FC = () => {
   // 状态管理
@@ -27,7 +27,7 @@ const Heatmap: React.FC = () => {
     error,
   } = useQuery({
     queryKey: ['heatmap', timeRange.start, timeRange.end],
-    queryFn: () => getSeries({
+    queryFn: () => getSeriesColumns({
       start_ms: timeRange.start,
       end_ms: timeRange.end,
       slot_sec: 3600, // 1小时粒度
@@ -50,13 +50,11 @@ const Heatmap: React.FC = () => {
                    '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', '23'];
     const days = ['周日', '周一', '周二', '周三', '周四', '周五', '周六'];
 
-    seriesData.data.forEach((item: any) => {
-      const date = dayjs(item.bucket);
-      const hour = date.hour();
-      const day = date.day();
-      const value = item[metric as keyof typeof item] as number;
-
-      data.push([hour, day, value]);
+    const columns = seriesData.data;
+    const values = (columns[metric as keyof SeriesColumns] ?? []) as number[];
+    columns.bucket.forEach((ts, i) => {
+      const date = dayjs.unix(ts);
+      data.push([date.hour(), date.day(), values[i] ?? 0]);
     });
 
     return { data, hours, days };
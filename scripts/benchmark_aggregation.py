@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+小时级聚合基准测试脚本
+对比逐维度分别查询与单次扫描两种聚合路径的扫描行数与耗时（只读，不写入聚合表）。
+单次扫描路径包含分位数草图的第二次扫描（TOKEN_SIZE_QUERY），另与把Token数分桶并入
+单次扫描分组的做法对比：后者少扫描一遍logs，但分组行数随每组的分桶数成倍增加。
+
+用法:
+    python scripts/benchmark_aggregation.py --hours 24 --repeat 3
+
+扫描行数取自 SHOW GLOBAL STATUS 中 Innodb_rows_read 的差值，
+建议在无其他流量的只读副本上运行以获得准确结果。
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+# 添加worker包路径
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'worker'))
+
+from app.aggregator import (  # noqa: E402
+    DIMENSION_QUERIES, SINGLE_PASS_QUERY, TOKEN_SIZE_QUERY, MAX_LOG_ID_QUERY,
+    DimensionFolder, QuantileFolder
+)
+from app.database import execute_query_ro, close_connections  # noqa: E402
+
+
+async def get_rows_read() -> int:
+    """获取InnoDB累计读取行数"""
+    result = await execute_query_ro("SHOW GLOBAL STATUS LIKE 'Innodb_rows_read'")
+    return int(result[0]["Value"]) if result else 0
+
+
+async def run_multi_query(start_time: datetime, end_time: datetime) -> dict:
+    """逐维度分别查询路径"""
+    params = [int(start_time.timestamp()), int(end_time.timestamp())]
+    rows_before = await get_rows_read()
+    started = time.perf_counter()
+
+    result_rows = 0
+    for sql in DIMENSION_QUERIES.values():
+        result_rows += len(await execute_query_ro(sql, params))
+
+    elapsed = time.perf_counter() - started
+    rows_scanned = await get_rows_read() - rows_before
+    return {"elapsed": elapsed, "rows_scanned": rows_scanned, "result_rows": result_rows}
+
+
+# Token数分桶并入单次扫描分组的对比查询：一次扫描同时得到维度聚合与分位数分桶
+SINGLE_PASS_WITH_BINS_QUERY = """
+    SELECT
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+        user_id,
+        model_name,
+        channel_id,
+        token_id,
+        CASE WHEN COALESCE(prompt_tokens + completion_tokens, 0) > 0
+             THEN CEIL(LN(prompt_tokens + completion_tokens) / %s) END AS token_bin,
+        COUNT(*) AS request_count,
+        COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+        COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+        COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+        COALESCE(SUM(quota), 0) AS quota_sum
+    FROM logs
+    WHERE created_at >= %s
+      AND created_at < %s
+      AND id <= %s
+    GROUP BY hour_bucket, user_id, model_name, channel_id, token_id, token_bin
+"""
+
+
+async def run_single_pass(start_time: datetime, end_time: datetime, with_bins: bool = False) -> dict:
+    """单次扫描路径（逐小时读取并在内存中折叠）
+
+    with_bins 为 False 时与Worker一致，分位数分桶由 TOKEN_SIZE_QUERY 第二次扫描得到；
+    为 True 时分桶并入单次扫描的分组。
+    """
+    result = await execute_query_ro(MAX_LOG_ID_QUERY)
+    max_log_id = int(result[0]["max_id"]) if result else 0
+    ln_gamma = math.log(QuantileFolder().gamma)
+
+    rows_before = await get_rows_read()
+    started = time.perf_counter()
+
+    groups = 0
+    result_rows = 0
+    fold_elapsed = 0.0
+    quantile_elapsed = 0.0
+    hour_start = start_time
+    while hour_start < end_time:
+        hour_end = min(hour_start + timedelta(hours=1), end_time)
+        time_range = [int(hour_start.timestamp()), int(hour_end.timestamp())]
+        if with_bins:
+            rows = await execute_query_ro(SINGLE_PASS_WITH_BINS_QUERY, [ln_gamma, *time_range, max_log_id])
+            quantile_rows = rows
+        else:
+            rows = await execute_query_ro(SINGLE_PASS_QUERY, [*time_range, max_log_id])
+            quantile_started = time.perf_counter()
+            quantile_rows = await execute_query_ro(TOKEN_SIZE_QUERY, [ln_gamma, 0, max_log_id, *time_range])
+            quantile_elapsed += time.perf_counter() - quantile_started
+            groups += len(quantile_rows)
+        groups += len(rows)
+
+        fold_started = time.perf_counter()
+        folder = DimensionFolder()
+        folder.add(rows)
+        folded = folder.results()
+        quantiles = QuantileFolder()
+        quantiles.add(quantile_rows)
+        quantiles.attach(folded)
+        fold_elapsed += time.perf_counter() - fold_started
+        result_rows += sum(len(results) for results in folded.values())
+        hour_start = hour_end
+
+    elapsed = time.perf_counter() - started
+    rows_scanned = await get_rows_read() - rows_before
+    stats = {
+        "elapsed": elapsed,
+        "fold_elapsed": fold_elapsed,
+        "rows_scanned": rows_scanned,
+        "groups": groups,
+        "result_rows": result_rows,
+    }
+    if not with_bins:
+        stats["quantile_elapsed"] = quantile_elapsed
+    return stats
+
+
+def print_result(name: str, runs: list):
+    """打印某一路径的统计结果"""
+    best = min(runs, key=lambda r: r["elapsed"])
+    avg_elapsed = sum(r["elapsed"] for r in runs) / len(runs)
+    print(f"{name}:")
+    print(f"  平均耗时: {avg_elapsed:.3f}s  最快: {best['elapsed']:.3f}s")
+    print(f"  扫描行数: {best['rows_scanned']}")
+    if "groups" in best:
+        print(f"  MySQL返回分组行数: {best['groups']}")
+    print(f"  聚合结果行数: {best['result_rows']}")
+    if "quantile_elapsed" in best:
+        print(f"  分位数分桶扫描耗时: {best['quantile_elapsed']:.3f}s")
+    if "fold_elapsed" in best:
+        print(f"  内存折叠耗时: {best['fold_elapsed']:.3f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='小时级聚合基准测试')
+    parser.add_argument('--hours', type=int, default=24, help='测试的时间范围（小时）')
+    parser.add_argument('--repeat', type=int, default=3, help='每种路径重复次数')
+    args = parser.parse_args()
+
+    end_time = datetime.now().replace(minute=0, second=0, microsecond=0)
+    start_time = end_time - timedelta(hours=args.hours)
+    print(f"时间范围: {start_time.isoformat()} ~ {end_time.isoformat()}")
+    print("=" * 50)
+
+    try:
+        multi_runs = [await run_multi_query(start_time, end_time) for _ in range(args.repeat)]
+        single_runs = [await run_single_pass(start_time, end_time) for _ in range(args.repeat)]
+        binned_runs = [await run_single_pass(start_time, end_time, with_bins=True) for _ in range(args.repeat)]
+
+        print_result("逐维度分别查询", multi_runs)
+        print_result("单次扫描 + 分位数分桶扫描（当前实现）", single_runs)
+        print_result("单次扫描并入分位数分桶", binned_runs)
+
+        multi_best = min(r["elapsed"] for r in multi_runs)
+        single_best = min(r["elapsed"] for r in single_runs)
+        if single_best > 0:
+            print("=" * 50)
+            print(f"耗时加速比: {multi_best / single_best:.2f}x")
+        multi_scanned = min(r["rows_scanned"] for r in multi_runs)
+        single_scanned = min(r["rows_scanned"] for r in single_runs)
+        if single_scanned > 0:
+            print(f"扫描行数比: {multi_scanned / single_scanned:.2f}x")
+        binned_best = min(r["elapsed"] for r in binned_runs)
+        if binned_best > 0:
+            print(f"分桶并入单次扫描的耗时比: {single_best / binned_best:.2f}x（大于1说明并入更快）")
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+响应体缓存基准测试脚本
+对比缓存命中时两种响应方式的每请求CPU耗时（不连接数据库，使用构造的TopN与异常检测结果）:
+  - 缓存对象: Redis中保存 json.dumps(default=str) 的结果，命中后 json.loads，
+    再由FastAPI经 jsonable_encoder 与 json.dumps 重新编码（改造前）
+  - 缓存响应体: Redis中保存orjson编码并gzip压缩的最终响应体，命中后原样返回；
+    客户端不接受gzip时只需解压
+
+并对比 /stats/series 各响应格式（rows / columnar / msgpack）的响应体大小与解码耗时（客户端解析的近似）。
+
+用法:
+    python scripts/benchmark_responses.py --rows 50,1000,5000 --series-points 1440,10080 --repeat 200
+
+改造前的响应由Nginx按需gzip压缩，该部分CPU不在API进程内，未计入。
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+# 添加api包路径
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from app.responses import encode_body, decode_body, is_compressed  # noqa: E402
+from app.planner import format_series_rows, format_series_columns  # noqa: E402
+
+
+def build_top_rows(count: int) -> list:
+    """构造TopN结果行（SUM结果为Decimal，与MySQL驱动返回的类型一致）"""
+    return [
+        {
+            "user_id": i,
+            "username": f"user_{i:06d}",
+            "reqs": random.randint(1, 100000),
+            "tokens": Decimal(random.randint(1, 10 ** 9)),
+            "quota_sum": Decimal(random.randint(1, 10 ** 8)),
+        }
+        for i in range(count)
+    ]
+
+
+def build_anomaly_rows(count: int) -> list:
+    """构造异常检测结果行"""
+    base = datetime(2024, 8, 11)
+    return [
+        {
+            "token_id": i,
+            "token_name": f"token_{i}",
+            "user_id": i % 97,
+            "window_start": base + timedelta(minutes=i),
+            "reqs": random.randint(120, 5000),
+            "ip": f"10.0.{i % 256}.{i % 97}",
+        }
+        for i in range(count)
+    ]
+
+
+def build_series_rows(count: int) -> list:
+    """构造分钟级时序结果（带内部使用的 ts 字段）"""
+    base = datetime(2024, 8, 11)
+    return [
+        {
+            "bucket": base + timedelta(minutes=i),
+            "ts": 1723334400 + i * 60,
+            "reqs": random.randint(0, 5000),
+            "tokens": random.randint(0, 10 ** 7),
+            "users": random.randint(0, 300),
+            "tokens_cnt": random.randint(0, 500),
+        }
+        for i in range(count)
+    ]
+
+
+def benchmark_series_formats(points: list, repeat: int):
+    """对比时序各响应格式的大小（未压缩/gzip）与解码耗时"""
+    print(f"{'时间桶数':>8} {'格式':>10} {'原始字节':>10} {'gzip字节':>10} {'解码us':>10}")
+    print("=" * 56)
+    for count in points:
+        rows = build_series_rows(count)
+        bodies = {
+            "rows": {"data": format_series_rows([dict(row) for row in rows]), "total_points": count},
+            "columnar": {"data": format_series_columns(rows), "total_points": count, "slot_sec": 60},
+        }
+        for fmt, binary in (("rows", False), ("columnar", False), ("msgpack", True)):
+            content = bodies["rows" if fmt == "rows" else "columnar"]
+            plain = encode_body(content, binary)
+            plain = gzip.decompress(plain) if is_compressed(plain) else plain
+            compressed = gzip.compress(plain, compresslevel=6)
+            decode_us = cpu_per_request(lambda: decode_body(plain, binary), repeat)
+            print(f"{count:>10} {fmt:>10} {len(plain):>12} {len(compressed):>12} {decode_us:>12.1f}")
+        print("-" * 56)
+
+
+def render_legacy(cached: str) -> bytes:
+    """改造前的缓存命中：解码缓存的JSON，FastAPI编码为响应（JSONResponse.render）"""
+    content = {"data": json.loads(cached), "by": "user", "metric": "tokens", "limit": 0}
+    return json.dumps(
+        jsonable_encoder(content), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def cpu_per_request(func, repeat: int) -> float:
+    """每次调用的平均CPU耗时（微秒）"""
+    started = time.process_time()
+    for _ in range(repeat):
+        func()
+    return (time.process_time() - started) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='响应体缓存基准测试')
+    parser.add_argument('--rows', default='50,1000,5000', help='逗号分隔的结果行数')
+    parser.add_argument('--series-points', default='1440,10080', help='逗号分隔的时序时间桶数（1天/1周的分钟级）')
+    parser.add_argument('--repeat', type=int, default=200, help='每种方式重复次数')
+    args = parser.parse_args()
+
+    print(f"{'结果':>6} {'行数':>6} {'方式':>14} {'CPU us/请求':>12} {'缓存字节':>10}")
+    print("=" * 58)
+    for name, builder in (("TopN", build_top_rows), ("异常", build_anomaly_rows)):
+        for count in (int(v) for v in args.rows.split(',')):
+            rows = builder(count)
+            legacy_cached = json.dumps(rows, ensure_ascii=False, default=str)
+            body = encode_body({"data": rows, "by": "user", "metric": "tokens", "limit": count})
+
+            results = (
+                ("缓存对象", cpu_per_request(lambda: render_legacy(legacy_cached), args.repeat),
+                 len(legacy_cached.encode("utf-8"))),
+                ("响应体(gzip)", cpu_per_request(lambda: body, args.repeat), len(body)),
+                ("响应体(解压)", cpu_per_request(
+                    lambda: gzip.decompress(body) if is_compressed(body) else body, args.repeat), len(body)),
+            )
+            for label, cpu_us, size in results:
+                print(f"{name:>6} {count:>8} {label:>14} {cpu_us:>14.1f} {size:>12}")
+            print("-" * 58)
+
+    print()
+    benchmark_series_formats([int(v) for v in args.series_points.split(',')], args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+时序补齐基准测试脚本
+对比MySQL递归CTE生成完整时间序列与只查询有数据的时间桶、在API中补齐两种方式在不同时间跨度下的耗时（只读）
+
+用法:
+    python scripts/benchmark_series.py --ranges 1,24,168,720 --slot-sec 60 --repeat 3
+
+两种方式都只读分钟级聚合表（整个范围视为已聚合，不读logs尾部）。
+递归CTE方式会临时调大会话级 cte_max_recursion_depth，否则30天/1分钟（43200个时间桶）的范围直接报错。
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# 添加api包路径
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from app.deps import execute_query, close_connections  # noqa: E402
+from app.queries import SERIES_QUERIES  # noqa: E402
+from app.planner import SERIES_METRIC_FIELDS, densify_series  # noqa: E402
+
+# 改造前的递归CTE查询（分钟级），仅用于对比
+RECURSIVE_SERIES_QUERY = """
+SET SESSION cte_max_recursion_depth = %(max_depth)s;
+WITH RECURSIVE time_series AS (
+    SELECT
+        FROM_UNIXTIME(FLOOR(%(start_ms)s / 1000 / %(slot_sec)s) * %(slot_sec)s) AS bucket
+    UNION ALL
+    SELECT
+        DATE_ADD(bucket, INTERVAL %(slot_sec)s SECOND)
+    FROM time_series
+    WHERE bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
+),
+tier_data AS (
+    SELECT
+        FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(minute_bucket) / %(slot_sec)s) * %(slot_sec)s) AS bucket,
+        SUM(request_count) AS reqs,
+        SUM(total_tokens) AS tokens,
+        SUM(unique_users) AS users,
+        SUM(unique_tokens) AS tokens_cnt
+    FROM agg_usage_minute
+    WHERE minute_bucket >= FROM_UNIXTIME(%(start_ms)s / 1000)
+      AND minute_bucket < FROM_UNIXTIME(%(end_ms)s / 1000)
+    GROUP BY bucket
+)
+SELECT
+    ts.bucket,
+    COALESCE(td.reqs, 0) AS reqs,
+    COALESCE(td.tokens, 0) AS tokens,
+    COALESCE(td.users, 0) AS users,
+    COALESCE(td.tokens_cnt, 0) AS tokens_cnt
+FROM time_series ts
+LEFT JOIN tier_data td ON ts.bucket = td.bucket
+ORDER BY ts.bucket;
+"""
+
+
+async def run_recursive(params: dict) -> dict:
+    """递归CTE在MySQL中生成并关联完整时间序列"""
+    buckets = (params["end_ms"] - params["start_ms"]) // 1000 // params["slot_sec"] + 2
+    started = time.perf_counter()
+    rows = await execute_query(RECURSIVE_SERIES_QUERY, {**params, "max_depth": max(1000, buckets)})
+    return {"elapsed": time.perf_counter() - started, "fill_elapsed": 0.0, "points": len(rows), "fetched": len(rows)}
+
+
+async def run_densify(params: dict) -> dict:
+    """只查询有数据的时间桶，在Python中补齐"""
+    started = time.perf_counter()
+    rows = await execute_query(SERIES_QUERIES["minute"], params)
+
+    fill_started = time.perf_counter()
+    data = [
+        {"bucket": row["bucket"], **{field: row[field] for field in SERIES_METRIC_FIELDS}}
+        for row in rows if row["bucket"] is not None
+    ]
+    dense = densify_series(data, rows[0]["first_bucket"], rows[0]["range_end"], params["slot_sec"])
+    finished = time.perf_counter()
+    return {
+        "elapsed": finished - started,
+        "fill_elapsed": finished - fill_started,
+        "points": len(dense),
+        "fetched": len(data),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='时序补齐基准测试')
+    parser.add_argument('--ranges', default='1,24,168,720', help='逗号分隔的时间跨度（小时），截止到当前时间')
+    parser.add_argument('--slot-sec', type=int, default=60, help='时间粒度（秒），需为分钟级粒度')
+    parser.add_argument('--repeat', type=int, default=3, help='每种方式重复次数，取最短耗时')
+    args = parser.parse_args()
+
+    now_ms = int(time.time() * 1000)
+    print(f"{'跨度(小时)':>10} {'方式':>8} {'耗时ms':>10} {'补齐ms':>8} {'查询行数':>8} {'时间桶数':>8}")
+    print("=" * 62)
+    try:
+        for hours in (int(v) for v in args.ranges.split(',')):
+            start_ms = now_ms - hours * 3600 * 1000
+            params = {
+                "start_ms": start_ms,
+                "end_ms": now_ms,
+                "slot_sec": args.slot_sec,
+                "agg_end": -(-now_ms // 1000),
+            }
+            for name, runner in (("递归CTE", run_recursive), ("API补齐", run_densify)):
+                results = [await runner(params) for _ in range(args.repeat)]
+                best = min(results, key=lambda r: r["elapsed"])
+                print(f"{hours:>12} {name:>8} {best['elapsed'] * 1000:>12.1f} {best['fill_elapsed'] * 1000:>10.2f}"
+                      f" {best['fetched']:>10} {best['points']:>10}")
+            print("-" * 62)
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
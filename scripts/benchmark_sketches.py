@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+草图基准测试脚本
+在不同HLL精度与基数下测量草图序列化大小、估算相对误差与合并耗时，
+并测量Token数分位数草图（DDSketch）的大小与分位数相对误差（纯内存计算，不访问数据库）
+
+用法:
+    python scripts/benchmark_sketches.py --cardinalities 100,1000,10000,100000 --trials 5
+
+误差取多次试验（不同随机ID集合）相对误差绝对值的平均值与最大值，
+合并测试将24个小时草图取并集，对应按天汇总去重数的场景。
+分位数测试使用对数正态分布模拟单请求Token数，与精确分位数比较。
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+# 添加worker包路径
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'worker'))
+
+from app.sketches import HyperLogLog, DDSketch, MIN_PRECISION, MAX_PRECISION  # noqa: E402
+
+
+def measure(precision: int, cardinality: int, trials: int) -> dict:
+    """测量某一精度与基数下的草图大小与估算误差"""
+    errors = []
+    size = 0
+    for trial in range(trials):
+        rng = random.Random(precision * 1000003 + cardinality * 31 + trial)
+        values = rng.sample(range(1, cardinality * 100 + 1), cardinality)
+        sketch = HyperLogLog.from_values(values, precision)
+        size = len(sketch.to_bytes())
+        errors.append(abs(sketch.cardinality() - cardinality) / cardinality)
+
+    return {
+        "size": size,
+        "mean_error": sum(errors) / len(errors),
+        "max_error": max(errors),
+    }
+
+
+def measure_merge(precision: int, cardinality: int, parts: int = 24) -> dict:
+    """测量将多个草图取并集的耗时与误差（各部分之间有一半元素重叠）"""
+    rng = random.Random(precision)
+    universe = rng.sample(range(1, cardinality * 100 + 1), cardinality)
+    blobs = []
+    expected = set()
+    for _ in range(parts):
+        part = rng.sample(universe, max(1, cardinality // 2))
+        expected.update(part)
+        blobs.append(HyperLogLog.from_values(part, precision).to_bytes())
+
+    started = time.perf_counter()
+    merged = HyperLogLog.from_bytes(blobs[0])
+    for blob in blobs[1:]:
+        merged.merge(HyperLogLog.from_bytes(blob))
+    estimate = merged.cardinality()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "elapsed": elapsed,
+        "error": abs(estimate - len(expected)) / len(expected),
+        "total_bytes": sum(len(b) for b in blobs),
+    }
+
+
+def measure_quantiles(relative_accuracy: float, count: int, parts: int = 24) -> dict:
+    """测量分位数草图的大小、合并耗时与 p50/p95/p99 相对误差（按小时分为 parts 个草图后合并）"""
+    rng = random.Random(count)
+    values = [int(rng.lognormvariate(6.5, 1.2)) for _ in range(count)]
+    blobs = [
+        DDSketch.from_values(values[i::parts], relative_accuracy).to_bytes()
+        for i in range(parts)
+    ]
+
+    started = time.perf_counter()
+    merged = DDSketch.from_bytes(blobs[0])
+    for blob in blobs[1:]:
+        merged.merge(DDSketch.from_bytes(blob))
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(values)
+    errors = {}
+    for q in (0.5, 0.95, 0.99):
+        exact = ordered[int(q * (count - 1))]
+        errors[q] = abs(merged.quantile(q) - exact) / exact if exact else 0.0
+
+    return {
+        "elapsed": elapsed,
+        "max_bytes": max(len(b) for b in blobs),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='去重草图基准测试')
+    parser.add_argument('--cardinalities', default='10,100,1000,10000,100000',
+                        help='逗号分隔的基数列表')
+    parser.add_argument('--precisions', default=f'{MIN_PRECISION + 4},10,12,14,{MAX_PRECISION}',
+                        help='逗号分隔的HLL精度列表')
+    parser.add_argument('--trials', type=int, default=5, help='每组参数的试验次数')
+    parser.add_argument('--accuracies', default='0.005,0.01,0.02',
+                        help='逗号分隔的DDSketch相对误差列表')
+    args = parser.parse_args()
+
+    cardinalities = [int(v) for v in args.cardinalities.split(',')]
+    precisions = [int(v) for v in args.precisions.split(',')]
+
+    print(f"{'精度':>4} {'理论误差':>8} {'基数':>8} {'草图字节':>8} {'平均误差':>8} {'最大误差':>8}")
+    print("=" * 56)
+    for precision in precisions:
+        theoretical = 1.04 / math.sqrt(1 << precision)
+        for cardinality in cardinalities:
+            result = measure(precision, cardinality, args.trials)
+            print(f"{precision:>6} {theoretical:>11.2%} {cardinality:>10} {result['size']:>12}"
+                  f" {result['mean_error']:>11.2%} {result['max_error']:>11.2%}")
+        print("-" * 56)
+
+    print("24个草图取并集（模拟小时汇总为天）:")
+    for precision in precisions:
+        result = measure_merge(precision, max(cardinalities))
+        print(f"  精度 {precision:>2}: 耗时 {result['elapsed'] * 1000:.2f}ms"
+              f"  草图总字节 {result['total_bytes']}  相对误差 {result['error']:.2%}")
+
+    print("Token数分位数草图（24个小时草图合并）:")
+    for accuracy in (float(v) for v in args.accuracies.split(',')):
+        result = measure_quantiles(accuracy, max(cardinalities))
+        errors = "  ".join(f"p{int(q * 100)} {e:.2%}" for q, e in result['errors'].items())
+        print(f"  相对误差 {accuracy:.1%}: 合并耗时 {result['elapsed'] * 1000:.2f}ms"
+              f"  单个草图最大字节 {result['max_bytes']}  {errors}")
+
+
+if __name__ == "__main__":
+    main()
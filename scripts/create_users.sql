@@ -17,7 +17,11 @@ GRANT SELECT ON `new-api`.tokens TO 'newapi_agg'@'%';
 GRANT SELECT ON `new-api`.channels TO 'newapi_agg'@'%';
 GRANT SELECT ON `new-api`.models TO 'newapi_agg'@'%';
 GRANT SELECT ON `new-api`.vendors TO 'newapi_agg'@'%';
-GRANT SELECT, INSERT, UPDATE ON `new-api`.agg_usage_hourly TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_usage_hourly TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_usage_minute TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_usage_daily TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_checkpoints TO 'newapi_agg'@'%';
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_dirty_hours TO 'newapi_agg'@'%';
 
 -- 3. 可选：创建管理用户（用于维护和监控）
 -- CREATE USER IF NOT EXISTS 'newapi_admin'@'%' IDENTIFIED BY 'newapi_admin_secure_password_2024';
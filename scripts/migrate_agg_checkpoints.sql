@@ -0,0 +1,24 @@
+-- 聚合检查点迁移脚本
+-- 新增 agg_checkpoints 表，保存小时级各维度、分钟级与天级的时间水位，以及增量聚合的logs.id水位。
+-- 检查点与聚合数据在同一事务中提交，某个维度或某个小时失败后只重做未完成的部分，
+-- Redis丢失 last_aggregation_time 也不会从 hours_back 重新扫描。
+--
+-- 使用方法（需要CREATE与GRANT权限的账号）:
+--   mysql -h<host> -P<port> -u<user> -p new-api < scripts/migrate_agg_checkpoints.sql
+-- 表为空时Worker首次运行回退到Redis中已有的 last_aggregation_time / last_aggregated_log_id，
+-- 之后以本表为准，Redis中的两个键仅作为镜像供API读取。
+
+USE `new-api`;
+
+CREATE TABLE IF NOT EXISTS agg_checkpoints (
+    name VARCHAR(64) NOT NULL PRIMARY KEY COMMENT '检查点名称：hourly:<维度>、minute、daily 或 incremental:log_id',
+    watermark_time DATETIME DEFAULT NULL COMMENT '已完成的时间边界（不含）',
+    watermark_id BIGINT DEFAULT NULL COMMENT '已聚合的logs.id高水位',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='聚合检查点表';
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_checkpoints TO 'newapi_agg'@'%';
+FLUSH PRIVILEGES;
+
+SELECT '聚合检查点迁移完成！' AS message;
@@ -0,0 +1,71 @@
+-- agg_usage_hourly 维度键迁移脚本
+-- 旧表结构中非适用维度以NULL存储，而MySQL唯一键视NULL为互不相等，
+-- 导致 ON DUPLICATE KEY UPDATE 永远无法命中、每次重算都会插入新行并使SUM重复计数。
+-- 本脚本增加 dim 维度列、将NULL替换为非NULL哨兵值，并对已有重复行去重。
+--
+-- 使用方法（需要ALTER/DELETE权限的账号，建议先停止Worker并备份）:
+--   mysql -h<host> -P<port> -u<user> -p new-api < scripts/migrate_agg_dimension_keys.sql
+-- 执行完成后请删除Redis中的 last_aggregated_log_id（已创建 agg_checkpoints 表时同时删除其中的
+-- incremental:log_id 记录），Worker将重建当前小时的增量基线。
+
+USE `new-api`;
+
+-- 1. 增加维度列并根据非NULL字段回填
+ALTER TABLE agg_usage_hourly
+    ADD COLUMN dim VARCHAR(32) NOT NULL DEFAULT 'global' COMMENT '聚合维度：global/user/model/channel' AFTER hour_bucket;
+
+UPDATE agg_usage_hourly
+SET dim = CASE
+    WHEN user_id IS NOT NULL THEN 'user'
+    WHEN model_name IS NOT NULL THEN 'model'
+    WHEN channel_id IS NOT NULL THEN 'channel'
+    ELSE 'global'
+END;
+
+-- 2. 去重：每个 (小时, 维度, 维度值) 仅保留最后一次写入（id最大）的行
+--    旧逻辑下每次写入都是该小时的整体重算结果，最新一行即为最终值
+CREATE TEMPORARY TABLE agg_usage_hourly_keep AS
+SELECT MAX(id) AS id
+FROM agg_usage_hourly
+GROUP BY hour_bucket, dim, COALESCE(user_id, 0), COALESCE(model_name, ''), COALESCE(channel_id, 0);
+
+ALTER TABLE agg_usage_hourly_keep ADD PRIMARY KEY (id);
+
+SELECT
+    '将要删除的重复聚合行数' AS '操作',
+    COUNT(*) AS '记录数'
+FROM agg_usage_hourly a
+LEFT JOIN agg_usage_hourly_keep k ON a.id = k.id
+WHERE k.id IS NULL;
+
+DELETE a FROM agg_usage_hourly a
+LEFT JOIN agg_usage_hourly_keep k ON a.id = k.id
+WHERE k.id IS NULL;
+
+DROP TEMPORARY TABLE agg_usage_hourly_keep;
+
+-- 3. NULL替换为哨兵值
+UPDATE agg_usage_hourly
+SET user_id = COALESCE(user_id, 0),
+    model_name = COALESCE(model_name, ''),
+    channel_id = COALESCE(channel_id, 0)
+WHERE user_id IS NULL OR model_name IS NULL OR channel_id IS NULL;
+
+-- 4. 收紧列定义并重建唯一键与索引
+ALTER TABLE agg_usage_hourly
+    MODIFY user_id INT NOT NULL DEFAULT 0 COMMENT '用户ID，非用户维度为0',
+    MODIFY model_name VARCHAR(255) NOT NULL DEFAULT '' COMMENT '模型名称，非模型维度为空串',
+    MODIFY channel_id INT NOT NULL DEFAULT 0 COMMENT '通道ID，非通道维度为0',
+    DROP INDEX uk_agg_hourly,
+    ADD UNIQUE KEY uk_agg_hourly (hour_bucket, dim, user_id, model_name, channel_id),
+    DROP INDEX idx_agg_hour_bucket,
+    ADD KEY idx_agg_dim_hour (dim, hour_bucket);
+
+ANALYZE TABLE agg_usage_hourly;
+
+-- 5. 验证：各维度行数，且不应存在重复键
+SELECT dim AS '维度', COUNT(*) AS '记录数'
+FROM agg_usage_hourly
+GROUP BY dim;
+
+SELECT 'agg_usage_hourly 维度键迁移完成！' AS message;
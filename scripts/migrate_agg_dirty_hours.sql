@@ -0,0 +1,22 @@
+-- 待重算小时迁移脚本
+-- 新增 agg_dirty_hours 表，保存收到迟到日志的已定稿小时（此前保存在Redis有序集合 dirty_hour_buckets 中，
+-- Redis丢失数据后这些小时不会再被重算）。
+--
+-- 使用方法（需要CREATE与GRANT权限的账号）:
+--   mysql -h<host> -P<port> -u<user> -p new-api < scripts/migrate_agg_dirty_hours.sql
+-- 升级前Redis中尚未重算的小时不会自动迁移，可用 redis-cli ZRANGE dirty_hour_buckets 0 -1 查看，
+-- 再以回填命令重算对应的时间范围。
+
+USE `new-api`;
+
+CREATE TABLE IF NOT EXISTS agg_dirty_hours (
+    hour_bucket DATETIME NOT NULL PRIMARY KEY COMMENT '收到迟到日志的小时',
+    max_log_id BIGINT NOT NULL COMMENT '该小时迟到日志的最大logs.id',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci 
+COMMENT='待重算小时表';
+
+GRANT SELECT, INSERT, UPDATE, DELETE ON `new-api`.agg_dirty_hours TO 'newapi_agg'@'%';
+FLUSH PRIVILEGES;
+
+SELECT '待重算小时迁移完成！' AS message;
@@ -0,0 +1,18 @@
+-- 聚合表分位数草图迁移脚本
+-- 为小时级/天级聚合表增加单请求Token数的DDSketch草图列（仅全局与模型维度写入），
+-- /stats/quantiles 合并查询范围内的草图得到 p50/p95/p99，不扫描logs。
+--
+-- 使用方法（需要ALTER权限的账号）:
+--   mysql -h<host> -P<port> -u<user> -p new-api < scripts/migrate_agg_quantiles.sql
+-- 迁移前写入的聚合行草图为NULL，查询时跳过；如需补齐历史区间，可用回填命令重算
+-- （python -m app.backfill，见 DEPLOYMENT.md）。
+
+USE `new-api`;
+
+ALTER TABLE agg_usage_hourly
+    ADD COLUMN tokens_qsketch BLOB DEFAULT NULL COMMENT '单请求Token数分位数草图（DDSketch），仅全局与模型维度' AFTER tokens_sketch;
+
+ALTER TABLE agg_usage_daily
+    ADD COLUMN tokens_qsketch BLOB DEFAULT NULL COMMENT '单请求Token数分位数草图（DDSketch），仅全局与模型维度' AFTER tokens_sketch;
+
+SELECT '聚合表分位数草图迁移完成！' AS message;
@@ -0,0 +1,24 @@
+-- 聚合表去重草图迁移脚本
+-- 为分钟级/小时级/天级聚合表增加用户与Token的HLL草图列。
+-- 去重计数无法相加，草图可合并，任意时间范围的独立用户/Token数由草图取并集估算。
+--
+-- 使用方法（需要ALTER权限的账号）:
+--   mysql -h<host> -P<port> -u<user> -p new-api < scripts/migrate_agg_sketches.sql
+-- 迁移前写入的聚合行草图为NULL，查询时回退为按时间桶累加的去重计数；
+-- 如需补齐草图，可用回填命令重算历史区间（python -m app.backfill，见 DEPLOYMENT.md）。
+
+USE `new-api`;
+
+ALTER TABLE agg_usage_hourly
+    ADD COLUMN users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图' AFTER unique_tokens,
+    ADD COLUMN tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图' AFTER users_sketch;
+
+ALTER TABLE agg_usage_minute
+    ADD COLUMN users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图' AFTER unique_tokens,
+    ADD COLUMN tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图' AFTER users_sketch;
+
+ALTER TABLE agg_usage_daily
+    ADD COLUMN users_sketch BLOB DEFAULT NULL COMMENT '用户去重HLL草图' AFTER unique_tokens,
+    ADD COLUMN tokens_sketch BLOB DEFAULT NULL COMMENT 'Token去重HLL草图' AFTER users_sketch;
+
+SELECT '聚合表去重草图迁移完成！' AS message;
@@ -0,0 +1,27 @@
+-- 聚合表Token维度迁移脚本
+-- 为小时级/天级聚合表增加 token_id 维度列并重建唯一键，
+-- 使 /stats/top?by=token 可以由聚合表提供已结束小时的数据，不再扫描logs。
+--
+-- 使用方法（需要ALTER权限的账号）:
+--   mysql -h<host> -P<port> -u<user> -p new-api < scripts/migrate_agg_token_dimension.sql
+-- 迁移前的小时没有Token维度行，如需补齐可用回填命令重算历史区间（python -m app.backfill，
+-- 覆盖写入，不会重复计数），天级聚合随之重新汇总。
+
+USE `new-api`;
+
+ALTER TABLE agg_usage_hourly
+    MODIFY dim VARCHAR(32) NOT NULL DEFAULT 'global' COMMENT '聚合维度：global/user/model/channel/token',
+    ADD COLUMN token_id INT NOT NULL DEFAULT 0 COMMENT 'Token ID，非Token维度为0' AFTER channel_id,
+    DROP INDEX uk_agg_hourly,
+    ADD UNIQUE KEY uk_agg_hourly (hour_bucket, dim, user_id, model_name, channel_id, token_id),
+    ADD KEY idx_agg_token_hour (token_id, hour_bucket);
+
+ALTER TABLE agg_usage_daily
+    MODIFY dim VARCHAR(32) NOT NULL DEFAULT 'global' COMMENT '聚合维度：global/user/model/channel/token',
+    ADD COLUMN token_id INT NOT NULL DEFAULT 0 COMMENT 'Token ID，非Token维度为0' AFTER channel_id,
+    DROP INDEX uk_agg_daily,
+    ADD UNIQUE KEY uk_agg_daily (day_bucket, dim, user_id, model_name, channel_id, token_id);
+
+ANALYZE TABLE agg_usage_hourly, agg_usage_daily;
+
+SELECT '聚合表Token维度迁移完成！' AS message;
@@ -88,10 +88,10 @@ async def test_aggregation():
             print("\n💾 5. 测试插入聚合数据")
             insert_sql = """
                 INSERT INTO agg_usage_hourly (
-                    hour_bucket, user_id, model_name, channel_id,
+                    hour_bucket, dim, user_id, model_name, channel_id,
                     request_count, total_tokens, prompt_tokens, completion_tokens,
                     quota_sum, unique_users, unique_tokens
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ON DUPLICATE KEY UPDATE
                     request_count = VALUES(request_count),
                     total_tokens = VALUES(total_tokens),
@@ -107,9 +107,10 @@ async def test_aggregation():
             test_row = results[0]
             test_data = [
                 test_row['hour_bucket'],
-                None,  # user_id (全局聚合)
-                None,  # model_name (全局聚合)
-                None,  # channel_id (全局聚合)
+                'global',  # dim (全局聚合)
+                0,  # user_id 哨兵值
+                '',  # model_name 哨兵值
+                0,  # channel_id 哨兵值
                 test_row['request_count'],
                 test_row['total_tokens'],
                 test_row['prompt_tokens'],
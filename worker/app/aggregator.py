@@ -1,265 +1,1303 @@
 """数据聚合模块"""
 import asyncio
+import math
+import time
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import structlog
 
-from app.database import execute_query_ro, execute_query_agg, get_last_aggregation_time, set_last_aggregation_time
+from app.config import settings
+from app.database import (
+    execute_query_ro, stream_query_ro, execute_query_agg, bulk_upsert_agg,
+    agg_transaction, get_checkpoints, set_checkpoints, MYSQL_POOL_AGG_MAXSIZE,
+    get_last_aggregation_time, set_last_aggregation_time,
+    get_last_aggregated_log_id, set_last_aggregated_log_id,
+    add_dirty_hours, get_dirty_hours, remove_dirty_hour, bump_aggregation_revision
+)
+from app.sketches import HyperLogLog, DDSketch
+from app.pipeline import StageTimings, run_pipeline
 
 logger = structlog.get_logger()
 
+# 聚合维度定义：维度名 -> 分组字段，全局维度不分组
+AGG_DIMENSIONS = {
+    "global": (),
+    "user": ("user_id",),
+    "model": ("model_name",),
+    "channel": ("channel_id",),
+    "token": ("token_id",),
+}
+
+# 基础维度对应的logs字段，交叉维度由其中两个或多个组合而成
+BASE_DIMENSION_FIELDS = {
+    "user": "user_id",
+    "model": "model_name",
+    "channel": "channel_id",
+    "token": "token_id",
+}
+
+
+def parse_cubes(spec: str) -> Dict[str, tuple]:
+    """解析交叉维度配置，如 "user:model,channel:model" -> {"user_model": ("user_id", "model_name"), ...}"""
+    cubes = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        dims = [dim.strip() for dim in item.split(":")]
+        if len(dims) < 2 or len(set(dims)) != len(dims):
+            raise ValueError(f"交叉维度至少包含两个不同的基础维度: {item}")
+        unknown = [dim for dim in dims if dim not in BASE_DIMENSION_FIELDS]
+        if unknown:
+            raise ValueError(f"未知的基础维度: {', '.join(unknown)}")
+        name = "_".join(dims)
+        if len(name) > 32:
+            raise ValueError(f"交叉维度名称超过32个字符: {name}")
+        cubes[name] = tuple(BASE_DIMENSION_FIELDS[dim] for dim in dims)
+    return cubes
+
+
+# 配置声明的交叉维度，与基础维度一样逐小时物化到聚合表（dim 列为维度名）
+AGG_DIMENSIONS.update(parse_cubes(settings.agg_cubes))
+
+# 维度字段的哨兵值：非适用维度写入非NULL哨兵，保证唯一键 uk_agg_hourly 总能匹配
+DIMENSION_SENTINELS = {
+    "user_id": 0,
+    "model_name": "",
+    "channel_id": 0,
+    "token_id": 0,
+}
+
+# 分维度聚合SQL（逐维度扫描logs，每个维度一次全量扫描）
+DIMENSION_QUERIES = {
+    "global": """
+        SELECT
+            DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+            COUNT(*) AS request_count,
+            COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM(quota), 0) AS quota_sum,
+            COUNT(DISTINCT user_id) AS unique_users,
+            COUNT(DISTINCT token_id) AS unique_tokens
+        FROM logs
+        WHERE created_at >= %s
+          AND created_at < %s
+        GROUP BY hour_bucket
+        ORDER BY hour_bucket
+    """,
+    "user": """
+        SELECT
+            DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+            user_id,
+            COUNT(*) AS request_count,
+            COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM(quota), 0) AS quota_sum,
+            1 AS unique_users,
+            COUNT(DISTINCT token_id) AS unique_tokens
+        FROM logs
+        WHERE created_at >= %s
+          AND created_at < %s
+        GROUP BY hour_bucket, user_id
+        ORDER BY hour_bucket, user_id
+    """,
+    "model": """
+        SELECT
+            DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+            model_name,
+            COUNT(*) AS request_count,
+            COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM(quota), 0) AS quota_sum,
+            COUNT(DISTINCT user_id) AS unique_users,
+            COUNT(DISTINCT token_id) AS unique_tokens
+        FROM logs
+        WHERE created_at >= %s
+          AND created_at < %s
+        GROUP BY hour_bucket, model_name
+        ORDER BY hour_bucket, model_name
+    """,
+    "channel": """
+        SELECT
+            DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+            channel_id,
+            COUNT(*) AS request_count,
+            COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM(quota), 0) AS quota_sum,
+            COUNT(DISTINCT user_id) AS unique_users,
+            COUNT(DISTINCT token_id) AS unique_tokens
+        FROM logs
+        WHERE created_at >= %s
+          AND created_at < %s
+        GROUP BY hour_bucket, channel_id
+        ORDER BY hour_bucket, channel_id
+    """,
+    "token": """
+        SELECT
+            DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+            token_id,
+            COUNT(*) AS request_count,
+            COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM(quota), 0) AS quota_sum,
+            COUNT(DISTINCT user_id) AS unique_users,
+            1 AS unique_tokens
+        FROM logs
+        WHERE created_at >= %s
+          AND created_at < %s
+        GROUP BY hour_bucket, token_id
+        ORDER BY hour_bucket, token_id
+    """,
+}
+
+
+def build_dimension_query(fields: tuple) -> str:
+    """生成交叉维度的逐维度聚合SQL，与 DIMENSION_QUERIES 中的单维度查询结构一致"""
+    group_fields = ", ".join(("hour_bucket",) + fields)
+    select_fields = "".join(f"\n            {field}," for field in fields)
+    unique_users = "1" if "user_id" in fields else "COUNT(DISTINCT user_id)"
+    unique_tokens = "1" if "token_id" in fields else "COUNT(DISTINCT token_id)"
+    return f"""
+        SELECT
+            DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,{select_fields}
+            COUNT(*) AS request_count,
+            COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+            COALESCE(SUM(quota), 0) AS quota_sum,
+            {unique_users} AS unique_users,
+            {unique_tokens} AS unique_tokens
+        FROM logs
+        WHERE created_at >= %s
+          AND created_at < %s
+        GROUP BY {group_fields}
+        ORDER BY {group_fields}
+    """
+
+
+DIMENSION_QUERIES.update({
+    dim: build_dimension_query(fields) for dim, fields in AGG_DIMENSIONS.items() if dim not in DIMENSION_QUERIES
+})
+
+# 单次扫描聚合SQL：按各维度分组字段的最细粒度分组，在Python中折叠出全部维度
+SINGLE_PASS_QUERY = """
+    SELECT
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+        user_id,
+        model_name,
+        channel_id,
+        token_id,
+        COUNT(*) AS request_count,
+        COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+        COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+        COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+        COALESCE(SUM(quota), 0) AS quota_sum
+    FROM logs
+    WHERE created_at >= %s
+      AND created_at < %s
+      AND id <= %s
+    GROUP BY hour_bucket, user_id, model_name, channel_id, token_id
+"""
+
+# 增量聚合SQL：按logs.id区间读取日志，按分钟粒度分组，
+# 同时供分钟级全局聚合与小时级各维度聚合折叠使用
+INCREMENTAL_QUERY = """
+    SELECT
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:%%i:00') AS minute_bucket,
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+        user_id,
+        model_name,
+        channel_id,
+        token_id,
+        COUNT(*) AS request_count,
+        COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+        COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+        COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+        COALESCE(SUM(quota), 0) AS quota_sum
+    FROM logs
+    WHERE id > %s
+      AND id <= %s
+      AND created_at >= %s
+      AND created_at < %s
+    GROUP BY minute_bucket, hour_bucket, user_id, model_name, channel_id, token_id
+"""
+
+# 分钟级全局聚合SQL：逐维度聚合路径下为全局维度补写分钟级数据（单次扫描与增量路径由 INCREMENTAL_QUERY 折叠）
+MINUTE_GLOBAL_QUERY = """
+    SELECT
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:%%i:00') AS minute_bucket,
+        user_id,
+        token_id,
+        COUNT(*) AS request_count,
+        COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
+        COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+        COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
+        COALESCE(SUM(quota), 0) AS quota_sum
+    FROM logs
+    WHERE created_at >= %s
+      AND created_at < %s
+    GROUP BY minute_bucket, user_id, token_id
+"""
+
+# 单请求Token数分布SQL：按小时、模型统计每个DDSketch对数分桶的请求数（桶索引在MySQL中计算，
+# 第一个参数为 ln(γ)），输出行数只与模型数和分桶数有关；全局维度由各模型的草图合并得到
+TOKEN_SIZE_QUERY = """
+    SELECT
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+        COALESCE(model_name, '') AS model_name,
+        CASE WHEN COALESCE(prompt_tokens + completion_tokens, 0) > 0
+             THEN CEIL(LN(prompt_tokens + completion_tokens) / %s) END AS token_bin,
+        COUNT(*) AS request_count
+    FROM logs
+    WHERE id > %s
+      AND id <= %s
+      AND created_at >= %s
+      AND created_at < %s
+    GROUP BY hour_bucket, COALESCE(model_name, ''), token_bin
+"""
+
+MAX_LOG_ID_QUERY = "SELECT COALESCE(MAX(id), 0) AS max_id FROM logs"
+
+# 增量快照上界：新增id区间内、写入时间不早于快照时刻的日志的最小id（按主键范围扫描）
+RECENT_LOG_ID_QUERY = """
+    SELECT MIN(id) AS min_id
+    FROM logs
+    WHERE id > %s
+      AND id <= %s
+      AND created_at >= %s
+"""
+
+# 迟到日志检测SQL：本轮新增id区间内、时间早于已定稿边界的日志所在小时（按主键范围扫描）
+LATE_LOGS_QUERY = """
+    SELECT
+        DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
+        COUNT(*) AS late_logs,
+        MAX(id) AS max_id
+    FROM logs
+    WHERE id > %s
+      AND id <= %s
+      AND created_at >= %s
+      AND created_at < %s
+    GROUP BY hour_bucket
+"""
+
+# 天级聚合由小时级聚合表汇总得到（读取聚合表，不读取logs）
+# 可加指标在Python中求和，去重计数由各小时的HLL草图取并集估算
+DAILY_SOURCE_QUERY = """
+    SELECT
+        DATE_FORMAT(hour_bucket, '%%Y-%%m-%%d 00:00:00') AS day_bucket,
+        dim,
+        user_id,
+        model_name,
+        channel_id,
+        token_id,
+        request_count,
+        total_tokens,
+        prompt_tokens,
+        completion_tokens,
+        quota_sum,
+        unique_users,
+        unique_tokens,
+        users_sketch,
+        tokens_sketch,
+        tokens_qsketch
+    FROM agg_usage_hourly
+    WHERE hour_bucket >= %s
+      AND hour_bucket < %s
+"""
+
+# 按唯一键读取已有聚合行的草图，用于增量写入前合并；只读取本批涉及的键，
+# 开销随本批日志的分组数增长，与该小时已有的分组数无关
+HOURLY_SKETCH_QUERY = """
+    SELECT hour_bucket, dim, user_id, model_name, channel_id, token_id, users_sketch, tokens_sketch, tokens_qsketch
+    FROM agg_usage_hourly
+    WHERE (hour_bucket, dim, user_id, model_name, channel_id, token_id) IN ({placeholders})
+"""
+
+# 每条草图查询的唯一键数量上限
+SKETCH_LOOKUP_BATCH = 500
+
+MINUTE_SKETCH_QUERY = """
+    SELECT minute_bucket, users_sketch, tokens_sketch
+    FROM agg_usage_minute
+    WHERE minute_bucket IN ({placeholders})
+"""
+
+# 聚合指标列；前五项可直接累加，去重计数无法相加
+METRIC_COLUMNS = (
+    "request_count", "total_tokens", "prompt_tokens", "completion_tokens",
+    "quota_sum", "unique_users", "unique_tokens",
+)
+ADDITIVE_METRIC_COLUMNS = METRIC_COLUMNS[:5]
+
+# 去重计数列与对应的HLL草图列
+SKETCH_COLUMNS = {
+    "unique_users": "users_sketch",
+    "unique_tokens": "tokens_sketch",
+}
+VALUE_COLUMNS = METRIC_COLUMNS + tuple(SKETCH_COLUMNS.values())
+
+# 单请求Token数分位数草图列（DDSketch），小时级与天级的全局、模型维度保存，分钟级不保存
+QUANTILE_COLUMN = "tokens_qsketch"
+QUANTILE_DIMENSIONS = ("global", "model")
+HOURLY_VALUE_COLUMNS = VALUE_COLUMNS + (QUANTILE_COLUMN,)
+
+HOURLY_KEY_COLUMNS = ("hour_bucket", "dim", "user_id", "model_name", "channel_id", "token_id")
+MINUTE_KEY_COLUMNS = ("minute_bucket",)
+DAILY_KEY_COLUMNS = ("day_bucket", "dim", "user_id", "model_name", "channel_id", "token_id")
+
+
+def build_upsert_sql(table: str, key_columns: tuple, additive: bool = False,
+                     value_columns: tuple = VALUE_COLUMNS) -> str:
+    """生成聚合表的 INSERT ... ON DUPLICATE KEY UPDATE 语句
+
+    additive 为 False 时覆盖写入（整体重算）；为 True 时可加指标累加，
+    去重计数与草图覆盖为写入前已在Python中与已有草图合并的结果（增量写入）。
+    """
+    columns = key_columns + value_columns
+    updates = []
+    for column in value_columns:
+        if additive and column in ADDITIVE_METRIC_COLUMNS:
+            updates.append(f"{column} = {column} + VALUES({column})")
+        else:
+            updates.append(f"{column} = VALUES({column})")
+    updates.append("updated_at = CURRENT_TIMESTAMP")
+
+    # {values} 由 bulk_upsert_agg 替换为多行值列表
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES {{values}} "
+        f"ON DUPLICATE KEY UPDATE {', '.join(updates)}"
+    )
+
+
+UPSERT_SQL = build_upsert_sql("agg_usage_hourly", HOURLY_KEY_COLUMNS, value_columns=HOURLY_VALUE_COLUMNS)
+UPSERT_ADDITIVE_SQL = build_upsert_sql("agg_usage_hourly", HOURLY_KEY_COLUMNS, additive=True,
+                                       value_columns=HOURLY_VALUE_COLUMNS)
+MINUTE_UPSERT_SQL = build_upsert_sql("agg_usage_minute", MINUTE_KEY_COLUMNS)
+MINUTE_UPSERT_ADDITIVE_SQL = build_upsert_sql("agg_usage_minute", MINUTE_KEY_COLUMNS, additive=True)
+DAILY_UPSERT_SQL = build_upsert_sql("agg_usage_daily", DAILY_KEY_COLUMNS, value_columns=HOURLY_VALUE_COLUMNS)
+
+# 聚合检查点名称（agg_checkpoints 表）：小时级每个维度一个时间水位，分钟级与天级各一个时间水位，
+# 增量聚合一个logs.id水位。检查点与对应分块的聚合数据在同一事务中提交，重试或重启只重做未完成的部分
+LOG_ID_CHECKPOINT = "incremental:log_id"
+# 分钟级：已定稿（以完整快照覆盖写入）的小时边界；天级：已由小时级汇总的时间边界
+MINUTE_CHECKPOINT = "minute"
+DAILY_CHECKPOINT = "daily"
+
+
+def hourly_checkpoint(dim: str) -> str:
+    """小时级某维度的检查点名称"""
+    return f"hourly:{dim}"
+
+
+def dimension_keys(result: Dict[str, Any], dim: str) -> List[Any]:
+    """按 DIMENSION_SENTINELS 的顺序返回维度字段值，非该维度的字段取哨兵值"""
+    fields = AGG_DIMENSIONS[dim]
+    keys = []
+    for field, sentinel in DIMENSION_SENTINELS.items():
+        value = result.get(field) if field in fields else None
+        # 非该维度或维度值本身为NULL时写入哨兵值，避免唯一键失效
+        keys.append(sentinel if value is None else value)
+    return keys
+
+
+def merge_sketch_columns(result: Dict[str, Any], existing: Dict[str, Any]):
+    """将已有聚合行的草图并入结果，并以合并后的估算值更新去重计数"""
+    for count_column, sketch_column in SKETCH_COLUMNS.items():
+        if not existing.get(sketch_column) or not result.get(sketch_column):
+            continue
+        merged = HyperLogLog.from_bytes(existing[sketch_column])
+        merged.merge(HyperLogLog.from_bytes(result[sketch_column]))
+        result[count_column] = merged.cardinality()
+        result[sketch_column] = merged.to_bytes()
+
+    # 分位数草图的桶计数可直接相加；本批没有草图时保留已有草图
+    if existing.get(QUANTILE_COLUMN):
+        if result.get(QUANTILE_COLUMN):
+            merged = DDSketch.from_bytes(existing[QUANTILE_COLUMN])
+            merged.merge(DDSketch.from_bytes(result[QUANTILE_COLUMN]))
+            result[QUANTILE_COLUMN] = merged.to_bytes()
+        else:
+            result[QUANTILE_COLUMN] = existing[QUANTILE_COLUMN]
+
+
+class QuantileFolder:
+    """分位数折叠器：累计 TOKEN_SIZE_QUERY 的分桶计数，按小时得到全局与模型维度的DDSketch"""
+
+    def __init__(self):
+        self.gamma = (1 + settings.quantile_relative_accuracy) / (1 - settings.quantile_relative_accuracy)
+        self._sketches: Dict[tuple, DDSketch] = {}
+
+    def add(self, rows: List[Dict[str, Any]]):
+        """累计一批分桶计数"""
+        for row in rows:
+            index = int(row["token_bin"]) if row["token_bin"] is not None else None
+            for dim in QUANTILE_DIMENSIONS:
+                key = (str(row["hour_bucket"]), dim, *dimension_keys(row, dim))
+                sketch = self._sketches.get(key)
+                if sketch is None:
+                    sketch = self._sketches[key] = DDSketch(gamma=self.gamma)
+                sketch.add_bin(index, int(row["request_count"]))
+
+    def attach(self, folded: Dict[str, List[Dict[str, Any]]]):
+        """将草图写入折叠结果中对应的全局与模型维度行"""
+        for dim in QUANTILE_DIMENSIONS:
+            for result in folded.get(dim, ()):
+                sketch = self._sketches.get((str(result["hour_bucket"]), dim, *dimension_keys(result, dim)))
+                result[QUANTILE_COLUMN] = sketch.to_bytes() if sketch is not None else None
+
+
+class DimensionFolder:
+    """维度折叠器：分批接收最细粒度分组结果，在内存中累计各维度的聚合
+
+    配合 stream_query_ro 使用时无需在内存中保留全部原始分组行，
+    内存占用只与折叠后的聚合结果数量有关。
+    """
+
+    def __init__(self, bucket_field: str = "hour_bucket", dimensions: Optional[Dict[str, tuple]] = None):
+        self.bucket_field = bucket_field
+        self.dimensions = AGG_DIMENSIONS if dimensions is None else dimensions
+        self.scanned_groups = 0
+        self.aggregated_logs = 0
+        self._buckets: Dict[str, Dict[tuple, Dict[str, Any]]] = {dim: {} for dim in self.dimensions}
+
+    def add(self, rows: List[Dict[str, Any]]):
+        """累计一批分组结果"""
+        bucket_field = self.bucket_field
+        for row in rows:
+            self.scanned_groups += 1
+            self.aggregated_logs += row["request_count"]
+            for dim, fields in self.dimensions.items():
+                key = (row[bucket_field],) + tuple(row[field] for field in fields)
+                bucket = self._buckets[dim].get(key)
+                if bucket is None:
+                    bucket = {bucket_field: row[bucket_field]}
+                    for field in fields:
+                        bucket[field] = row[field]
+                    bucket.update(request_count=0, total_tokens=0, prompt_tokens=0,
+                                  completion_tokens=0, quota_sum=0, users=set(), tokens=set())
+                    self._buckets[dim][key] = bucket
+
+                bucket["request_count"] += row["request_count"]
+                bucket["total_tokens"] += row["total_tokens"]
+                bucket["prompt_tokens"] += row["prompt_tokens"]
+                bucket["completion_tokens"] += row["completion_tokens"]
+                bucket["quota_sum"] += row["quota_sum"]
+                bucket["users"].add(row["user_id"])
+                bucket["tokens"].add(row["token_id"])
+
+    def results(self) -> Dict[str, List[Dict[str, Any]]]:
+        """返回 {维度名: 聚合结果列表}，调用后折叠器不再可用"""
+        folded = {}
+        for dim, dim_buckets in self._buckets.items():
+            results = []
+            for bucket in dim_buckets.values():
+                users = bucket.pop("users")
+                tokens = bucket.pop("tokens")
+                # 与分维度SQL的COUNT(DISTINCT)语义保持一致，不计NULL
+                bucket["unique_users"] = len(users - {None})
+                bucket["unique_tokens"] = len(tokens - {None})
+                bucket["users_sketch"] = HyperLogLog.from_values(users, settings.hll_precision).to_bytes()
+                bucket["tokens_sketch"] = HyperLogLog.from_values(tokens, settings.hll_precision).to_bytes()
+                results.append(bucket)
+            folded[dim] = results
+        self._buckets = {}
+        return folded
+
+
+def fold_dimension_rows(rows: List[Dict[str, Any]],
+                        bucket_field: str = "hour_bucket",
+                        dimensions: Optional[Dict[str, tuple]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """将最细粒度分组结果折叠为各维度的聚合结果
+
+    bucket_field 为时间桶字段（小时级或分钟级），dimensions 默认为 AGG_DIMENSIONS。
+    返回 {维度名: 聚合结果列表}，结果字段与 DIMENSION_QUERIES 的输出一致，
+    另附用户与Token的HLL草图（users_sketch、tokens_sketch）。
+    """
+    folder = DimensionFolder(bucket_field, dimensions)
+    folder.add(rows)
+    return folder.results()
+
 
 class DataAggregator:
     """数据聚合器"""
     
     def __init__(self):
-        self.batch_size = 1000  # 批量处理大小
+        self.batch_size = 1000  # 流式读取的每批行数（写入按语句字节数切分）
     
     async def aggregate_hourly_data(self, hours_back: int = 2):
-        """聚合小时级数据"""
+        """聚合小时级数据
+
+        每个维度从自己的检查点继续，逐小时写入并在同一事务中推进检查点，
+        某个维度失败时已完成的维度与小时不会被重做。
+        """
         try:
-            # 获取最后聚合时间
-            last_time = await get_last_aggregation_time()
+            cycle_started = time.perf_counter()
+            timings = StageTimings()
+            watermarks, _, tier_watermarks = await self._load_watermarks(hours_back)
 
             # 计算聚合时间范围
             current_time = datetime.now()
             end_time = current_time.replace(minute=0, second=0, microsecond=0)
+            start_time = min(watermarks.values())
+            daily_from = tier_watermarks[DAILY_CHECKPOINT]
 
-            if last_time:
-                start_time = datetime.fromisoformat(last_time)
-                # 如果最后聚合时间就是当前小时，跳过
-                if start_time >= end_time:
-                    logger.debug("无需聚合数据", last_time=last_time, end_time=end_time.isoformat())
-                    return
-            else:
-                # 首次运行，聚合过去几小时的数据
-                start_time = end_time - timedelta(hours=hours_back)
-            
-            logger.info("开始聚合小时级数据", 
-                       start_time=start_time.isoformat(),
-                       end_time=end_time.isoformat())
-            
-            # 聚合全局数据
-            await self._aggregate_global_hourly(start_time, end_time)
-            
-            # 聚合用户维度数据
-            await self._aggregate_user_hourly(start_time, end_time)
-            
-            # 聚合模型维度数据
-            await self._aggregate_model_hourly(start_time, end_time)
+            # 所有维度与天级汇总都已完成到当前小时，跳过
+            if start_time >= end_time and daily_from >= end_time:
+                logger.debug("无需聚合数据", start_time=start_time.isoformat(), end_time=end_time.isoformat())
+                return
             
-            # 聚合通道维度数据
-            await self._aggregate_channel_hourly(start_time, end_time)
-            
-            # 更新最后聚合时间
+            # 各维度已完成时只补上一轮失败的天级汇总
+            if start_time < end_time:
+                logger.info("开始聚合小时级数据", 
+                           start_time=start_time.isoformat(),
+                           end_time=end_time.isoformat(),
+                           watermarks={dim: t.isoformat() for dim, t in watermarks.items()})
+
+                if settings.aggregation_single_pass:
+                    # 单次扫描产出全部维度
+                    await self._aggregate_single_pass_hourly(start_time, end_time, watermarks=watermarks,
+                                                             minute_watermark=tier_watermarks[MINUTE_CHECKPOINT],
+                                                             timings=timings)
+                else:
+                    # 逐维度聚合：各维度的检查点相互独立，多个维度的流水线并行运行；
+                    # 每条流水线的写入阶段占用一个聚合连接，留出一个连接给其他写入
+                    concurrency = max(1, min(settings.aggregation_pipeline_concurrency,
+                                             MYSQL_POOL_AGG_MAXSIZE - 1))
+                    semaphore = asyncio.Semaphore(concurrency)
+
+                    async def run_dimension(dim: str):
+                        async with semaphore:
+                            await self._aggregate_dimension_hourly(dim, watermarks[dim], end_time, timings)
+
+                    pending = [dim for dim in AGG_DIMENSIONS if watermarks[dim] < end_time]
+                    results = await asyncio.gather(*(run_dimension(dim) for dim in pending),
+                                                   return_exceptions=True)
+                    failed = {dim: r for dim, r in zip(pending, results) if isinstance(r, Exception)}
+                    if failed:
+                        for dim, error in failed.items():
+                            logger.error("维度小时级数据聚合失败", dim=dim, error=str(error))
+                        raise next(iter(failed.values()))
+
+            # 从天级检查点汇总到全部维度已完成的小时，上一轮汇总失败的部分一并补上
+            if daily_from < end_time:
+                await self._rollup_daily(daily_from, end_time, timings, checkpoint=True)
+
+            # 同步最后聚合时间到Redis，供API判断聚合表覆盖范围
             await set_last_aggregation_time(end_time.isoformat())
             
-            logger.info("小时级数据聚合完成")
+            logger.info("小时级数据聚合完成",
+                       cycle_ms=round((time.perf_counter() - cycle_started) * 1000, 2),
+                       stages=timings.summary())
             
         except Exception as e:
             logger.error("小时级数据聚合失败", error=str(e))
             raise
     
-    async def _aggregate_global_hourly(self, start_time: datetime, end_time: datetime):
-        """聚合全局小时级数据"""
-        # 转换为Unix时间戳
-        start_timestamp = int(start_time.timestamp())
-        end_timestamp = int(end_time.timestamp())
-
-        sql_query = """
-            SELECT
-                DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
-                COUNT(*) AS request_count,
-                COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
-                COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
-                COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
-                COALESCE(SUM(quota), 0) AS quota_sum,
-                COUNT(DISTINCT user_id) AS unique_users,
-                COUNT(DISTINCT token_id) AS unique_tokens
-            FROM logs
-            WHERE created_at >= %s
-              AND created_at < %s
-            GROUP BY hour_bucket
-            ORDER BY hour_bucket
+    async def _load_watermarks(self, hours_back: int) -> Tuple[Dict[str, datetime], Optional[int],
+                                                                Dict[str, datetime]]:
+        """读取各维度的小时级时间水位、增量聚合的logs.id水位，以及分钟级与天级的时间水位
+
+        以 agg_checkpoints 表为准；表中没有记录时回退到Redis中的旧水位（升级前写入），
+        仍没有时从 hours_back 小时前开始。分钟级与天级没有记录时取各维度水位的最小值，
+        升级后不会为此重扫历史。
         """
-        
-        results = await execute_query_ro(sql_query, [start_timestamp, end_timestamp])
-        
-        if results:
-            await self._upsert_aggregation_data(results, None, None, None)
-            logger.info("全局小时级数据聚合完成", records=len(results))
-    
-    async def _aggregate_user_hourly(self, start_time: datetime, end_time: datetime):
-        """聚合用户维度小时级数据"""
-        # 转换为Unix时间戳
-        start_timestamp = int(start_time.timestamp())
-        end_timestamp = int(end_time.timestamp())
-
-        sql_query = """
-            SELECT
-                DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
-                user_id,
-                COUNT(*) AS request_count,
-                COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
-                COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
-                COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
-                COALESCE(SUM(quota), 0) AS quota_sum,
-                1 AS unique_users,
-                COUNT(DISTINCT token_id) AS unique_tokens
-            FROM logs
-            WHERE created_at >= %s
-              AND created_at < %s
-            GROUP BY hour_bucket, user_id
-            ORDER BY hour_bucket, user_id
+        checkpoints = await get_checkpoints()
+
+        fallback_time = None
+        if any(hourly_checkpoint(dim) not in checkpoints for dim in AGG_DIMENSIONS):
+            last_time = await get_last_aggregation_time()
+            if last_time:
+                fallback_time = datetime.fromisoformat(last_time)
+            else:
+                current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+                fallback_time = current_hour - timedelta(hours=hours_back)
+
+        watermarks = {}
+        for dim in AGG_DIMENSIONS:
+            checkpoint = checkpoints.get(hourly_checkpoint(dim))
+            watermarks[dim] = checkpoint["watermark_time"] if checkpoint else fallback_time
+
+        checkpoint = checkpoints.get(LOG_ID_CHECKPOINT)
+        if checkpoint and checkpoint["watermark_id"] is not None:
+            last_log_id = int(checkpoint["watermark_id"])
+        else:
+            last_log_id = await get_last_aggregated_log_id()
+
+        tier_watermarks = {}
+        for name in (MINUTE_CHECKPOINT, DAILY_CHECKPOINT):
+            checkpoint = checkpoints.get(name)
+            tier_watermarks[name] = checkpoint["watermark_time"] if checkpoint else min(watermarks.values())
+
+        return watermarks, last_log_id, tier_watermarks
+
+    async def _snapshot_log_id(self, last_log_id: int, snapshot_time: datetime) -> int:
+        """增量聚合的logs.id快照上界
+
+        增量聚合假设id按顺序提交：id不超过水位的日志都已可见。但AUTO_INCREMENT在事务开始写入时
+        分配，较小id的事务可能晚于较大id的事务提交；以 MAX(id) 为快照时，晚提交的日志id低于
+        下一轮的水位，增量读取与迟到日志检测都按id区间扫描，这些日志将不会被聚合。
+        因此快照只取写入时间早于 snapshot_time 的日志：上界为新增id区间内写入时间不早于
+        snapshot_time 的最小id减一，给未提交的事务留出 INCREMENTAL_ID_LAG_SECONDS 的提交时间。
+        事务持续时间超过该值时仍会漏计，可按日志写入事务的最长耗时调大；为0时退化为 MAX(id)。
         """
-        
-        results = await execute_query_ro(sql_query, [start_timestamp, end_timestamp])
-        
-        if results:
-            await self._upsert_aggregation_data(results, "user_id", None, None)
-            logger.info("用户维度小时级数据聚合完成", records=len(results))
-    
-    async def _aggregate_model_hourly(self, start_time: datetime, end_time: datetime):
-        """聚合模型维度小时级数据"""
-        # 转换为Unix时间戳
-        start_timestamp = int(start_time.timestamp())
-        end_timestamp = int(end_time.timestamp())
-
-        sql_query = """
-            SELECT
-                DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
-                model_name,
-                COUNT(*) AS request_count,
-                COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
-                COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
-                COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
-                COALESCE(SUM(quota), 0) AS quota_sum,
-                COUNT(DISTINCT user_id) AS unique_users,
-                COUNT(DISTINCT token_id) AS unique_tokens
-            FROM logs
-            WHERE created_at >= %s
-              AND created_at < %s
-            GROUP BY hour_bucket, model_name
-            ORDER BY hour_bucket, model_name
+        result = await execute_query_ro(MAX_LOG_ID_QUERY)
+        max_log_id = int(result[0]["max_id"]) if result else 0
+        if settings.incremental_id_lag_seconds <= 0 or max_log_id <= last_log_id:
+            return max_log_id
+
+        result = await execute_query_ro(
+            RECENT_LOG_ID_QUERY, [last_log_id, max_log_id, int(snapshot_time.timestamp())]
+        )
+        recent_min_id = result[0]["min_id"] if result else None
+        if recent_min_id is None:
+            return max_log_id
+        return int(recent_min_id) - 1
+
+    async def aggregate_incremental(self, hours_back: int = 2):
+        """按logs.id高水位增量聚合，覆盖当前未结束的小时
+
+        - 已结束但未定稿的小时：以本轮快照的最大id为上界整体重算一次（覆盖写），此后不再重算
+        - 当前小时：只读取上轮高水位之后的新增日志，以增量方式累加到当前小时的聚合行
+        - 分钟级聚合：新增日志同时按分钟累加到分钟级全局聚合表
+        - 天级聚合：定稿小时后由小时级聚合表汇总
+        聚合成本与新增日志量成正比，而与小时内的总日志量无关。
         """
-        
-        results = await execute_query_ro(sql_query, [start_timestamp, end_timestamp])
-        
-        if results:
-            await self._upsert_aggregation_data(results, None, "model_name", None)
-            logger.info("模型维度小时级数据聚合完成", records=len(results))
-    
-    async def _aggregate_channel_hourly(self, start_time: datetime, end_time: datetime):
-        """聚合通道维度小时级数据"""
-        # 转换为Unix时间戳
-        start_timestamp = int(start_time.timestamp())
-        end_timestamp = int(end_time.timestamp())
-
-        sql_query = """
-            SELECT
-                DATE_FORMAT(FROM_UNIXTIME(created_at), '%%Y-%%m-%%d %%H:00:00') AS hour_bucket,
-                channel_id,
-                COUNT(*) AS request_count,
-                COALESCE(SUM(prompt_tokens + completion_tokens), 0) AS total_tokens,
-                COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
-                COALESCE(SUM(completion_tokens), 0) AS completion_tokens,
-                COALESCE(SUM(quota), 0) AS quota_sum,
-                COUNT(DISTINCT user_id) AS unique_users,
-                COUNT(DISTINCT token_id) AS unique_tokens
-            FROM logs
-            WHERE created_at >= %s
-              AND created_at < %s
-            GROUP BY hour_bucket, channel_id
-            ORDER BY hour_bucket, channel_id
+        try:
+            cycle_started = time.perf_counter()
+            timings = StageTimings()
+
+            watermarks, last_log_id, tier_watermarks = await self._load_watermarks(hours_back)
+
+            # 本轮快照上界，保证定稿与增量读取看到同一批日志；快照时刻比当前时间滞后
+            # INCREMENTAL_ID_LAG_SECONDS，当前小时与定稿边界都以快照时刻为准
+            snapshot_time = datetime.now() - timedelta(seconds=settings.incremental_id_lag_seconds)
+            max_log_id = await self._snapshot_log_id(last_log_id or 0, snapshot_time)
+            finalized_until = min(watermarks.values())
+            # 分钟级定稿落后时（如上一轮写入失败），从分钟级水位开始定稿，早于分钟级保留期的部分不再补写
+            minute_retention_start = datetime.now() - timedelta(days=settings.minute_retention_days)
+            minute_from = max(tier_watermarks[MINUTE_CHECKPOINT],
+                              minute_retention_start.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1))
+            finalize_from = min(finalized_until, minute_from)
+
+            current_hour = snapshot_time.replace(minute=0, second=0, microsecond=0)
+            next_hour = current_hour + timedelta(hours=1)
+
+            if last_log_id is None:
+                # 首次运行：按分钟粒度整体重算未定稿的时间范围，作为增量基线
+                logger.info("初始化增量聚合基线",
+                           start_time=finalized_until.isoformat(),
+                           end_time=next_hour.isoformat(),
+                           max_log_id=max_log_id)
+                hourly = DimensionFolder()
+                minutely = DimensionFolder("minute_bucket", {"global": ()})
+                async for batch in stream_query_ro(
+                    INCREMENTAL_QUERY,
+                    [0, max_log_id, int(finalized_until.timestamp()), int(next_hour.timestamp())],
+                    self.batch_size
+                ):
+                    hourly.add(batch)
+                    minutely.add(batch)
+                quantiles = await self._fold_token_sizes(0, max_log_id, finalized_until, next_hour)
+
+                # 基线数据与全部检查点一起提交，已结束的小时同时定稿
+                checkpoints = {hourly_checkpoint(dim): (current_hour, None) for dim in AGG_DIMENSIONS}
+                checkpoints[MINUTE_CHECKPOINT] = (current_hour, None)
+                checkpoints[LOG_ID_CHECKPOINT] = (None, max_log_id)
+                async with agg_transaction() as conn:
+                    if hourly.scanned_groups:
+                        folded = hourly.results()
+                        quantiles.attach(folded)
+                        await self._upsert_folded_rows(folded, conn=conn)
+                        await self._upsert_minute_rows(minutely.results()["global"], conn=conn)
+                    await set_checkpoints(conn, checkpoints)
+            else:
+                # 定稿已结束的小时，每小时与各维度及分钟级检查点一起提交
+                if finalize_from < current_hour:
+                    logger.info("定稿已结束小时的聚合数据",
+                               start_time=finalize_from.isoformat(),
+                               end_time=current_hour.isoformat(),
+                               max_log_id=max_log_id)
+                    await self._aggregate_single_pass_hourly(finalize_from, current_hour, max_log_id,
+                                                             watermarks=watermarks,
+                                                             minute_watermark=tier_watermarks[MINUTE_CHECKPOINT],
+                                                             timings=timings)
+
+                if max_log_id > last_log_id:
+                    # 已结束小时刚刚整体重算过，小时级只累加当前小时的增量
+                    current_bucket = current_hour.strftime("%Y-%m-%d %H:00:00")
+                    hourly = DimensionFolder()
+                    minutely = DimensionFolder("minute_bucket", {"global": ()})
+                    started = time.perf_counter()
+                    async for batch in stream_query_ro(
+                        INCREMENTAL_QUERY,
+                        [last_log_id, max_log_id, int(finalized_until.timestamp()), int(next_hour.timestamp())],
+                        self.batch_size
+                    ):
+                        # 已结束小时的分钟级数据也随定稿整体重写，同样只累加当前小时
+                        rows = [row for row in batch if row["hour_bucket"] >= current_bucket]
+                        hourly.add(rows)
+                        minutely.add(rows)
+                    quantiles = await self._fold_token_sizes(last_log_id, max_log_id, current_hour, next_hour)
+                    timings.add("delta_read", time.perf_counter() - started)
+
+                    # 同一id区间内落入已定稿小时的迟到日志，交由迟到日志重算任务处理；
+                    # 先于增量提交标记，提交失败时重复标记也只会多重算一次；标记失败时本轮不提交id水位
+                    await self._detect_late_logs(last_log_id, max_log_id, finalized_until)
+
+                    # 增量累加与id水位在同一事务中提交，失败重试不会重复累加
+                    started = time.perf_counter()
+                    async with agg_transaction() as conn:
+                        if hourly.scanned_groups:
+                            folded = hourly.results()
+                            quantiles.attach(folded)
+                            await self._upsert_folded_rows(folded, additive=True, conn=conn)
+                        if minutely.scanned_groups:
+                            await self._upsert_minute_rows(minutely.results()["global"], additive=True,
+                                                           conn=conn)
+                        await set_checkpoints(conn, {LOG_ID_CHECKPOINT: (None, max_log_id)})
+                    timings.add("delta_write", time.perf_counter() - started)
+
+                    logger.info("当前小时增量聚合完成",
+                               hour=current_hour.isoformat(),
+                               from_log_id=last_log_id,
+                               to_log_id=max_log_id,
+                               scanned_groups=minutely.scanned_groups)
+                else:
+                    logger.debug("无新增日志", last_log_id=last_log_id)
+
+            # 从天级检查点汇总到已定稿的小时，上一轮汇总失败的部分一并补上
+            if tier_watermarks[DAILY_CHECKPOINT] < current_hour:
+                await self._rollup_daily(tier_watermarks[DAILY_CHECKPOINT], current_hour, timings, checkpoint=True)
+
+            # 同步水位到Redis，供API判断聚合表覆盖范围
+            await set_last_aggregation_time(max(finalized_until, current_hour).isoformat())
+            await set_last_aggregated_log_id(max(max_log_id, last_log_id or 0))
+
+            logger.info("增量聚合周期完成",
+                       cycle_ms=round((time.perf_counter() - cycle_started) * 1000, 2),
+                       stages=timings.summary())
+
+        except Exception as e:
+            logger.error("增量聚合失败", error=str(e))
+            raise
+
+    async def _detect_late_logs(self, from_log_id: int, to_log_id: int, finalized_until: datetime):
+        """检测落入已定稿小时的迟到日志，将这些小时记为待重算
+
+        与增量聚合使用同一id区间，定稿时已包含的日志不会被重复标记；
+        早于小时级保留期的日志对应的聚合行已被清理，不再标记。
         """
-        
-        results = await execute_query_ro(sql_query, [start_timestamp, end_timestamp])
-        
-        if results:
-            await self._upsert_aggregation_data(results, None, None, "channel_id")
-            logger.info("通道维度小时级数据聚合完成", records=len(results))
+        retention_start = datetime.now() - timedelta(days=settings.hourly_retention_days)
+        late = await execute_query_ro(
+            LATE_LOGS_QUERY,
+            [from_log_id, to_log_id, int(retention_start.timestamp()), int(finalized_until.timestamp())]
+        )
+        if not late:
+            return
+
+        await add_dirty_hours({row["hour_bucket"]: int(row["max_id"]) for row in late})
+        logger.info("检测到迟到日志",
+                   hours={row["hour_bucket"]: row["late_logs"] for row in late},
+                   from_log_id=from_log_id,
+                   to_log_id=to_log_id)
+
+    async def recompute_dirty_hours(self, max_hours: Optional[int] = None):
+        """重算收到迟到日志的已定稿小时
+
+        每个小时以当前快照整体重算一次（覆盖写入），同时重写仍在保留期内的分钟级数据，
+        并重新汇总涉及到的天级聚合。成本与迟到日志涉及的小时数成正比。
+        """
+        dirty_hours = await get_dirty_hours(max_hours or settings.dirty_bucket_max_hours)
+        if not dirty_hours:
+            logger.debug("无待重算小时")
+            return
+
+        result = await execute_query_ro(MAX_LOG_ID_QUERY)
+        max_log_id = int(result[0]["max_id"]) if result else 0
+        minute_retention_start = datetime.now() - timedelta(days=settings.minute_retention_days)
+
+        for hour, _ in dirty_hours:
+            hour_start = datetime.fromisoformat(hour)
+            hour_end = hour_start + timedelta(hours=1)
+
+            # 一次扫描同时折叠小时级各维度与分钟级全局数据
+            hourly = DimensionFolder()
+            minutely = DimensionFolder("minute_bucket", {"global": ()})
+            async for batch in stream_query_ro(
+                INCREMENTAL_QUERY,
+                [0, max_log_id, int(hour_start.timestamp()), int(hour_end.timestamp())],
+                self.batch_size
+            ):
+                hourly.add(batch)
+                minutely.add(batch)
+
+            if hourly.scanned_groups:
+                folded = hourly.results()
+                (await self._fold_token_sizes(0, max_log_id, hour_start, hour_end)).attach(folded)
+                await self._upsert_folded_rows(folded)
+                if hour_start >= minute_retention_start:
+                    await self._upsert_minute_rows(minutely.results()["global"])
+                await self._rollup_daily(hour_start, hour_end)
+
+            await remove_dirty_hour(hour, max_log_id)
+            logger.info("迟到日志小时重算完成",
+                       hour=hour,
+                       aggregated_logs=hourly.aggregated_logs,
+                       max_log_id=max_log_id)
+
+        # 已定稿的小时被重写，使API缓存的封闭分段失效
+        await bump_aggregation_revision()
+
+    async def _fold_token_sizes(self, from_log_id: int, to_log_id: int,
+                                start_time: datetime, end_time: datetime) -> QuantileFolder:
+        """读取id区间与时间范围内单请求Token数的分桶计数，折叠为各小时的分位数草图"""
+        folder = QuantileFolder()
+        async for batch in stream_query_ro(
+            TOKEN_SIZE_QUERY,
+            [math.log(folder.gamma), from_log_id, to_log_id, int(start_time.timestamp()), int(end_time.timestamp())],
+            self.batch_size
+        ):
+            folder.add(batch)
+        return folder
+
+    async def _aggregate_single_pass_hourly(self, start_time: datetime, end_time: datetime,
+                                            max_log_id: Optional[int] = None,
+                                            watermarks: Optional[Dict[str, datetime]] = None,
+                                            minute_watermark: Optional[datetime] = None,
+                                            timings: Optional[StageTimings] = None):
+        """单次扫描聚合全部维度的小时级数据
+
+        逐小时读取一次logs，按最细粒度分组后在内存中折叠出全局、用户、模型、通道、Token维度，
+        避免同一小时的日志被分维度重复扫描。max_log_id 用于限定日志快照上界。
+        仍在分钟级保留期内的小时按分钟粒度读取，同一次扫描同时折叠并覆盖写入分钟级全局数据。
+        传入各维度的检查点 watermarks 时跳过已完成的维度，并在写入该小时的同一事务中推进检查点，
+        分钟级同样跳过 minute_watermark 之前已定稿的小时并推进分钟级检查点；
+        不传时只写数据（回填等不推进检查点的场景）。
+        读取与写入以流水线方式重叠：写入上一个小时的同时读取并折叠下一个小时。
+        返回聚合的日志行数。
+        """
+        if max_log_id is None:
+            result = await execute_query_ro(MAX_LOG_ID_QUERY)
+            max_log_id = int(result[0]["max_id"]) if result else 0
+
+        own_timings = timings is None
+        timings = timings or StageTimings()
+        minute_retention_start = datetime.now() - timedelta(days=settings.minute_retention_days)
+
+        async def read_hours():
+            hour_start = start_time
+            while hour_start < end_time:
+                hour_end = min(hour_start + timedelta(hours=1), end_time)
+                with_minutes = hour_start >= minute_retention_start and (
+                    minute_watermark is None or minute_watermark < hour_end)
+                if watermarks is None:
+                    pending = list(AGG_DIMENSIONS)
+                else:
+                    pending = [dim for dim in AGG_DIMENSIONS if watermarks[dim] < hour_end]
+                    if not pending and not with_minutes:
+                        hour_start = hour_end
+                        continue
+
+                # 分批流式读取分组结果并边读边折叠，内存中不保留原始分组行
+                folder = DimensionFolder(dimensions={dim: AGG_DIMENSIONS[dim] for dim in pending})
+                if with_minutes:
+                    minutely = DimensionFolder("minute_bucket", {"global": ()})
+                    query = INCREMENTAL_QUERY
+                    params = [0, max_log_id, int(hour_start.timestamp()), int(hour_end.timestamp())]
+                else:
+                    minutely = None
+                    query = SINGLE_PASS_QUERY
+                    params = [int(hour_start.timestamp()), int(hour_end.timestamp()), max_log_id]
+                async for batch in stream_query_ro(query, params, self.batch_size):
+                    folder.add(batch)
+                    if minutely is not None:
+                        minutely.add(batch)
+
+                folded = folder.results()
+                if any(dim in QUANTILE_DIMENSIONS for dim in pending):
+                    (await self._fold_token_sizes(0, max_log_id, hour_start, hour_end)).attach(folded)
+                minute_rows = minutely.results()["global"] if minutely is not None else []
+
+                yield (hour_start, hour_end, pending, folder.scanned_groups, folder.aggregated_logs,
+                       folded, with_minutes, minute_rows)
+                hour_start = hour_end
+
+        aggregated_logs = 0
+
+        async def write_hour(item):
+            nonlocal aggregated_logs
+            hour_start, hour_end, pending, scanned_groups, logs, folded, with_minutes, minute_rows = item
+            async with agg_transaction() as conn:
+                await self._upsert_folded_rows(folded, conn=conn)
+                await self._upsert_minute_rows(minute_rows, conn=conn)
+                if watermarks is not None:
+                    checkpoints = {hourly_checkpoint(dim): (hour_end, None) for dim in pending}
+                    if with_minutes:
+                        checkpoints[MINUTE_CHECKPOINT] = (hour_end, None)
+                    await set_checkpoints(conn, checkpoints)
+            aggregated_logs += logs
+
+            if scanned_groups:
+                logger.info("单次扫描小时级数据聚合完成",
+                           hour=hour_start.isoformat(),
+                           scanned_groups=scanned_groups,
+                           records={dim: len(results) for dim, results in folded.items()},
+                           minute_records=len(minute_rows))
+
+        await run_pipeline(read_hours(), write_hour, settings.aggregation_pipeline_queue_size,
+                           timings, "hourly_")
+
+        if own_timings:
+            logger.info("单次扫描流水线阶段耗时",
+                       start_time=start_time.isoformat(),
+                       end_time=end_time.isoformat(),
+                       stages=timings.summary())
+
+        return aggregated_logs
+
+    async def _upsert_folded_rows(self, folded: Dict[str, List[Dict[str, Any]]], additive: bool = False,
+                                  conn=None):
+        """写入折叠后的各维度聚合结果，conn 为事务连接时随事务提交"""
+        if additive:
+            # 增量写入前先合并已有聚合行的草图，去重计数才能跨批次保持准确
+            keys = [
+                (result["hour_bucket"], dim, *dimension_keys(result, dim))
+                for dim, results in folded.items() for result in results
+            ]
+            existing = await self._load_hourly_sketches(keys)
+            for dim, results in folded.items():
+                for result in results:
+                    key = (str(result["hour_bucket"]), dim, *dimension_keys(result, dim))
+                    if key in existing:
+                        merge_sketch_columns(result, existing[key])
+
+        for dim, results in folded.items():
+            await self._upsert_aggregation_data(results, dim, additive=additive, conn=conn)
+
+    async def _load_hourly_sketches(self, keys: List[tuple]) -> Dict[tuple, Dict[str, Any]]:
+        """按唯一键（HOURLY_KEY_COLUMNS 顺序）分批读取已有聚合行的草图，按唯一键索引"""
+        existing = {}
+        row_placeholder = f"({', '.join(['%s'] * len(HOURLY_KEY_COLUMNS))})"
+        for i in range(0, len(keys), SKETCH_LOOKUP_BATCH):
+            chunk = keys[i:i + SKETCH_LOOKUP_BATCH]
+            rows = await execute_query_ro(
+                HOURLY_SKETCH_QUERY.format(placeholders=", ".join([row_placeholder] * len(chunk))),
+                [value for key in chunk for value in key]
+            )
+            for row in rows:
+                key = (str(row["hour_bucket"]),) + tuple(row[column] for column in HOURLY_KEY_COLUMNS[1:])
+                existing[key] = row
+        return existing
+
+    async def _upsert_minute_rows(self, results: List[Dict[str, Any]], additive: bool = False, conn=None):
+        """写入按分钟折叠后的全局聚合数据"""
+        if additive and results:
+            minute_buckets = sorted({result["minute_bucket"] for result in results})
+            existing_rows = await execute_query_ro(
+                MINUTE_SKETCH_QUERY.format(placeholders=", ".join(["%s"] * len(minute_buckets))),
+                minute_buckets
+            )
+            existing = {str(row["minute_bucket"]): row for row in existing_rows}
+            for result in results:
+                if str(result["minute_bucket"]) in existing:
+                    merge_sketch_columns(result, existing[str(result["minute_bucket"])])
+
+        batch_data = [
+            [result["minute_bucket"]] + [result[column] for column in VALUE_COLUMNS]
+            for result in results
+        ]
+        await self._batch_upsert(MINUTE_UPSERT_ADDITIVE_SQL if additive else MINUTE_UPSERT_SQL, batch_data, conn)
+
+    async def _rollup_daily(self, start_time: datetime, end_time: datetime,
+                            timings: Optional[StageTimings] = None, checkpoint: bool = False):
+        """由小时级聚合表重算涉及到的整天的天级聚合
+
+        逐天读取小时级聚合行，可加指标求和，去重计数由小时草图取并集估算；
+        缺少草图的旧数据回退为按小时累加的去重计数。读取与合并下一天时同时写入上一天。
+        checkpoint 为 True 时每天的写入与天级检查点（推进到该天结束或 end_time）在同一事务中提交，
+        失败后下一轮从检查点所在的那一天继续；迟到日志重算等局部汇总不推进检查点。
+        开始时间早于小时级保留期的天，前面的小时已被清理，重新汇总会截断已有的天级数据，跳过不写。
+        """
+        day_start = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        day_end = end_time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if day_end < end_time:
+            day_end += timedelta(days=1)
+
+        own_timings = timings is None
+        timings = timings or StageTimings()
+        hourly_retention_start = datetime.now() - timedelta(days=settings.hourly_retention_days)
+
+        async def read_days():
+            day = day_start
+            while day < day_end:
+                next_day = day + timedelta(days=1)
+                if day < hourly_retention_start:
+                    logger.warning("天级汇总跳过已超出小时级保留期的一天",
+                                  day=day.date().isoformat(),
+                                  hourly_retention_start=hourly_retention_start.isoformat())
+                    yield min(next_day, end_time), []
+                    day = next_day
+                    continue
+
+                buckets: Dict[tuple, Dict[str, Any]] = {}
+                async for rows in stream_query_ro(DAILY_SOURCE_QUERY, [day, next_day], self.batch_size):
+                    for row in rows:
+                        key = tuple(row[column] for column in DAILY_KEY_COLUMNS)
+                        bucket = buckets.get(key)
+                        if bucket is None:
+                            bucket = {field: row[field] for field in DAILY_KEY_COLUMNS}
+                            bucket.update({column: 0 for column in METRIC_COLUMNS})
+                            bucket.update({column: None for column in SKETCH_COLUMNS.values()})
+                            bucket[QUANTILE_COLUMN] = None
+                            buckets[key] = bucket
+
+                        for column in METRIC_COLUMNS:
+                            bucket[column] += row[column] or 0
+                        for sketch_column in SKETCH_COLUMNS.values():
+                            if row[sketch_column]:
+                                sketch = HyperLogLog.from_bytes(row[sketch_column])
+                                if bucket[sketch_column] is None:
+                                    bucket[sketch_column] = sketch
+                                else:
+                                    bucket[sketch_column].merge(sketch)
+                        if row[QUANTILE_COLUMN]:
+                            sketch = DDSketch.from_bytes(row[QUANTILE_COLUMN])
+                            if bucket[QUANTILE_COLUMN] is None:
+                                bucket[QUANTILE_COLUMN] = sketch
+                            else:
+                                bucket[QUANTILE_COLUMN].merge(sketch)
+
+                batch_data = []
+                for bucket in buckets.values():
+                    for count_column, sketch_column in SKETCH_COLUMNS.items():
+                        sketch = bucket[sketch_column]
+                        if sketch is not None:
+                            bucket[count_column] = sketch.cardinality()
+                            bucket[sketch_column] = sketch.to_bytes()
+                    if bucket[QUANTILE_COLUMN] is not None:
+                        bucket[QUANTILE_COLUMN] = bucket[QUANTILE_COLUMN].to_bytes()
+                    batch_data.append([bucket[column] for column in DAILY_KEY_COLUMNS + HOURLY_VALUE_COLUMNS])
+
+                yield min(next_day, end_time), batch_data
+                day = next_day
+
+        total_records = 0
+
+        async def write_day(item):
+            nonlocal total_records
+            rolled_until, batch_data = item
+            if checkpoint:
+                async with agg_transaction() as conn:
+                    await self._batch_upsert(DAILY_UPSERT_SQL, batch_data, conn)
+                    await set_checkpoints(conn, {DAILY_CHECKPOINT: (rolled_until, None)})
+            else:
+                await self._batch_upsert(DAILY_UPSERT_SQL, batch_data)
+            total_records += len(batch_data)
+
+        await run_pipeline(read_days(), write_day, settings.aggregation_pipeline_queue_size,
+                           timings, "daily_")
+
+        logger.info("天级聚合汇总完成",
+                   start_day=day_start.date().isoformat(),
+                   end_day=day_end.date().isoformat(),
+                   records=total_records,
+                   **({"stages": timings.summary()} if own_timings else {}))
+
+    async def _aggregate_dimension_hourly(self, dim: str, start_time: datetime, end_time: datetime,
+                                          timings: Optional[StageTimings] = None):
+        """逐维度聚合小时级数据
+
+        按小时分块流式读取该维度的分组结果，每批结果读到即写入（覆盖写，重做幂等），内存中只保留一批；
+        一个小时的全部批次写完后，该小时的分钟级数据与维度检查点在同一事务中提交，
+        中途失败时检查点不前进，重试覆盖重写该小时。写入上一批的同时读取下一批。
+        全局维度同时重写仍在保留期内的分钟级数据。
+        """
+        timings = timings or StageTimings()
+        minute_retention_start = datetime.now() - timedelta(days=settings.minute_retention_days)
+
+        async def read_batches():
+            hour_start = start_time
+            while hour_start < end_time:
+                hour_end = min(hour_start + timedelta(hours=1), end_time)
+                params = [int(hour_start.timestamp()), int(hour_end.timestamp())]
+                # 分位数草图先于分组结果读取，逐批附加到对应的行；逐维度查询不限定logs.id上界，分布统计同样不限定
+                quantiles = None
+                if dim in QUANTILE_DIMENSIONS:
+                    quantiles = await self._fold_token_sizes(0, 2 ** 63 - 1, hour_start, hour_end)
+                hour_records = 0
+                async for results in stream_query_ro(DIMENSION_QUERIES[dim], params, self.batch_size):
+                    if quantiles is not None:
+                        quantiles.attach({dim: results})
+                    hour_records += len(results)
+                    yield None, results, []
+                minute_rows = []
+                if dim == "global" and hour_records and hour_start >= minute_retention_start:
+                    minutely = DimensionFolder("minute_bucket", {"global": ()})
+                    async for results in stream_query_ro(MINUTE_GLOBAL_QUERY, params, self.batch_size):
+                        minutely.add(results)
+                    minute_rows = minutely.results()["global"]
+                # 小时结束标记：提交分钟级数据与检查点
+                yield hour_end, [], minute_rows
+                hour_start = hour_end
+
+        records = 0
+
+        async def write_batch(item):
+            nonlocal records
+            hour_end, rows, minute_rows = item
+            if hour_end is None:
+                await self._upsert_aggregation_data(rows, dim)
+                records += len(rows)
+                return
+            async with agg_transaction() as conn:
+                await self._upsert_minute_rows(minute_rows, conn=conn)
+                checkpoints = {hourly_checkpoint(dim): (hour_end, None)}
+                if minute_rows:
+                    checkpoints[MINUTE_CHECKPOINT] = (hour_end, None)
+                await set_checkpoints(conn, checkpoints)
+
+        await run_pipeline(read_batches(), write_batch, settings.aggregation_pipeline_queue_size,
+                           timings, f"{dim}_")
+
+        logger.info("维度小时级数据聚合完成", dim=dim, records=records,
+                   start_time=start_time.isoformat(), end_time=end_time.isoformat())
     
     async def _upsert_aggregation_data(self, 
                                      results: List[Dict[str, Any]], 
-                                     user_id_field: Optional[str],
-                                     model_name_field: Optional[str],
-                                     channel_id_field: Optional[str]):
-        """插入或更新聚合数据"""
+                                     dim: str,
+                                     additive: bool = False,
+                                     conn=None):
+        """插入或更新聚合数据
+
+        dim 为 AGG_DIMENSIONS 中的维度名，非该维度的字段写入哨兵值。
+        additive 为 True 时以增量方式累加到已有聚合行（用于未结束小时），
+        否则覆盖写入（用于整体重算）。
+        """
         if not results:
             return
         
         # 使用ON DUPLICATE KEY UPDATE实现幂等插入
-        sql = """
-            INSERT INTO agg_usage_hourly (
-                hour_bucket, user_id, model_name, channel_id,
-                request_count, total_tokens, prompt_tokens, completion_tokens,
-                quota_sum, unique_users, unique_tokens
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-            ) ON DUPLICATE KEY UPDATE
-                request_count = VALUES(request_count),
-                total_tokens = VALUES(total_tokens),
-                prompt_tokens = VALUES(prompt_tokens),
-                completion_tokens = VALUES(completion_tokens),
-                quota_sum = VALUES(quota_sum),
-                unique_users = VALUES(unique_users),
-                unique_tokens = VALUES(unique_tokens),
-                updated_at = CURRENT_TIMESTAMP
-        """
+        sql = UPSERT_ADDITIVE_SQL if additive else UPSERT_SQL
         
         # 准备批量插入数据
         batch_data = []
         for result in results:
             data = [
                 result["hour_bucket"],
-                result.get(user_id_field) if user_id_field else None,
-                result.get(model_name_field) if model_name_field else None,
-                result.get(channel_id_field) if channel_id_field else None,
+                dim,
+                *dimension_keys(result, dim),
                 result["request_count"],
                 result["total_tokens"],
                 result["prompt_tokens"],
                 result["completion_tokens"],
                 result["quota_sum"],
                 result["unique_users"],
-                result["unique_tokens"]
+                result["unique_tokens"],
+                # 逐维度查询路径不产出去重草图，写入NULL
+                result.get("users_sketch"),
+                result.get("tokens_sketch"),
+                # 分位数草图仅全局与模型维度有
+                result.get(QUANTILE_COLUMN)
             ]
             batch_data.append(data)
         
-        # 分批插入
-        total_affected = 0
-        for i in range(0, len(batch_data), self.batch_size):
-            batch = batch_data[i:i + self.batch_size]
+        await self._batch_upsert(sql, batch_data, conn)
 
-            # 执行批量插入
-            affected_rows = await batch_insert_agg(sql, batch)
-            total_affected += affected_rows
+    async def _batch_upsert(self, sql: str, batch_data: List[List[Any]], conn=None):
+        """以多行语句批量写入聚合数据，并记录每批写入耗时"""
+        if not batch_data:
+            return
 
-            logger.debug("批量插入聚合数据",
-                        batch_size=len(batch),
-                        affected_rows=affected_rows)
+        started = time.perf_counter()
+        stats = await bulk_upsert_agg(sql, batch_data, conn=conn)
+        elapsed = time.perf_counter() - started
 
+        latencies = sorted(stats["batch_latencies_ms"])
         logger.info("聚合数据插入完成",
-                   total_records=len(batch_data),
-                   total_affected=total_affected)
+                   total_records=stats["rows"],
+                   total_affected=stats["affected_rows"],
+                   statements=stats["statements"],
+                   statement_bytes=stats["bytes"],
+                   elapsed_ms=round(elapsed * 1000, 2),
+                   rows_per_second=round(stats["rows"] / elapsed, 1) if elapsed > 0 else None,
+                   batch_latency_p50_ms=round(latencies[len(latencies) // 2], 2),
+                   batch_latency_max_ms=round(latencies[-1], 2))
     
-    async def cleanup_old_aggregation_data(self, days_to_keep: int = 90):
-        """清理旧的聚合数据"""
-        try:
-            cutoff_date = datetime.now() - timedelta(days=days_to_keep)
-            
-            sql = """
-                DELETE FROM agg_usage_hourly 
-                WHERE hour_bucket < %s
-            """
-            
-            affected_rows = await execute_query_agg(sql, [cutoff_date])
-            
-            logger.info("清理旧聚合数据完成", 
-                       cutoff_date=cutoff_date.isoformat(),
-                       deleted_rows=affected_rows)
-            
-        except Exception as e:
-            logger.error("清理旧聚合数据失败", error=str(e))
+    async def cleanup_old_aggregation_data(self) -> Dict[str, Dict[str, Any]]:
+        """按各聚合层级的保留期清理旧的聚合数据
+
+        按主键分块删除：每次选出最旧的一批id并按id删除，每块是一个短事务，
+        块之间暂停以让出锁与复制带宽；超过单次运行时长上限时停止，剩余数据留待下次清理。
+        返回各表的删除行数、块数与耗时。
+        """
+        retention_tiers = [
+            ("agg_usage_minute", "minute_bucket", settings.minute_retention_days),
+            ("agg_usage_hourly", "hour_bucket", settings.hourly_retention_days),
+            ("agg_usage_daily", "day_bucket", settings.daily_retention_days),
+        ]
+
+        started = time.perf_counter()
+        deadline = started + settings.retention_max_seconds
+        report = {}
+
+        for table, bucket_column, days_to_keep in retention_tiers:
+            try:
+                cutoff_date = datetime.now() - timedelta(days=days_to_keep)
+                table_started = time.perf_counter()
+                deleted_rows = 0
+                chunks = 0
+                completed = True
+
+                while True:
+                    if time.perf_counter() >= deadline:
+                        completed = False
+                        break
+
+                    rows = await execute_query_ro(
+                        f"SELECT id FROM {table} WHERE {bucket_column} < %s "
+                        f"ORDER BY {bucket_column} LIMIT %s",
+                        [cutoff_date, settings.retention_chunk_size]
+                    )
+                    if not rows:
+                        break
+
+                    ids = [row["id"] for row in rows]
+                    affected_rows = await execute_query_agg(
+                        f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                        ids
+                    )
+                    deleted_rows += affected_rows
+                    chunks += 1
+
+                    if len(ids) < settings.retention_chunk_size:
+                        break
+                    await asyncio.sleep(settings.retention_chunk_sleep_ms / 1000)
+
+                elapsed = time.perf_counter() - table_started
+                report[table] = {
+                    "deleted_rows": deleted_rows,
+                    "chunks": chunks,
+                    "elapsed_seconds": round(elapsed, 2),
+                    "completed": completed,
+                }
+
+                logger.info("清理旧聚合数据完成", 
+                           table=table,
+                           cutoff_date=cutoff_date.isoformat(),
+                           **report[table])
+                
+            except Exception as e:
+                logger.error("清理旧聚合数据失败", table=table, error=str(e))
+
+        logger.info("聚合数据保留期清理完成",
+                   deleted_rows=sum(r["deleted_rows"] for r in report.values()),
+                   elapsed_seconds=round(time.perf_counter() - started, 2))
+        return report
 
 
 # 全局数据聚合器实例
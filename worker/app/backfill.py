@@ -0,0 +1,192 @@
+"""历史数据回填模块
+
+将一段历史时间范围切分为按小时或按天的分片，以有限并发重算小时级聚合，
+每完成一个分片即记录进度，进程中断后重新执行同一命令会跳过已完成的分片。
+全部分片完成后由小时级聚合表重新汇总涉及到的天级聚合。
+
+用法:
+    python -m app.backfill --start 2024-01-01 --end 2024-04-01 --chunk day --concurrency 3
+
+回填只覆盖已结束的小时（结束时间截断到当前小时），当前小时仍由增量聚合任务负责；
+仍在分钟级保留期内的小时同时重写分钟级全局数据。重算为覆盖写入，重复执行不会重复计数。
+"""
+import argparse
+import asyncio
+import hashlib
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import structlog
+
+from app.config import settings
+from app.database import (
+    execute_query_ro, close_connections,
+    get_backfill_done_chunks, mark_backfill_chunk_done, clear_backfill_checkpoint,
+    bump_aggregation_revision
+)
+from app.aggregator import data_aggregator, MAX_LOG_ID_QUERY
+
+logger = structlog.get_logger()
+
+CHUNK_SIZES = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+
+
+def split_chunks(start_time: datetime, end_time: datetime, chunk: str) -> List[Tuple[datetime, datetime]]:
+    """将时间范围按小时或天切分为分片，首尾分片按边界截断"""
+    size = CHUNK_SIZES[chunk]
+    if chunk == "day":
+        chunk_start = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        chunk_start = start_time.replace(minute=0, second=0, microsecond=0)
+
+    chunks = []
+    while chunk_start < end_time:
+        chunk_end = chunk_start + size
+        chunks.append((max(chunk_start, start_time), min(chunk_end, end_time)))
+        chunk_start = chunk_end
+    return chunks
+
+
+def make_job_id(start_time: datetime, end_time: datetime, chunk: str) -> str:
+    """由回填参数生成任务ID，同一参数重复执行时复用进度"""
+    raw = f"{start_time.isoformat()}|{end_time.isoformat()}|{chunk}"
+    return hashlib.md5(raw.encode()).hexdigest()[:12]
+
+
+class BackfillRunner:
+    """历史数据回填执行器"""
+
+    def __init__(self, start_time: datetime, end_time: datetime, chunk: str = "day",
+                 concurrency: Optional[int] = None, job_id: Optional[str] = None):
+        # 只回填已结束的小时，当前小时由增量聚合负责
+        current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        self.start_time = start_time.replace(minute=0, second=0, microsecond=0)
+        self.end_time = min(end_time, current_hour)
+        self.chunk = chunk
+        self.concurrency = concurrency or settings.backfill_concurrency
+        # 任务ID取自原始参数，结束时间被截断到当前小时不影响断点续跑
+        self.job_id = job_id or make_job_id(start_time, end_time, chunk)
+
+        self.total_logs = 0
+        self.total_hours = 0.0
+        self.completed_chunks = 0
+        self.started_at = 0.0
+
+    async def run(self, restart: bool = False):
+        """执行回填，restart 为 True 时忽略已有进度从头开始"""
+        if self.start_time >= self.end_time:
+            logger.warning("回填时间范围为空",
+                          start_time=self.start_time.isoformat(),
+                          end_time=self.end_time.isoformat())
+            return
+
+        if restart:
+            await clear_backfill_checkpoint(self.job_id)
+
+        chunks = split_chunks(self.start_time, self.end_time, self.chunk)
+        done = await get_backfill_done_chunks(self.job_id)
+        pending = [c for c in chunks if c[0].isoformat() not in done]
+
+        # 本次回填的日志快照上界，所有分片看到同一批日志
+        result = await execute_query_ro(MAX_LOG_ID_QUERY)
+        max_log_id = int(result[0]["max_id"]) if result else 0
+
+        logger.info("开始回填历史聚合数据",
+                   job_id=self.job_id,
+                   start_time=self.start_time.isoformat(),
+                   end_time=self.end_time.isoformat(),
+                   chunk=self.chunk,
+                   total_chunks=len(chunks),
+                   pending_chunks=len(pending),
+                   concurrency=self.concurrency)
+
+        self.started_at = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_chunk(chunk_start: datetime, chunk_end: datetime):
+            async with semaphore:
+                await self._run_chunk(chunk_start, chunk_end, max_log_id, len(pending))
+
+        results = await asyncio.gather(
+            *(run_chunk(chunk_start, chunk_end) for chunk_start, chunk_end in pending),
+            return_exceptions=True
+        )
+        failed = [(chunk, r) for chunk, r in zip(pending, results) if isinstance(r, Exception)]
+        if failed:
+            for (chunk_start, _), error in failed:
+                logger.error("回填分片失败", job_id=self.job_id,
+                            chunk_start=chunk_start.isoformat(), error=str(error))
+            raise RuntimeError(f"{len(failed)} 个回填分片失败，重新执行同一命令将从断点继续")
+
+        # 全部小时完成后统一汇总天级聚合，避免并发分片读到不完整的小时数据
+        await data_aggregator._rollup_daily(self.start_time, self.end_time)
+        await bump_aggregation_revision()
+
+        elapsed = time.perf_counter() - self.started_at
+        logger.info("历史聚合数据回填完成",
+                   job_id=self.job_id,
+                   chunks=self.completed_chunks,
+                   hours=round(self.total_hours, 2),
+                   logs=self.total_logs,
+                   elapsed_seconds=round(elapsed, 2),
+                   rows_per_second=round(self.total_logs / elapsed, 1) if elapsed > 0 else None,
+                   hours_per_second=round(self.total_hours / elapsed, 3) if elapsed > 0 else None)
+
+        await clear_backfill_checkpoint(self.job_id)
+
+    async def _run_chunk(self, chunk_start: datetime, chunk_end: datetime, max_log_id: int, total: int):
+        """重算一个分片并记录进度"""
+        chunk_started = time.perf_counter()
+        logs = await data_aggregator._aggregate_single_pass_hourly(chunk_start, chunk_end, max_log_id)
+        await mark_backfill_chunk_done(self.job_id, chunk_start.isoformat())
+
+        hours = (chunk_end - chunk_start).total_seconds() / 3600
+        self.total_logs += logs
+        self.total_hours += hours
+        self.completed_chunks += 1
+
+        chunk_elapsed = time.perf_counter() - chunk_started
+        elapsed = time.perf_counter() - self.started_at
+        logger.info("回填分片完成",
+                   job_id=self.job_id,
+                   chunk_start=chunk_start.isoformat(),
+                   chunk_end=chunk_end.isoformat(),
+                   logs=logs,
+                   chunk_seconds=round(chunk_elapsed, 2),
+                   progress=f"{self.completed_chunks}/{total}",
+                   rows_per_second=round(self.total_logs / elapsed, 1) if elapsed > 0 else None,
+                   hours_per_second=round(self.total_hours / elapsed, 3) if elapsed > 0 else None)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='历史聚合数据回填')
+    parser.add_argument('--start', required=True, help='开始时间（ISO格式，如 2024-01-01 或 2024-01-01T08:00）')
+    parser.add_argument('--end', required=True, help='结束时间（ISO格式，不含）')
+    parser.add_argument('--chunk', choices=sorted(CHUNK_SIZES), default='day', help='分片粒度')
+    parser.add_argument('--concurrency', type=int, default=None, help='并发分片数，默认 BACKFILL_CONCURRENCY')
+    parser.add_argument('--job-id', default=None, help='任务ID，默认由时间范围与分片粒度生成')
+    parser.add_argument('--restart', action='store_true', help='忽略已有进度，从头开始回填')
+    args = parser.parse_args()
+
+    runner = BackfillRunner(
+        datetime.fromisoformat(args.start),
+        datetime.fromisoformat(args.end),
+        chunk=args.chunk,
+        concurrency=args.concurrency,
+        job_id=args.job_id,
+    )
+
+    try:
+        await runner.run(restart=args.restart)
+    finally:
+        await close_connections()
+
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=getattr(logging, settings.log_level.upper()))
+
+    asyncio.run(main())
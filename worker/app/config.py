@@ -37,6 +37,43 @@ class Settings(BaseSettings):
     
     # 任务调度配置
     aggregation_interval_minutes: int = int(os.getenv("AGGREGATION_INTERVAL_MINUTES", "5"))
+    # 单次扫描聚合模式，关闭时回退为逐维度查询
+    aggregation_single_pass: bool = os.getenv("AGGREGATION_SINGLE_PASS", "true").lower() == "true"
+    # 按logs.id高水位增量聚合（包含当前未结束的小时），关闭时仅聚合已结束的小时
+    aggregation_incremental: bool = os.getenv("AGGREGATION_INCREMENTAL", "true").lower() == "true"
+    # 增量快照滞后（秒）：只聚合写入时间早于该秒数的日志，给id较小但晚提交的日志写入事务留出提交时间
+    incremental_id_lag_seconds: int = int(os.getenv("INCREMENTAL_ID_LAG_SECONDS", "10"))
+    # 迟到日志重算：检查间隔与每轮最多重算的小时数
+    dirty_bucket_interval_minutes: int = int(os.getenv("DIRTY_BUCKET_INTERVAL_MINUTES", "15"))
+    dirty_bucket_max_hours: int = int(os.getenv("DIRTY_BUCKET_MAX_HOURS", "24"))
+    # 聚合写入单条多行语句的字节上限，0 表示按 max_allowed_packet 自动确定
+    agg_max_statement_bytes: int = int(os.getenv("AGG_MAX_STATEMENT_BYTES", "0"))
+    # 交叉维度聚合（cube）：逗号分隔，每项为冒号连接的基础维度（user/model/channel/token），
+    # 如 "user:model" 物化为维度 user_model，供API按一个维度过滤、按另一个维度排行或出时序
+    agg_cubes: str = os.getenv("AGG_CUBES", "user:model,channel:model")
+    # 聚合流水线：读取阶段最多提前准备的分块数，逐维度聚合时同时运行的维度数（受聚合写连接池大小限制）
+    aggregation_pipeline_queue_size: int = int(os.getenv("AGGREGATION_PIPELINE_QUEUE_SIZE", "2"))
+    aggregation_pipeline_concurrency: int = int(os.getenv("AGGREGATION_PIPELINE_CONCURRENCY", "2"))
+    # 历史回填并发分片数，受聚合写连接池大小（3）限制
+    backfill_concurrency: int = int(os.getenv("BACKFILL_CONCURRENCY", "3"))
+    # 去重计数HLL草图精度（4~15，受 BLOB 列长度限制），标准误差约 1.04/sqrt(2^p)；修改后新旧草图无法合并
+    hll_precision: int = int(os.getenv("HLL_PRECISION", "14"))
+    # 单请求Token数分位数草图（DDSketch）的相对误差；修改后新旧草图无法合并
+    quantile_relative_accuracy: float = float(os.getenv("QUANTILE_RELATIVE_ACCURACY", "0.01"))
+    
+    # 仪表盘默认视图预热：每轮聚合完成后调用API的 POST /cache/warm，地址或共享密钥（与API一致）为空时不预热
+    api_internal_url: str = os.getenv("API_INTERNAL_URL", "http://api:8080")
+    cache_warm_token: str = os.getenv("CACHE_WARM_TOKEN", "")
+    cache_warm_timeout_seconds: int = int(os.getenv("CACHE_WARM_TIMEOUT_SECONDS", "60"))
+    
+    # 聚合数据保留期（天），分钟级/小时级/天级各自独立
+    minute_retention_days: int = int(os.getenv("MINUTE_RETENTION_DAYS", "7"))
+    hourly_retention_days: int = int(os.getenv("HOURLY_RETENTION_DAYS", "90"))
+    daily_retention_days: int = int(os.getenv("DAILY_RETENTION_DAYS", "730"))
+    # 保留期清理按主键分块删除：每块行数、块间暂停（毫秒）、单次运行时长上限（秒）
+    retention_chunk_size: int = int(os.getenv("RETENTION_CHUNK_SIZE", "5000"))
+    retention_chunk_sleep_ms: int = int(os.getenv("RETENTION_CHUNK_SLEEP_MS", "100"))
+    retention_max_seconds: int = int(os.getenv("RETENTION_MAX_SECONDS", "1800"))
     burst_check_interval_minutes: int = int(os.getenv("BURST_CHECK_INTERVAL_MINUTES", "1"))
     multi_user_token_check_interval_minutes: int = int(os.getenv("MULTI_USER_TOKEN_CHECK_INTERVAL_MINUTES", "5"))
     ip_many_users_check_interval_minutes: int = int(os.getenv("IP_MANY_USERS_CHECK_INTERVAL_MINUTES", "5"))
@@ -1,7 +1,9 @@
 """数据库连接管理模块"""
+import time
+from contextlib import asynccontextmanager
 import aiomysql
 import redis.asyncio as redis
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Set, Tuple, AsyncIterator
 import structlog
 
 from .config import settings
@@ -12,6 +14,11 @@ logger = structlog.get_logger()
 _mysql_pool_ro: Optional[aiomysql.Pool] = None
 _mysql_pool_agg: Optional[aiomysql.Pool] = None
 _redis_client: Optional[redis.Redis] = None
+_max_allowed_packet: Optional[int] = None
+
+# 连接池大小，聚合流水线与回填的并发度以此为上限
+MYSQL_POOL_RO_MAXSIZE = 5
+MYSQL_POOL_AGG_MAXSIZE = 3
 
 
 async def get_mysql_pool_ro() -> aiomysql.Pool:
@@ -22,7 +29,7 @@ async def get_mysql_pool_ro() -> aiomysql.Pool:
         try:
             _mysql_pool_ro = await aiomysql.create_pool(
                 minsize=1,
-                maxsize=5,
+                maxsize=MYSQL_POOL_RO_MAXSIZE,
                 host=settings.db_host,
                 port=settings.db_port,
                 user=settings.db_user_ro,
@@ -48,7 +55,7 @@ async def get_mysql_pool_agg() -> aiomysql.Pool:
         try:
             _mysql_pool_agg = await aiomysql.create_pool(
                 minsize=1,
-                maxsize=3,
+                maxsize=MYSQL_POOL_AGG_MAXSIZE,
                 host=settings.db_host,
                 port=settings.db_port,
                 user=settings.db_user_agg,
@@ -119,14 +126,38 @@ async def execute_query_ro(sql: str, params: dict = None) -> List[Dict[str, Any]
         async with pool.acquire() as conn:
             async with conn.cursor(aiomysql.DictCursor) as cursor:
                 await cursor.execute(sql, params or {})
-                result = await cursor.fetchall()
-                return [dict(row) for row in result]
+                # DictCursor 已返回字典，无需逐行复制
+                return list(await cursor.fetchall())
                 
     except Exception as e:
         logger.error("只读查询执行失败", sql=sql[:100], error=str(e))
         raise
 
 
+async def stream_query_ro(sql: str, params = None,
+                          batch_size: int = 1000) -> AsyncIterator[List[Dict[str, Any]]]:
+    """以服务端游标（SSCursor）流式执行只读查询，按批返回结果
+
+    结果不在客户端整体缓冲，内存占用与批大小成正比。迭代完成前会占用一个连接，
+    调用方应尽快消费每一批数据。
+    """
+    pool = await get_mysql_pool_ro()
+    
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSDictCursor) as cursor:
+                await cursor.execute(sql, params or {})
+                while True:
+                    batch = await cursor.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    yield list(batch)
+                
+    except Exception as e:
+        logger.error("流式只读查询执行失败", sql=sql[:100], error=str(e))
+        raise
+
+
 async def execute_query_agg(sql: str, params = None) -> int:
     """执行聚合查询（有写权限）"""
     pool = await get_mysql_pool_agg()
@@ -143,26 +174,152 @@ async def execute_query_agg(sql: str, params = None) -> int:
         raise
 
 
-async def batch_insert_agg(sql: str, data_list: List) -> int:
-    """批量插入聚合数据"""
-    if not data_list:
-        return 0
+async def get_max_allowed_packet() -> int:
+    """获取聚合库的 max_allowed_packet（字节，进程内缓存）"""
+    global _max_allowed_packet
+    
+    if _max_allowed_packet is None:
+        pool = await get_mysql_pool_agg()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT @@max_allowed_packet")
+                row = await cursor.fetchone()
+                _max_allowed_packet = int(row[0])
+        logger.info("获取max_allowed_packet成功", max_allowed_packet=_max_allowed_packet)
+    
+    return _max_allowed_packet
+
+
+async def bulk_upsert_agg(sql_template: str, rows: List[List[Any]], conn=None) -> Dict[str, Any]:
+    """以多行 VALUES 语句批量写入聚合数据
+
+    sql_template 中的 {values} 替换为 "(..),(..)" 形式的多行值列表。每条语句按字节大小切分，
+    上限为 max_allowed_packet 的90%（AGG_MAX_STATEMENT_BYTES 可进一步限制），
+    在一个连接上依次执行。返回写入统计，其中 batch_latencies_ms 为每条语句的耗时。
+    传入 conn（agg_transaction 提供的连接）时在该事务内执行且不逐条提交。
+    """
+    stats = {"statements": 0, "rows": 0, "affected_rows": 0, "bytes": 0, "batch_latencies_ms": []}
+    if not rows:
+        return stats
+
+    limit = int(await get_max_allowed_packet() * 0.9)
+    if settings.agg_max_statement_bytes > 0:
+        limit = min(limit, settings.agg_max_statement_bytes)
+
+    head, tail = sql_template.split("{values}")
+    base_size = len(head.encode("utf-8")) + len(tail.encode("utf-8"))
+
+    async def write(conn, autocommit: bool):
+        async with conn.cursor() as cursor:
+            async def flush(values: List[str], size: int):
+                started = time.perf_counter()
+                await cursor.execute(head + ",".join(values) + tail)
+                if autocommit:
+                    await conn.commit()
+                latency_ms = (time.perf_counter() - started) * 1000
 
+                stats["statements"] += 1
+                stats["rows"] += len(values)
+                stats["affected_rows"] += cursor.rowcount
+                stats["bytes"] += size
+                stats["batch_latencies_ms"].append(latency_ms)
+                logger.debug("批量写入聚合数据",
+                            rows=len(values),
+                            statement_bytes=size,
+                            affected_rows=cursor.rowcount,
+                            latency_ms=round(latency_ms, 2))
+
+            values: List[str] = []
+            size = base_size
+            for row in rows:
+                literal = "(" + ",".join(conn.literal(value) for value in row) + ")"
+                # 二进制草图经 surrogateescape 转义，与驱动发送时的编码方式一致
+                literal_size = len(literal.encode("utf-8", "surrogateescape")) + 1
+                if values and size + literal_size > limit:
+                    await flush(values, size)
+                    values, size = [], base_size
+                values.append(literal)
+                size += literal_size
+
+            if values:
+                await flush(values, size)
+
+    try:
+        if conn is not None:
+            await write(conn, autocommit=False)
+        else:
+            pool = await get_mysql_pool_agg()
+            async with pool.acquire() as conn:
+                await write(conn, autocommit=True)
+
+    except Exception as e:
+        logger.error("批量写入聚合数据失败", sql=head[:100], data_count=len(rows),
+                    written_rows=stats["rows"], error=str(e))
+        raise
+
+    return stats
+
+
+@asynccontextmanager
+async def agg_transaction() -> AsyncIterator[aiomysql.Connection]:
+    """在聚合库上开启一个事务，块内全部写入一起提交，异常时整体回滚"""
+    # 事务内的批量写入需要 max_allowed_packet，先于占用连接获取，避免并发事务占满连接池时互相等待
+    await get_max_allowed_packet()
     pool = await get_mysql_pool_agg()
+    async with pool.acquire() as conn:
+        await conn.begin()
+        try:
+            yield conn
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+
+
+CHECKPOINTS_QUERY = "SELECT name, watermark_time, watermark_id FROM agg_checkpoints"
 
+# 水位只前进不后退，NULL 表示保留原值
+CHECKPOINT_UPSERT_SQL = """
+    INSERT INTO agg_checkpoints (name, watermark_time, watermark_id)
+    VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        watermark_time = GREATEST(COALESCE(watermark_time, VALUES(watermark_time)),
+                                  COALESCE(VALUES(watermark_time), watermark_time)),
+        watermark_id = GREATEST(COALESCE(watermark_id, VALUES(watermark_id)),
+                                COALESCE(VALUES(watermark_id), watermark_id))
+"""
+
+
+async def get_checkpoints() -> Dict[str, Dict[str, Any]]:
+    """读取聚合检查点 {名称: {"watermark_time": datetime, "watermark_id": int}}
+
+    从聚合库（写库）读取，保证读到本进程刚提交的检查点。
+    """
+    pool = await get_mysql_pool_agg()
+    
     try:
         async with pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                # 使用executemany进行批量插入
-                await cursor.executemany(sql, data_list)
-                await conn.commit()  # 确保提交事务
-                return cursor.rowcount
-
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(CHECKPOINTS_QUERY)
+                return {row["name"]: row for row in await cursor.fetchall()}
     except Exception as e:
-        logger.error("批量插入失败", sql=sql[:100], data_count=len(data_list), error=str(e))
+        logger.error("读取聚合检查点失败", error=str(e))
         raise
 
 
+async def set_checkpoints(conn, checkpoints: Dict[str, Tuple[Optional[Any], Optional[int]]]):
+    """在给定事务连接上写入检查点 {名称: (时间水位, id水位)}，随事务一起提交"""
+    if not checkpoints:
+        return
+    
+    async with conn.cursor() as cursor:
+        await cursor.executemany(
+            CHECKPOINT_UPSERT_SQL,
+            [(name, watermark_time, watermark_id)
+             for name, (watermark_time, watermark_id) in checkpoints.items()]
+        )
+
+
 async def get_last_aggregation_time() -> Optional[str]:
     """获取最后一次聚合时间"""
     redis_client = await get_redis_client()
@@ -182,3 +339,133 @@ async def set_last_aggregation_time(timestamp: str):
         await redis_client.set("last_aggregation_time", timestamp)
     except Exception as e:
         logger.warning("设置最后聚合时间失败", error=str(e))
+
+
+async def get_last_aggregated_log_id() -> Optional[int]:
+    """获取增量聚合的logs.id高水位"""
+    redis_client = await get_redis_client()
+    
+    try:
+        value = await redis_client.get("last_aggregated_log_id")
+        return int(value) if value is not None else None
+    except Exception as e:
+        logger.warning("获取增量聚合高水位失败", error=str(e))
+        return None
+
+
+async def set_last_aggregated_log_id(log_id: int):
+    """设置增量聚合的logs.id高水位"""
+    redis_client = await get_redis_client()
+    
+    try:
+        await redis_client.set("last_aggregated_log_id", log_id)
+    except Exception as e:
+        logger.warning("设置增量聚合高水位失败", error=str(e))
+
+
+async def bump_aggregation_revision():
+    """递增聚合修订号
+
+    已定稿的小时被重写（迟到日志重算、回填）后调用，API的分段缓存键包含修订号，
+    递增后已缓存的封闭分段全部失效。
+    """
+    redis_client = await get_redis_client()
+    
+    try:
+        await redis_client.incr("aggregation_revision")
+    except Exception as e:
+        logger.warning("递增聚合修订号失败", error=str(e))
+
+
+async def get_backfill_done_chunks(job_id: str) -> Set[str]:
+    """获取回填任务已完成的分片（分片起始时间ISO字符串）"""
+    redis_client = await get_redis_client()
+    
+    try:
+        return set(await redis_client.smembers(f"backfill:{job_id}:done"))
+    except Exception as e:
+        logger.warning("获取回填进度失败", job_id=job_id, error=str(e))
+        return set()
+
+
+async def mark_backfill_chunk_done(job_id: str, chunk_start: str):
+    """记录回填任务的一个分片已完成"""
+    redis_client = await get_redis_client()
+    
+    try:
+        await redis_client.sadd(f"backfill:{job_id}:done", chunk_start)
+    except Exception as e:
+        logger.warning("记录回填进度失败", job_id=job_id, chunk=chunk_start, error=str(e))
+
+
+async def clear_backfill_checkpoint(job_id: str):
+    """清除回填任务的进度记录"""
+    redis_client = await get_redis_client()
+    
+    try:
+        await redis_client.delete(f"backfill:{job_id}:done")
+    except Exception as e:
+        logger.warning("清除回填进度失败", job_id=job_id, error=str(e))
+
+
+# 待重算小时保存在聚合库的 agg_dirty_hours 表中，同一小时保留最大的迟到日志id
+DIRTY_HOURS_UPSERT_SQL = """
+    INSERT INTO agg_dirty_hours (hour_bucket, max_log_id)
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE max_log_id = GREATEST(max_log_id, VALUES(max_log_id))
+"""
+
+DIRTY_HOURS_QUERY = """
+    SELECT hour_bucket, max_log_id
+    FROM agg_dirty_hours
+    ORDER BY hour_bucket
+    LIMIT %s
+"""
+
+# 仅当记录的迟到日志id未超过本次重算的快照时才移除，避免丢失重算期间新到的迟到日志
+DIRTY_HOUR_DELETE_SQL = "DELETE FROM agg_dirty_hours WHERE hour_bucket = %s AND max_log_id <= %s"
+
+
+async def add_dirty_hours(hours: Dict[str, int]):
+    """记录收到迟到日志的已定稿小时 {小时桶: 迟到日志的最大id}，同一小时保留最大id
+
+    写入失败时抛出异常：调用方在推进logs.id水位之前标记，失败的一轮不提交水位，
+    下一轮重新检测同一id区间，迟到日志不会因此漏算。
+    """
+    if not hours:
+        return
+    pool = await get_mysql_pool_agg()
+
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(DIRTY_HOURS_UPSERT_SQL, list(hours.items()))
+            await conn.commit()
+    except Exception as e:
+        logger.error("记录待重算小时失败", hours=list(hours), error=str(e))
+        raise
+
+
+async def get_dirty_hours(limit: int) -> List[Tuple[str, int]]:
+    """获取待重算的小时桶（"%Y-%m-%d %H:00:00"）及其迟到日志最大id，按小时先后排序
+
+    从聚合库（写库）读取，保证读到刚记录的小时。
+    """
+    pool = await get_mysql_pool_agg()
+
+    try:
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(DIRTY_HOURS_QUERY, (limit,))
+                return [(str(row["hour_bucket"]), int(row["max_log_id"])) for row in await cursor.fetchall()]
+    except Exception as e:
+        logger.warning("获取待重算小时失败", error=str(e))
+        return []
+
+
+async def remove_dirty_hour(hour: str, max_log_id: int):
+    """重算完成后移除待重算小时"""
+    try:
+        await execute_query_agg(DIRTY_HOUR_DELETE_SQL, (hour, max_log_id))
+    except Exception as e:
+        logger.warning("移除待重算小时失败", hour=hour, error=str(e))
@@ -0,0 +1,117 @@
+"""分阶段异步流水线模块
+
+聚合任务的读取（只读连接池上流式查询并折叠）与写入（聚合连接池上批量upsert）相互独立，
+串行执行时一方等待MySQL，另一方的连接池就处于空闲状态。流水线以有界队列连接读写两个阶段：
+读取阶段提前准备下一个分块，写入阶段同时写入上一个分块，队列满时读取阶段等待（背压）。
+
+同一条流水线只有一个写入者，分块按产出顺序写入，检查点只会按顺序前进；
+需要更高并发时由调用方并行运行多条流水线（如不同维度各一条）。
+"""
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+import structlog
+
+logger = structlog.get_logger()
+
+# 读取阶段结束标记
+_DONE = object()
+
+
+class _Failure:
+    """读取阶段的异常，经队列传递给写入阶段后重新抛出"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class StageTimings:
+    """各阶段累计耗时与处理的分块数
+
+    除 read/write 本身外，read_blocked 为读取阶段因队列已满等待的时间（写入是瓶颈），
+    write_idle 为写入阶段因队列为空等待的时间（读取是瓶颈）。
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def add(self, stage: str, seconds: float, items: int = 1):
+        """累计一个阶段的耗时"""
+        entry = self.stages.setdefault(stage, {"seconds": 0.0, "items": 0})
+        entry["seconds"] += seconds
+        entry["items"] += items
+
+    def merge(self, other: "StageTimings"):
+        """并入另一组阶段耗时"""
+        for stage, entry in other.stages.items():
+            self.add(stage, entry["seconds"], entry["items"])
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """返回 {阶段: {"ms": 累计毫秒, "items": 分块数}}，用于日志输出"""
+        return {
+            stage: {"ms": round(entry["seconds"] * 1000, 2), "items": int(entry["items"])}
+            for stage, entry in self.stages.items()
+        }
+
+
+async def run_pipeline(source: AsyncIterator[Any],
+                       sink: Callable[[Any], Awaitable[None]],
+                       queue_size: int,
+                       timings: StageTimings,
+                       prefix: str = ""):
+    """运行读取-写入两阶段流水线
+
+    source 为产出分块的异步迭代器（读取阶段），sink 逐个写入分块（写入阶段），
+    两者通过容量为 queue_size 的队列并发执行。任一阶段失败时取消另一阶段并抛出异常。
+    各阶段耗时以 prefix 为前缀累计到 timings 中。
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, queue_size))
+
+    async def produce():
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = await source.__anext__()
+                except StopAsyncIteration:
+                    break
+                timings.add(f"{prefix}read", time.perf_counter() - started)
+
+                started = time.perf_counter()
+                await queue.put(item)
+                timings.add(f"{prefix}read_blocked", time.perf_counter() - started)
+        except Exception as e:
+            await queue.put(_Failure(e))
+            return
+        await queue.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            started = time.perf_counter()
+            item = await queue.get()
+            timings.add(f"{prefix}write_idle", time.perf_counter() - started)
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+
+            started = time.perf_counter()
+            await sink(item)
+            timings.add(f"{prefix}write", time.perf_counter() - started)
+
+        await producer
+    except BaseException:
+        producer.cancel()
+        try:
+            await producer
+        except (asyncio.CancelledError, Exception):
+            pass
+        # 关闭读取阶段的异步生成器，及时归还其占用的只读连接
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception:
+                pass
+        raise
@@ -0,0 +1,272 @@
+"""可合并的统计草图：去重计数（HyperLogLog）与分位数（DDSketch）
+
+聚合表为每个时间桶/维度保存用户与Token的HLL草图，任意时间范围的去重数可由草图取并集估算；
+全局与模型维度另保存单请求Token数的DDSketch，任意时间范围的分位数可由草图合并得到，
+均无需回查logs。序列化格式需与 api/app/sketches.py 保持一致。
+
+序列化格式: 1字节版本 + 1字节精度p + 1字节编码 + 寄存器数据
+    - 稠密编码: m = 2^p 个寄存器，每个1字节
+    - 稀疏编码: 非零寄存器按索引升序排列，每项为2字节索引(大端) + 1字节值
+"""
+import hashlib
+import math
+import struct
+from typing import Dict, Iterable, Optional
+
+SKETCH_VERSION = 1
+ENCODING_DENSE = 0
+ENCODING_SPARSE = 1
+
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+# 稠密草图占 3 + 2^p 字节，p=16 时超过 BLOB 列的65535字节上限
+MAX_PRECISION = 15
+
+_MASK64 = (1 << 64) - 1
+_HEADER = struct.Struct(">BBB")
+_SPARSE_ENTRY = struct.Struct(">HB")
+
+# DDSketch 分位数草图：1字节版本 + 8字节γ(双精度) + 8字节0值计数 + 按索引升序的(4字节索引, 8字节计数)
+QUANTILE_SKETCH_VERSION = 1
+DEFAULT_RELATIVE_ACCURACY = 0.01
+_QUANTILE_HEADER = struct.Struct(">BdQ")
+_QUANTILE_BIN = struct.Struct(">iQ")
+
+
+def hash64(value) -> int:
+    """计算稳定的64位哈希（跨进程一致，不依赖Python内置hash）"""
+    if isinstance(value, int):
+        # splitmix64 终结函数，整数ID分布均匀且计算开销小
+        z = (value + 0x9E3779B97F4A7C15) & _MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return z ^ (z >> 31)
+
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class HyperLogLog:
+    """HyperLogLog 草图
+
+    元素较少时以稀疏字典保存寄存器，超过阈值后转为稠密数组，
+    使单用户、单Token等小基数时间桶的草图仅占用几个字节。
+    """
+
+    def __init__(self, precision: int = DEFAULT_PRECISION):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(f"不支持的HLL精度: {precision}")
+
+        self.precision = precision
+        self.m = 1 << precision
+        self._sparse: Optional[Dict[int, int]] = {}
+        self._dense: Optional[bytearray] = None
+
+    @classmethod
+    def from_values(cls, values: Iterable, precision: int = DEFAULT_PRECISION) -> "HyperLogLog":
+        """由一组值构建草图，忽略None"""
+        sketch = cls(precision)
+        for value in values:
+            if value is not None:
+                sketch.add(value)
+        return sketch
+
+    def add(self, value):
+        """添加一个元素"""
+        x = hash64(value)
+        index = x >> (64 - self.precision)
+        remaining = x & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        self._set_register(index, rank)
+
+    def _set_register(self, index: int, rank: int):
+        if self._dense is not None:
+            if rank > self._dense[index]:
+                self._dense[index] = rank
+            return
+
+        if rank > self._sparse.get(index, 0):
+            self._sparse[index] = rank
+            if len(self._sparse) > self.m // 16:
+                self._to_dense()
+
+    def _to_dense(self):
+        dense = bytearray(self.m)
+        for index, rank in self._sparse.items():
+            dense[index] = rank
+        self._dense = dense
+        self._sparse = None
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        """就地合并另一个草图（取寄存器最大值），返回自身"""
+        if other.precision != self.precision:
+            raise ValueError(f"HLL精度不一致: {self.precision} != {other.precision}")
+
+        if other._dense is not None:
+            if self._dense is None:
+                self._to_dense()
+            self._dense = bytearray(map(max, self._dense, other._dense))
+        else:
+            for index, rank in other._sparse.items():
+                self._set_register(index, rank)
+        return self
+
+    def cardinality(self) -> int:
+        """估算去重元素个数"""
+        if self._dense is not None:
+            registers = self._dense
+            zeros = registers.count(0)
+        else:
+            registers = self._sparse.values()
+            zeros = self.m - len(self._sparse)
+
+        if zeros == self.m:
+            return 0
+
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        harmonic = zeros + sum(2.0 ** -rank for rank in registers if rank)
+        estimate = alpha * self.m * self.m / harmonic
+
+        # 小基数区间使用线性计数修正
+        if estimate <= 2.5 * self.m and zeros > 0:
+            estimate = self.m * math.log(self.m / zeros)
+
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        """序列化，自动选择更紧凑的编码"""
+        if self._dense is None and len(self._sparse) * _SPARSE_ENTRY.size < self.m:
+            body = b"".join(
+                _SPARSE_ENTRY.pack(index, rank) for index, rank in sorted(self._sparse.items())
+            )
+            return _HEADER.pack(SKETCH_VERSION, self.precision, ENCODING_SPARSE) + body
+
+        if self._dense is None:
+            self._to_dense()
+        return _HEADER.pack(SKETCH_VERSION, self.precision, ENCODING_DENSE) + bytes(self._dense)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        """反序列化"""
+        version, precision, encoding = _HEADER.unpack_from(data)
+        if version != SKETCH_VERSION:
+            raise ValueError(f"不支持的草图版本: {version}")
+
+        sketch = cls(precision)
+        body = memoryview(data)[_HEADER.size:]
+        if encoding == ENCODING_DENSE:
+            sketch._dense = bytearray(body)
+            sketch._sparse = None
+        elif encoding == ENCODING_SPARSE:
+            for index, rank in _SPARSE_ENTRY.iter_unpack(body):
+                sketch._sparse[index] = rank
+            if len(sketch._sparse) > sketch.m // 16:
+                sketch._to_dense()
+        else:
+            raise ValueError(f"不支持的草图编码: {encoding}")
+        return sketch
+
+
+def union_cardinality(blobs: Iterable[Optional[bytes]]) -> Optional[int]:
+    """对一组序列化草图取并集并估算去重数，全部为空时返回None"""
+    merged: Optional[HyperLogLog] = None
+    for blob in blobs:
+        if not blob:
+            continue
+        sketch = HyperLogLog.from_bytes(blob)
+        merged = sketch if merged is None else merged.merge(sketch)
+    return merged.cardinality() if merged is not None else None
+
+
+class DDSketch:
+    """DDSketch 分位数草图
+
+    正数按对数分桶：桶 i 覆盖 (γ^(i-1), γ^i]，γ = (1+α)/(1-α)，
+    以桶的代表值估算分位数时相对误差不超过 α；0 与负数单独计数。
+    桶计数可直接相加，合并无损，任意时间范围的分位数可由各时间桶的草图合并得到。
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY, gamma: Optional[float] = None):
+        if gamma is None:
+            if not 0 < relative_accuracy < 1:
+                raise ValueError(f"不支持的分位数相对误差: {relative_accuracy}")
+            gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+
+        self.gamma = gamma
+        self.log_gamma = math.log(gamma)
+        self.zero_count = 0
+        self.bins: Dict[int, int] = {}
+
+    @classmethod
+    def from_values(cls, values: Iterable, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY) -> "DDSketch":
+        """由一组值构建草图，忽略None"""
+        sketch = cls(relative_accuracy)
+        for value in values:
+            if value is not None:
+                sketch.add(value)
+        return sketch
+
+    def add(self, value, count: int = 1):
+        """添加一个值"""
+        if value <= 0:
+            self.zero_count += count
+        else:
+            self.add_bin(math.ceil(math.log(value) / self.log_gamma), count)
+
+    def add_bin(self, index: Optional[int], count: int):
+        """按桶索引累加计数（索引为None表示0值桶），用于直接导入SQL分桶统计的结果"""
+        if index is None:
+            self.zero_count += count
+        else:
+            self.bins[index] = self.bins.get(index, 0) + count
+
+    @property
+    def count(self) -> int:
+        """值的总个数"""
+        return self.zero_count + sum(self.bins.values())
+
+    def merge(self, other: "DDSketch") -> "DDSketch":
+        """就地合并另一个草图（桶计数相加），返回自身"""
+        if abs(other.gamma - self.gamma) > 1e-12:
+            raise ValueError(f"DDSketch相对误差不一致: {self.gamma} != {other.gamma}")
+
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        """估算分位数（0 <= q <= 1），草图为空时返回None"""
+        total = self.count
+        if total == 0:
+            return None
+
+        rank = q * (total - 1)
+        cumulative = self.zero_count
+        if rank < cumulative:
+            return 0.0
+
+        index = None
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                break
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def to_bytes(self) -> bytes:
+        """序列化"""
+        body = b"".join(_QUANTILE_BIN.pack(index, count) for index, count in sorted(self.bins.items()))
+        return _QUANTILE_HEADER.pack(QUANTILE_SKETCH_VERSION, self.gamma, self.zero_count) + body
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DDSketch":
+        """反序列化"""
+        version, gamma, zero_count = _QUANTILE_HEADER.unpack_from(data)
+        if version != QUANTILE_SKETCH_VERSION:
+            raise ValueError(f"不支持的分位数草图版本: {version}")
+
+        sketch = cls(gamma=gamma)
+        sketch.zero_count = zero_count
+        for index, count in _QUANTILE_BIN.iter_unpack(memoryview(data)[_QUANTILE_HEADER.size:]):
+            sketch.bins[index] = count
+        return sketch
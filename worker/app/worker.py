@@ -6,6 +6,7 @@ from datetime import datetime
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.cron import CronTrigger
+import requests
 import structlog
 
 from app.config import settings, rules_config
@@ -107,6 +108,16 @@ class WorkerApp:
             coalesce=True
         )
         
+        # 迟到日志重算 - 每15分钟执行一次
+        self.scheduler.add_job(
+            self._run_dirty_bucket_job,
+            trigger=IntervalTrigger(minutes=settings.dirty_bucket_interval_minutes),
+            id="dirty_bucket_job",
+            name="迟到日志重算",
+            max_instances=1,
+            coalesce=True
+        )
+        
         # 突发频率检测 - 每1分钟执行一次
         self.scheduler.add_job(
             self._run_burst_check_job,
@@ -163,10 +174,41 @@ class WorkerApp:
         """执行数据聚合任务"""
         try:
             logger.info("开始执行数据聚合任务")
-            await data_aggregator.aggregate_hourly_data()
+            if settings.aggregation_incremental:
+                await data_aggregator.aggregate_incremental()
+            else:
+                await data_aggregator.aggregate_hourly_data()
             logger.info("数据聚合任务执行完成")
         except Exception as e:
             logger.error("数据聚合任务执行失败", error=str(e))
+            return
+
+        await self._warm_dashboard_cache()
+
+    async def _warm_dashboard_cache(self):
+        """聚合完成后通知API预热仪表盘默认视图，默认视图的请求不再查询MySQL"""
+        if not settings.api_internal_url or not settings.cache_warm_token:
+            return
+        url = f"{settings.api_internal_url.rstrip('/')}/cache/warm"
+        try:
+            response = await asyncio.to_thread(
+                requests.post, url,
+                headers={"X-Cache-Warm-Token": settings.cache_warm_token},
+                timeout=settings.cache_warm_timeout_seconds
+            )
+            response.raise_for_status()
+            logger.info("仪表盘默认视图预热完成", **response.json())
+        except Exception as e:
+            logger.warning("仪表盘默认视图预热失败", url=url, error=str(e))
+    
+    async def _run_dirty_bucket_job(self):
+        """执行迟到日志重算任务"""
+        try:
+            logger.debug("开始执行迟到日志重算")
+            await data_aggregator.recompute_dirty_hours()
+            logger.debug("迟到日志重算完成")
+        except Exception as e:
+            logger.error("迟到日志重算失败", error=str(e))
     
     async def _run_burst_check_job(self):
         """执行突发频率检测任务"""
@@ -208,8 +250,8 @@ class WorkerApp:
         """执行清理旧数据任务"""
         try:
             logger.info("开始执行清理旧数据任务")
-            await data_aggregator.cleanup_old_aggregation_data()
-            logger.info("清理旧数据任务执行完成")
+            report = await data_aggregator.cleanup_old_aggregation_data()
+            logger.info("清理旧数据任务执行完成", report=report)
         except Exception as e:
             logger.error("清理旧数据任务执行失败", error=str(e))
     
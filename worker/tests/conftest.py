@@ -0,0 +1,8 @@
+"""Worker单元测试：不连接MySQL与Redis，只测试草图、写入语句生成与切分等逻辑
+
+运行: cd worker && python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
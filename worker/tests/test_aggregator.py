@@ -0,0 +1,57 @@
+"""聚合逻辑的纯函数（不连接数据库）"""
+from app.aggregator import (
+    build_upsert_sql, dimension_keys, merge_sketch_columns, HOURLY_KEY_COLUMNS, ADDITIVE_METRIC_COLUMNS
+)
+from app.sketches import HyperLogLog, DDSketch
+
+
+class TestBuildUpsertSql:
+    def test_overwrite(self):
+        sql = build_upsert_sql("agg_usage_minute", ("minute_bucket",), value_columns=("request_count", "unique_users"))
+        assert sql == (
+            "INSERT INTO agg_usage_minute (minute_bucket, request_count, unique_users) VALUES {values} "
+            "ON DUPLICATE KEY UPDATE request_count = VALUES(request_count), "
+            "unique_users = VALUES(unique_users), updated_at = CURRENT_TIMESTAMP"
+        )
+
+    def test_additive_accumulates_only_additive_metrics(self):
+        sql = build_upsert_sql("agg_usage_hourly", HOURLY_KEY_COLUMNS, additive=True)
+        for column in ADDITIVE_METRIC_COLUMNS:
+            assert f"{column} = {column} + VALUES({column})" in sql
+        # 去重计数与草图不能相加，由写入前合并后的结果覆盖
+        assert "unique_users = VALUES(unique_users)" in sql
+        assert "users_sketch = VALUES(users_sketch)" in sql
+        assert sql.count("{values}") == 1
+
+
+def test_dimension_keys_use_sentinels():
+    result = {"user_id": 7, "model_name": None, "channel_id": 3, "token_id": 9}
+    assert dimension_keys(result, "global") == [0, "", 0, 0]
+    assert dimension_keys(result, "user") == [7, "", 0, 0]
+    # 维度值本身为NULL时同样写入哨兵值
+    assert dimension_keys(result, "model") == [0, "", 0, 0]
+
+
+class TestMergeSketchColumns:
+    def test_merges_hll_and_updates_counts(self):
+        existing = {"users_sketch": HyperLogLog.from_values([1, 2]).to_bytes(),
+                    "tokens_sketch": HyperLogLog.from_values([10]).to_bytes()}
+        result = {"unique_users": 2, "users_sketch": HyperLogLog.from_values([2, 3]).to_bytes(),
+                  "unique_tokens": 1, "tokens_sketch": HyperLogLog.from_values([10]).to_bytes()}
+
+        merge_sketch_columns(result, existing)
+
+        assert result["unique_users"] == 3
+        assert result["unique_tokens"] == 1
+        assert HyperLogLog.from_bytes(result["users_sketch"]).cardinality() == 3
+
+    def test_merges_quantile_sketch_or_keeps_existing(self):
+        existing = {"tokens_qsketch": DDSketch.from_values([1, 2]).to_bytes()}
+
+        result = {"tokens_qsketch": DDSketch.from_values([3]).to_bytes()}
+        merge_sketch_columns(result, existing)
+        assert DDSketch.from_bytes(result["tokens_qsketch"]).count == 3
+
+        result = {"tokens_qsketch": None}
+        merge_sketch_columns(result, existing)
+        assert result["tokens_qsketch"] == existing["tokens_qsketch"]
@@ -0,0 +1,87 @@
+"""多行 VALUES 写入语句按 max_allowed_packet 切分"""
+import asyncio
+
+from app import database
+from app.database import bulk_upsert_agg
+
+TEMPLATE = "INSERT INTO t (a, b) VALUES {values} ON DUPLICATE KEY UPDATE b = VALUES(b)"
+
+
+class FakeCursor:
+    def __init__(self, statements):
+        self.statements = statements
+        self.rowcount = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql):
+        self.statements.append(sql)
+        self.rowcount = sql.count("),(") + 1
+
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self.statements)
+
+    def literal(self, value):
+        return f"'{value}'" if isinstance(value, str) else str(value)
+
+    async def commit(self):
+        self.commits += 1
+
+
+def run_upsert(monkeypatch, rows, max_allowed_packet):
+    async def fake_packet():
+        return max_allowed_packet
+
+    monkeypatch.setattr(database, "get_max_allowed_packet", fake_packet)
+    monkeypatch.setattr(database.settings, "agg_max_statement_bytes", 0)
+    conn = FakeConnection()
+    stats = asyncio.run(bulk_upsert_agg(TEMPLATE, rows, conn=conn))
+    return conn, stats
+
+
+def test_splits_statements_below_packet_limit(monkeypatch):
+    rows = [[i, "x" * 20] for i in range(100)]
+    limit = 1000
+    conn, stats = run_upsert(monkeypatch, rows, limit)
+
+    assert stats["statements"] == len(conn.statements) > 1
+    assert stats["rows"] == 100
+    assert all(len(sql.encode()) <= limit * 0.9 for sql in conn.statements)
+    # 所有行都写出，且在事务连接上不逐条提交
+    assert sum(sql.count("'" + "x" * 20 + "'") for sql in conn.statements) == 100
+    assert conn.commits == 0
+
+
+def test_single_statement_when_rows_fit(monkeypatch):
+    conn, stats = run_upsert(monkeypatch, [[1, "a"], [2, "b"]], 1 << 20)
+    assert conn.statements == [
+        "INSERT INTO t (a, b) VALUES (1,'a'),(2,'b') ON DUPLICATE KEY UPDATE b = VALUES(b)"
+    ]
+    assert stats["affected_rows"] == 2
+
+
+def test_statement_byte_setting_lowers_limit(monkeypatch):
+    async def fake_packet():
+        return 1 << 20
+
+    monkeypatch.setattr(database, "get_max_allowed_packet", fake_packet)
+    monkeypatch.setattr(database.settings, "agg_max_statement_bytes", 200)
+    conn = FakeConnection()
+    asyncio.run(bulk_upsert_agg(TEMPLATE, [[i, "y" * 10] for i in range(20)], conn=conn))
+    assert len(conn.statements) > 1
+    assert all(len(sql.encode()) <= 200 for sql in conn.statements)
+
+
+def test_empty_rows_write_nothing(monkeypatch):
+    conn, stats = run_upsert(monkeypatch, [], 1000)
+    assert conn.statements == [] and stats["statements"] == 0
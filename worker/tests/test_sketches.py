@@ -0,0 +1,29 @@
+"""草图序列化格式与精度上限"""
+import pytest
+
+from app.sketches import HyperLogLog, DDSketch, MAX_PRECISION
+
+# 序列化格式需与 api/app/sketches.py 一致，两边的测试使用相同的字节
+HLL_BYTES = bytes.fromhex("010a01010301024403")
+DDSKETCH_BYTES = bytes.fromhex(
+    "013ff052bf5a814afd0000000000000001000000510000000000000001000000e70000000000000001"
+)
+
+
+def test_serialized_format_matches_api():
+    assert HyperLogLog.from_values([1, "a"], precision=10).to_bytes() == HLL_BYTES
+    assert DDSketch.from_values([0, 5, 100]).to_bytes() == DDSKETCH_BYTES
+
+
+def test_hll_round_trip_and_merge():
+    left = HyperLogLog.from_values(range(0, 3000))
+    right = HyperLogLog.from_bytes(HyperLogLog.from_values(range(2000, 5000)).to_bytes())
+    merged = HyperLogLog.from_bytes(left.merge(right).to_bytes())
+    assert abs(merged.cardinality() - 5000) / 5000 < 0.03
+
+
+def test_max_precision_fits_blob_column():
+    sketch = HyperLogLog.from_values(range(100000), precision=MAX_PRECISION)
+    assert len(sketch.to_bytes()) <= 65535
+    with pytest.raises(ValueError):
+        HyperLogLog(MAX_PRECISION + 1)